@@ -0,0 +1,332 @@
+import asyncio
+import collections
+import random
+
+from framing import LineFramer, VarintFramer
+from protocol import NOTICE, PING, SWITCH, Event, EventReader
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    The protocol of one connection of a ChatConnection. Incoming data is
+    split into lines by a LineFramer and handed to the ChatConnection. A
+    binary connection switches to an EventReader once the server confirms
+    the binary protocol. PINGs of the server are answered here and not
+    handed on.
+    """
+
+    # Constructor.
+    def __init__(self, connection):
+        self.connection = connection
+        self.framer = LineFramer(connection.maxFrame)
+        self.reader = None
+        self.transport = None
+        # Set while the transport's write buffer is over its high watermark.
+        self.writable = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.reader is not None:
+            self.reader.feed(data)
+            for event in self.reader.events():
+                if event.kind == PING:
+                    self.connection.pong(event.text)
+                else:
+                    self.connection.received(event)
+            return
+        self.framer.feed(data)
+        frames = self.framer.frames()
+        for line in frames:
+            # Lines longer than the maximum frame size are dropped.
+            if line is None:
+                continue
+            if line.startswith("PING "):
+                self.connection.pong(line[5:])
+            elif not self.connection.binary:
+                self.connection.received(line)
+            elif line in (SWITCH, SWITCH + " zlib"):
+                # Everything after this line is binary.
+                frames.close()
+                self.reader = EventReader(line != SWITCH)
+                rest = bytes(self.framer.pending)
+                self.framer.pending.clear()
+                self.data_received(rest)
+                return
+            else:
+                self.connection.received(Event(NOTICE, line))
+
+    def connection_lost(self, exc):
+        self.resume_writing()
+        self.connection.lost(self, exc)
+
+    def pause_writing(self):
+        self.writable = asyncio.get_running_loop().create_future()
+
+    def resume_writing(self):
+        if self.writable is not None:
+            if not self.writable.done():
+                self.writable.set_result(None)
+            self.writable = None
+
+
+class ChatConnection:
+    """
+    An asyncio connection to the chat server for bots and other clients
+    without a window. Commands are pipelined: sending never waits for a
+    reply. Incoming lines are read by iterating over the connection with
+    async for, which ends when the connection is closed. A lost connection
+    is reconnected after an exponential backoff with jitter; commands sent
+    in the meantime are kept, up to maxUnsent lines, and sent on reconnect.
+    With binary the connection uses the binary protocol, compressed with
+    compressed, and yields protocol.Event objects instead of lines. With
+    an ssl.SSLContext as ssl the connection uses TLS.
+    """
+
+    # Constructor.
+    def __init__(self, host='127.0.0.1', port=12345, reconnect=True,
+                 minDelay=0.5, maxDelay=30, maxFrame=1 << 16,
+                 maxUnsent=1024, binary=False, compressed=False, ssl=None):
+        self.host = host
+        self.port = port
+        self.ssl = ssl
+        self.reconnect = reconnect
+        self.binary = binary
+        self.compressed = compressed
+        self.minDelay = minDelay
+        self.maxDelay = maxDelay
+        self.maxFrame = maxFrame
+
+        self.protocol = None
+        self.incoming = asyncio.Queue()
+        # Encoded lines sent while disconnected, oldest dropped first.
+        self.unsent = collections.deque(maxlen=maxUnsent)
+        # Failed attempts since a connection last received a line.
+        self.attempts = 0
+        self.reconnects = 0
+        self.connectTask = None
+        self.closed = False
+        # Called with the exception, or None, and the delay until the next
+        # attempt when the connection is lost.
+        self.onDisconnect = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def __aiter__(self):
+        return self
+
+    # Returns the next incoming line or event. Raises StopAsyncIteration once
+    # the connection is closed.
+    async def __anext__(self):
+        line = await self.incoming.get()
+        if line is None:
+            # Ends every later iteration too.
+            self.incoming.put_nowait(None)
+            raise StopAsyncIteration
+        return line
+
+    # Returns True while connected.
+    def isConnected(self):
+        return self.protocol is not None
+
+    # Connects to the server. With reconnect, failed attempts are retried
+    # after a backoff until one succeeds, otherwise OSError is raised.
+    async def start(self):
+        if not self.reconnect:
+            await self.connectOnce()
+            return
+        self.connectTask = asyncio.get_running_loop() \
+            .create_task(self.connectLoop())
+        try:
+            await self.connectTask
+        except asyncio.CancelledError:
+            if not self.closed:
+                raise
+
+    async def connectOnce(self):
+        loop = asyncio.get_running_loop()
+        transport, protocol = await loop.create_connection(
+            lambda: ClientProtocol(self), self.host, self.port, ssl=self.ssl)
+        if self.closed:
+            transport.close()
+            return
+        self.protocol = protocol
+        if self.binary:
+            command = "/protocol binary" + (" zlib" if self.compressed else "")
+            transport.write(f"{command}\n".encode())
+        if self.unsent:
+            transport.writelines(self.unsent)
+            self.unsent.clear()
+
+    async def connectLoop(self):
+        while True:
+            try:
+                await self.connectOnce()
+                return
+            except OSError:
+                pass
+            await asyncio.sleep(self.nextDelay())
+
+    async def reconnectAfter(self, delay):
+        await asyncio.sleep(delay)
+        await self.connectLoop()
+        self.reconnects += 1
+
+    # Returns the delay before the next attempt to connect: doubles with
+    # every failed attempt up to maxDelay, and is randomised so that many
+    # clients do not reconnect at the same time.
+    def nextDelay(self):
+        delay = min(self.maxDelay, self.minDelay * 2 ** min(self.attempts, 30))
+        self.attempts += 1
+        return delay * random.uniform(0.5, 1)
+
+    def received(self, message):
+        # A banned client is disconnected before it receives anything, so the
+        # backoff only starts over once the server talked to us.
+        self.attempts = 0
+        self.incoming.put_nowait(message)
+
+    # Answers a PING of the server.
+    def pong(self, token):
+        self.attempts = 0
+        self.sendNowait(f"/pong {token}")
+
+    def lost(self, protocol, exc):
+        if protocol is not self.protocol:
+            return
+        self.protocol = None
+        if self.closed:
+            return
+        if not self.reconnect:
+            self.closed = True
+            self.incoming.put_nowait(None)
+            return
+        delay = self.nextDelay()
+        if self.onDisconnect is not None:
+            self.onDisconnect(exc, delay)
+        self.connectTask = asyncio.get_running_loop() \
+            .create_task(self.reconnectAfter(delay))
+
+    # Sends the lines without waiting. Raises ConnectionError if the
+    # connection is closed, or is lost and does not reconnect.
+    def sendNowait(self, *lines):
+        if self.closed:
+            raise ConnectionError("connection is closed")
+        if self.binary:
+            data = [VarintFramer.encode(line.encode()) for line in lines]
+        else:
+            data = [line.encode() + b'\n' for line in lines]
+        if self.protocol is None:
+            if not self.reconnect:
+                raise ConnectionError("not connected")
+            self.unsent.extend(data)
+            return
+        self.protocol.transport.writelines(data)
+
+    # Sends the lines and waits until the write buffer is below its high
+    # watermark. Does not wait for replies.
+    async def send(self, *lines):
+        self.sendNowait(*lines)
+        await self.drain()
+
+    # Waits until the write buffer is below its high watermark.
+    async def drain(self):
+        while self.protocol is not None and self.protocol.writable is not None:
+            await self.protocol.writable
+
+    # Returns the number of bytes waiting to be sent.
+    def buffered(self):
+        if self.protocol is None:
+            return sum(map(len, self.unsent))
+        return self.protocol.transport.get_write_buffer_size()
+
+    # Closes the connection and ends iteration. Lines that were not sent yet
+    # are dropped.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.connectTask is not None:
+            self.connectTask.cancel()
+        if self.protocol is not None:
+            self.protocol.transport.close()
+        self.incoming.put_nowait(None)
+
+
+class ClientPool:
+    """
+    A fixed number of connections to the same server, e.g. for a bot that
+    sends more than one connection is allowed to. Commands are sent over the
+    connection with the least data waiting to be sent. Iterating over the
+    pool yields (connection, line) for the lines of every connection.
+    """
+
+    # Constructor. The options are passed to every ChatConnection.
+    def __init__(self, host='127.0.0.1', port=12345, size=4, **options):
+        self.connections = [ChatConnection(host, port, **options)
+                            for _ in range(size)]
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    # Connects every connection of the pool.
+    async def start(self):
+        await asyncio.gather(*(connection.start()
+                               for connection in self.connections))
+
+    # Returns the connected connection with the least data waiting to be
+    # sent, or any connection if none is connected.
+    def get(self):
+        connected = [connection for connection in self.connections
+                     if connection.isConnected()]
+        return min(connected or self.connections,
+                   key=ChatConnection.buffered)
+
+    # Sends the lines over one connection without waiting.
+    def sendNowait(self, *lines):
+        self.get().sendNowait(*lines)
+
+    # Sends the lines over one connection and waits until its write buffer
+    # is below its high watermark.
+    async def send(self, *lines):
+        await self.get().send(*lines)
+
+    # Yields (connection, line) for every incoming line of every connection
+    # until all are closed.
+    async def __aiter__(self):
+        merged = asyncio.Queue()
+
+        async def forward(connection):
+            async for line in connection:
+                await merged.put((connection, line))
+            await merged.put(None)
+
+        loop = asyncio.get_running_loop()
+        tasks = [loop.create_task(forward(connection))
+                 for connection in self.connections]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                item = await merged.get()
+                if item is None:
+                    remaining -= 1
+                else:
+                    yield item
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    # Closes every connection of the pool.
+    def close(self):
+        for connection in self.connections:
+            connection.close()
@@ -0,0 +1,312 @@
+import asyncio
+import signal
+import socket as s
+import sys
+import time
+import traceback
+
+from chatserver import BACKENDS, LINGER_TIMEOUT, Server
+from connection import PAUSE_LIMIT
+from framing import FrameError, LineFramer
+from metrics import serveMetricsAsync
+from tls import serverContext
+
+
+class ChatProtocol(asyncio.Protocol):
+    """
+    One client connection of the asyncio engine. The protocol stands in for
+    the client socket in the Server handlers: it is the key of the user in
+    the registry and the receiver of sendMessageOne.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.framer = LineFramer(server.maxFrame)
+        self.binary = False
+        self.compressor = None
+        self.closing = False
+        self.paused = False
+        self.throttled = False
+        # Data queued during the current event loop iteration.
+        self.outbound = []
+        # When the client was last heard from, whether it was sent a PING
+        # since, and the timer checking that it is still there.
+        self.lastActive = 0
+        self.pinged = False
+        self.activityTimer = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        # asyncio only disables Nagle for sockets created with IPPROTO_TCP,
+        # which the listening socket of Server is not.
+        sock = transport.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+        transport.set_write_buffer_limits(high=self.server.highWatermark,
+                                          low=self.server.lowWatermark)
+        self.server.clock.tick()
+        # The transport of a TLS connection is made once its handshake
+        # completed.
+        sslObject = transport.get_extra_info('ssl_object')
+        if sslObject is not None and sslObject.session_reused and \
+                self.server.metrics is not None:
+            self.server.metrics.resumedSessions += 1
+        self.server.acceptClient(self, transport.get_extra_info('peername'))
+
+    def data_received(self, data):
+        if self.closing:
+            return
+        self.server.clock.tick()
+        if self.server.metrics is not None:
+            self.server.metrics.bytesIn += len(data)
+        self.lastActive = time.monotonic()
+        self.pinged = False
+        self.framer.feed(data)
+        self.processFrames()
+        limiter = self.server.limiter
+        if limiter is not None and not self.closing:
+            delay = limiter.received(self, len(data))
+            if delay:
+                self.throttle(delay)
+
+    # Handles the complete messages received. Stops when the connection
+    # closes or the rate limiter throttles it.
+    def processFrames(self):
+        limiter = self.server.limiter
+        framer = self.framer
+        frames = framer.frames()
+        try:
+            for frame in frames:
+                self.server.handleFrame(self, frame)
+                if self.closing:
+                    return
+                if limiter is not None:
+                    delay = limiter.message(self)
+                    if delay:
+                        self.throttle(delay)
+                        return
+                # The rest is framed by the protocol switched to.
+                if self.framer is not framer:
+                    frames.close()
+                    self.processFrames()
+                    return
+        except FrameError:
+            self.server.handleFrame(self, None)
+            self.server.closeConnection(self)
+
+    # Stops reading for delay seconds.
+    def throttle(self, delay):
+        if self.throttled:
+            return
+        self.throttled = True
+        self.transport.pause_reading()
+        asyncio.get_running_loop().call_later(delay, self.resume)
+        if self.server.metrics is not None:
+            self.server.metrics.throttled += 1
+
+    # Handles the messages received while throttled and reads again.
+    def resume(self):
+        self.throttled = False
+        if self.closing or self.transport.is_closing():
+            return
+        self.server.clock.tick()
+        self.processFrames()
+        if not self.throttled and not self.closing and not (
+                self.paused and self.server.overflowPolicy == 'pause'):
+            self.transport.resume_reading()
+
+    def connection_lost(self, exc):
+        self.server.clock.tick()
+        if self in self.server.getConnectedSockets():
+            self.server.disconnectClient(self)
+
+    def pause_writing(self):
+        self.paused = True
+        if self.server.overflowPolicy == 'disconnect':
+            self.server.dropConnection(self)
+        elif self.server.overflowPolicy == 'pause':
+            self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.paused = False
+        if self.server.overflowPolicy == 'pause' and not self.closing and \
+                not self.throttled:
+            self.transport.resume_reading()
+
+    # Queues data to be written at the end of the event loop iteration.
+    # Returns False if nothing was queued.
+    def write(self, data):
+        if self.closing or self.transport.is_closing():
+            return False
+        self.outbound.append(data)
+        return True
+
+    # Writes the queued data to the transport, which buffers what the socket
+    # does not accept yet. The transport cannot drop what it has buffered, so
+    # the drop policy drops new messages instead while the buffer is over the
+    # limit.
+    def flush(self):
+        outbound, self.outbound = self.outbound, []
+        if self.closing or self.transport.is_closing():
+            return
+        if self.paused:
+            if self.server.overflowPolicy == 'drop':
+                # A compressed stream cannot skip messages.
+                if self.compressor is not None:
+                    self.server.dropConnection(self)
+                return
+            limit = PAUSE_LIMIT * self.server.highWatermark
+            if self.transport.get_write_buffer_size() > limit:
+                self.server.dropConnection(self)
+                return
+        self.transport.writelines(outbound)
+        if self.server.metrics is not None:
+            self.server.metrics.bytesOut += sum(map(len, outbound))
+
+    # Returns the number of bytes waiting to be sent.
+    def getOutboundSize(self):
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size() + \
+            sum(map(len, self.outbound))
+
+    # Closes the transport once its buffer has been sent.
+    def close(self):
+        if self.outbound and self.transport is not None:
+            self.flush()
+        self.closing = True
+        if self.transport is not None:
+            self.transport.close()
+
+    # Closes the transport and discards its buffer.
+    def abort(self):
+        self.closing = True
+        if self.transport is not None:
+            self.transport.abort()
+
+
+class AsyncServer(Server):
+    """
+    Server whose I/O is done by an asyncio event loop instead of the select
+    loop in chatserver.serve. The command handlers are the ones of Server.
+    """
+
+    # Constructor.
+    def __init__(self, port, connections, **options):
+        super().__init__(port, connections, **options)
+        # The event loop watches the sockets instead of the selector.
+        self.selector.close()
+        self.selector = None
+
+    def appendConnectedSockets(self, sock):
+        self.connectedSockets[sock] = sock
+
+    def removeConnectedSockets(self, sock):
+        if self.connectedSockets.pop(sock, None) is None:
+            return
+        if self.capture is not None:
+            self.capture.close(sock)
+        if sock.activityTimer is not None:
+            sock.activityTimer.cancel()
+        if self.limiter is not None:
+            self.limiter.forget(sock)
+        if self.metrics is not None:
+            self.metrics.closed += 1
+
+    # Closes the transport once its buffer has been sent, or aborts it if
+    # the peer does not read it within LINGER_TIMEOUT.
+    def closeConnection(self, sock):
+        self.removeConnectedSockets(sock)
+        sock.close()
+        if sock.getOutboundSize():
+            self.callLater(LINGER_TIMEOUT, sock.abort)
+
+    def dropConnection(self, sock):
+        self.removeOnlineUser(self.getUserFromSock(sock))
+        self.removeConnectedSockets(sock)
+        sock.abort()
+
+    # Queues data on the protocol. Everything queued during one event loop
+    # iteration is written with one call per protocol.
+    def queueData(self, data, sock):
+        if sock not in self.connectedSockets or not sock.write(data):
+            return
+        if not self.pendingWrites:
+            asyncio.get_running_loop().call_soon(self.flushPending)
+        self.pendingWrites[sock] = None
+
+    def flushPending(self):
+        pending, self.pendingWrites = self.pendingWrites, {}
+        for sock in pending:
+            sock.flush()
+
+    # The event loop keeps the timers. The clock is updated before func
+    # runs, as before the other callbacks of the engine.
+    def callLater(self, delay, func, *args):
+        def call():
+            self.clock.tick()
+            func(*args)
+
+        return asyncio.get_running_loop().call_later(delay, call)
+
+    # Runs func in the default executor of the event loop and calls callback
+    # as Server.runTask does.
+    def runTask(self, func, callback):
+        def done(future):
+            error = future.exception()
+            if error is None:
+                callback(future.result(), None)
+            else:
+                traceback.print_exception(error)
+                callback(None, error)
+
+        loop = asyncio.get_running_loop()
+        loop.run_in_executor(None, func).add_done_callback(done)
+
+
+async def run(server, metricsPort=None, sslContext=None):
+    loop = asyncio.get_running_loop()
+    listener = await loop.create_server(lambda: ChatProtocol(server),
+                                        sock=server.getServerSocket(),
+                                        ssl=sslContext)
+    if metricsPort is not None:
+        await serveMetricsAsync(server, metricsPort)
+    if hasattr(signal, 'SIGHUP'):
+        loop.add_signal_handler(signal.SIGHUP, server.reloadBans)
+    async with listener:
+        await listener.serve_forever()
+
+
+def serve(port, cert, key, backend='default', useUvloop=False,
+          metricsPort=None, tls=False, **options):
+    """
+    Chat server entry point for the asyncio engine.
+    port: The port to listen on.
+    cert: The server public certificate.
+    key: The server private key.
+    backend: The I/O backend of the event loop, one of the keys of BACKENDS.
+    useUvloop: Runs on uvloop instead of the asyncio event loop. backend is
+               ignored in that case.
+    metricsPort: Local port to serve Prometheus metrics on, None to turn
+                 metrics off.
+    tls: Serves clients over TLS with the certificate and key. asyncio does
+         the handshakes.
+    options: Keyword arguments for Server, e.g. the outbound buffer limits.
+    """
+    sslContext = serverContext(cert, key) if tls else None
+    server = AsyncServer(port, 20, metrics=metricsPort is not None,
+                         **options)
+    if useUvloop:
+        import uvloop
+        loop = uvloop.new_event_loop()
+    else:
+        loop = asyncio.SelectorEventLoop(BACKENDS[backend]())
+    # Writes the rest of the message log and the capture when the server is
+    # stopped.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        loop.run_until_complete(run(server, metricsPort, sslContext))
+    finally:
+        loop.close()
+        server.close()
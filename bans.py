@@ -0,0 +1,157 @@
+import ipaddress
+import json
+import os
+import socket as s
+import time
+
+# Number of checked addresses whose outcome is remembered. A flood of
+# connections from a few addresses is checked with one dict lookup each.
+CACHE_SIZE = 1 << 16
+
+# Stands in for an address that is not in the cache.
+_MISSING = object()
+
+# Shortest prefix length of a range clients may ban, by address size. A
+# wider range, up to 0.0.0.0/0, would lock out everyone.
+MIN_PREFIX = {32: 8, 128: 32}
+
+
+# Returns True if the CIDR range is wider than MIN_PREFIX allows. Raises
+# ValueError if network is not an address or range.
+def isTooWide(network):
+    net = ipaddress.ip_network(network, strict=False)
+    return net.prefixlen < MIN_PREFIX[net.max_prefixlen]
+
+
+class BanList:
+    """
+    The banned IP addresses and CIDR ranges, IPv4 and IPv6, optionally with
+    an expiry time. Single addresses are kept in a dict by address. Ranges
+    are kept in a dict per prefix length by network number, so finding the
+    longest matching range costs one lookup per prefix length in use. Bans
+    are saved to path as JSON when given.
+    """
+
+    # Constructor. Loads the bans saved at path if it exists.
+    def __init__(self, path=None):
+        self.path = path
+        self.clear()
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    # Removes every ban, without saving.
+    def clear(self):
+        # Bans as address or network -> (network, expiry time or None).
+        self.exact = {}
+        self.networks = {32: {}, 128: {}}
+        # The prefix lengths of the ranges by address size, longest first.
+        self.prefixes = {32: [], 128: []}
+        self.cache = {}
+
+    # Returns True if the address is banned and the ban did not expire.
+    def isBanned(self, address):
+        ban = self.cache.get(address, _MISSING)
+        if ban is _MISSING:
+            ban = self.lookup(address)
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            self.cache[address] = ban
+        if ban is None:
+            return False
+        if ban[1] is not None and ban[1] <= time.time():
+            # Looks again, a shorter range may still match.
+            self.remove(ban[0])
+            return self.isBanned(address)
+        return True
+
+    # Returns the longest matching ban of the address or None.
+    def lookup(self, address):
+        ban = self.exact.get(address)
+        if ban is not None or not (self.prefixes[32] or self.prefixes[128]):
+            return ban
+        try:
+            packed = s.inet_pton(s.AF_INET, address)
+        except OSError:
+            try:
+                packed = s.inet_pton(s.AF_INET6, address)
+            except OSError:
+                return None
+        value = int.from_bytes(packed, 'big')
+        bits = len(packed) * 8
+        networks = self.networks[bits]
+        for length in self.prefixes[bits]:
+            ban = networks[length].get(value >> (bits - length))
+            if ban is not None:
+                return ban
+        return None
+
+    # Bans an address or CIDR range until the expiry time, forever if it is
+    # None. Returns the normalised network. Raises ValueError if network is
+    # not an address or range.
+    def add(self, network, expires=None):
+        net = ipaddress.ip_network(network, strict=False)
+        bits = net.max_prefixlen
+        if net.prefixlen == bits:
+            key = str(net.network_address)
+            self.exact[key] = (key, expires)
+        else:
+            key = str(net)
+            byNumber = self.networks[bits].setdefault(net.prefixlen, {})
+            byNumber[int(net.network_address) >> (bits - net.prefixlen)] = \
+                (key, expires)
+            self.prefixes[bits] = sorted(self.networks[bits], reverse=True)
+        self.cache.clear()
+        return key
+
+    # Lifts the ban of an address or CIDR range. Returns False if it was not
+    # banned. Raises ValueError if network is not an address or range.
+    def remove(self, network):
+        net = ipaddress.ip_network(network, strict=False)
+        bits = net.max_prefixlen
+        if net.prefixlen == bits:
+            removed = self.exact.pop(str(net.network_address), None)
+        else:
+            byNumber = self.networks[bits].get(net.prefixlen, {})
+            removed = byNumber.pop(
+                int(net.network_address) >> (bits - net.prefixlen), None)
+            if not byNumber:
+                self.networks[bits].pop(net.prefixlen, None)
+                self.prefixes[bits] = sorted(self.networks[bits],
+                                             reverse=True)
+        self.cache.clear()
+        return removed is not None
+
+    # Returns the bans as a list of (network, expiry time or None).
+    def entries(self):
+        bans = list(self.exact.values())
+        for networks in self.networks.values():
+            for byNumber in networks.values():
+                bans.extend(byNumber.values())
+        return bans
+
+    # Writes the bans that did not expire to path. The file is replaced in
+    # one step, so a reader never sees half of it.
+    def save(self):
+        if self.path is None:
+            return
+        now = time.time()
+        bans = [{'network': network, 'expires': expires}
+                for network, expires in self.entries()
+                if expires is None or expires > now]
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, 'w') as f:
+            json.dump({'bans': bans}, f, indent=1)
+        os.replace(temporary, self.path)
+
+    # Replaces the bans by the ones saved at path. The new bans are built
+    # aside and swapped in at once, so this can run from a signal handler.
+    def load(self):
+        with open(self.path) as f:
+            bans = json.load(f)['bans']
+        loaded = BanList()
+        now = time.time()
+        for ban in bans:
+            if ban['expires'] is None or ban['expires'] > now:
+                loaded.add(ban['network'], ban['expires'])
+        self.exact, self.networks, self.prefixes, self.cache = \
+            loaded.exact, loaded.networks, loaded.prefixes, {}
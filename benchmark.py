@@ -0,0 +1,1400 @@
+import heapq
+import itertools
+import json
+import os
+import random
+import selectors
+import shutil
+import socket as s
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import loadgen
+import msglog
+import shard
+from bans import BanList
+from chatserver import BACKENDS, Message, Server
+from connection import Connection
+from protocol import NOTICE, Event
+from registry import UserRegistry
+from timers import TimerWheel
+from tls import clientContext
+
+
+# Raises the open file limit as far as the hard limit allows.
+def raiseFileLimit():
+    try:
+        import resource
+    except ImportError:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        except (ValueError, OSError):
+            return soft
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+# Returns a readable file object that stays idle. An eventfd costs one
+# descriptor, a socket pair two.
+def idleEndpoint():
+    if hasattr(os, 'eventfd'):
+        fd = os.eventfd(0, os.EFD_NONBLOCK)
+        return os.fdopen(fd, 'rb', buffering=0), None
+    a, b = s.socketpair()
+    return a, b
+
+
+def benchConnections(counts, backends, wakeups):
+    """
+    Measures the cost of one selector wakeup while a growing number of idle
+    clients is registered. A single active socket pair is written to and
+    drained on every iteration.
+    counts: The numbers of idle clients to measure.
+    backends: The names of the I/O backends to measure.
+    wakeups: The number of wakeups to time per measurement.
+    """
+    limit = raiseFileLimit()
+    results = []
+    for backend in backends:
+        for count in counts:
+            if limit is not None and count + 64 > limit:
+                print(f"{backend:>8} {count:>7} idle: skipped, open file "
+                      f"limit is {limit}")
+                continue
+            selector = BACKENDS[backend]()
+            idle = []
+            try:
+                for _ in range(count):
+                    endpoint = idleEndpoint()
+                    idle.append(endpoint)
+                    selector.register(endpoint[0], selectors.EVENT_READ)
+            except (OSError, ValueError) as e:
+                print(f"{backend:>8} {count:>7} idle: skipped, {e}")
+                for a, b in idle:
+                    a.close()
+                    if b is not None:
+                        b.close()
+                selector.close()
+                continue
+
+            reader, writer = s.socketpair()
+            reader.setblocking(0)
+            selector.register(reader, selectors.EVENT_READ)
+            start = time.perf_counter()
+            try:
+                for _ in range(wakeups):
+                    writer.send(b'x')
+                    for key, mask in selector.select():
+                        key.fileobj.recv(16)
+            except ValueError as e:
+                # select() cannot watch descriptors above FD_SETSIZE.
+                print(f"{backend:>8} {count:>7} idle: failed, {e}")
+            else:
+                elapsed = time.perf_counter() - start
+                perWakeup = elapsed / wakeups * 1e6
+                print(f"{backend:>8} {count:>7} idle: {perWakeup:8.2f} "
+                      "us/wakeup")
+                results.append((backend, count, perWakeup))
+
+            selector.close()
+            reader.close()
+            writer.close()
+            for a, b in idle:
+                a.close()
+                if b is not None:
+                    b.close()
+    return results
+
+
+class NullSocket:
+    """
+    Stand-in for a client socket with an infinitely fast reader. Counts the
+    syscalls that would have been made.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.sent = 0
+
+    def send(self, data):
+        self.calls += 1
+        self.sent += len(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        sent = sum(map(len, buffers))
+        self.sent += sent
+        return sent
+
+
+# Returns a server on an ephemeral port with the given number of connections
+# to null sockets.
+def nullServer(recipients):
+    server = Server(0, 20)
+    for _ in range(recipients):
+        sock = NullSocket()
+        conn = Connection(sock)
+        conn.events = selectors.EVENT_READ
+        server.getConnectedSockets()[sock] = conn
+    return server
+
+
+# The broadcast path before encode-once fan-out: every recipient gets its own
+# encoded copy, which is written right away with its own send call.
+def legacyBroadcast(server, message, flush=True):
+    for conn in list(server.getConnectedSockets().values()):
+        conn.queue(message.encode())
+        if flush:
+            server.writeConnection(conn)
+
+
+# The current broadcast path.
+def sharedBroadcast(server, message, flush=True):
+    server.sendMessageAll(Event(NOTICE, message[:-1]))
+
+
+def benchBroadcast(recipientCounts, rounds, batch):
+    """
+    Measures broadcasts per second, bytes allocated per broadcast and send
+    syscalls per broadcast of the legacy and the shared broadcast path.
+    recipientCounts: The numbers of recipients to measure.
+    rounds: The number of loop iterations to time.
+    batch: The number of broadcasts per loop iteration.
+    """
+    message = "[12:00:00] Jochem-1: " + "x" * 80 + "\n"
+    results = []
+    for recipients in recipientCounts:
+        for name, broadcast in (('legacy', legacyBroadcast),
+                                ('shared', sharedBroadcast)):
+            server = nullServer(recipients)
+            socks = list(server.getConnectedSockets())
+
+            start = time.perf_counter()
+            for _ in range(rounds):
+                for _ in range(batch):
+                    broadcast(server, message)
+                server.flushPending()
+            elapsed = time.perf_counter() - start
+            calls = sum(sock.calls for sock in socks)
+
+            # Measures the memory held by the queued broadcasts of one
+            # iteration, as if every recipient was a slow reader.
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            for _ in range(batch):
+                broadcast(server, message, flush=False)
+            allocated = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+            server.flushPending()
+
+            broadcasts = rounds * batch
+            perSecond = broadcasts / elapsed
+            print(f"{name:>6} {recipients:>6} recipients: "
+                  f"{perSecond:10.1f} broadcasts/s "
+                  f"{allocated / batch:10.0f} bytes/broadcast "
+                  f"{calls / broadcasts:8.1f} sends/broadcast")
+            results.append((name, recipients, perSecond, allocated / batch))
+            server.getServerSocket().close()
+    return results
+
+
+def benchRooms(users, roomSizes, messages):
+    """
+    Measures the fan-out cost of room messages with the users spread over
+    rooms of different sizes. One room of every user is what every message
+    cost before rooms.
+    users: The number of online users.
+    roomSizes: The numbers of members per room to measure.
+    messages: The number of messages to time, said by users in turn.
+    """
+    results = []
+    for size in roomSizes:
+        server = nullServer(users)
+        socks = list(server.getConnectedSockets())
+        for i, sock in enumerate(socks):
+            user = server.addOnlineUser(sock, '127.0.0.1', f"Jochem-{i + 1}")
+            server.addToRoom(user, f"#room-{i // size}")
+
+        start = time.perf_counter()
+        for i in range(messages):
+            message = Message("hello room", f"Jochem-{i % users + 1}",
+                              server.commands)
+            server.handleSay(message, socks[i % users])
+            server.flushPending()
+        elapsed = time.perf_counter() - start
+        deliveries = sum(sock.calls for sock in socks)
+
+        rooms = len(server.getOnlineUsers().rooms)
+        print(f"{rooms:>6} rooms of {size:>6}: "
+              f"{messages / elapsed:10.1f} messages/s "
+              f"{deliveries / messages:8.1f} sends/message")
+        results.append((size, messages / elapsed, deliveries / messages))
+        server.getServerSocket().close()
+    return results
+
+
+def benchProtocol(recipients, messages):
+    """
+    Measures the bytes sent and the server time per room message for clients
+    of the text protocol, the binary protocol and the compressed binary
+    protocol.
+    recipients: The number of users in the room.
+    messages: The number of messages to time, said by users in turn.
+    """
+    words = ("hello", "anyone", "seen", "the", "build", "logs", "today", "it",
+             "failed", "again", "on", "the", "shard", "tests", "lol", "ok")
+    texts = [" ".join(words[(i * 7 + j) % len(words)]
+                      for j in range(4 + i % 9)) for i in range(64)]
+    results = []
+    for label, binary, compressed in (('text', False, False),
+                                      ('binary', True, False),
+                                      ('zlib', True, True)):
+        server = nullServer(recipients)
+        socks = list(server.getConnectedSockets())
+        for i, sock in enumerate(socks):
+            user = server.addOnlineUser(sock, '127.0.0.1', f"Jochem-{i + 1}")
+            server.addToRoom(user, '#lobby')
+            if binary:
+                server.switchProtocol(server.getConnection(sock), compressed)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            message = Message(texts[i % len(texts)],
+                              f"Jochem-{i % recipients + 1}", server.commands)
+            server.handleSay(message, socks[i % recipients])
+            server.flushPending()
+        elapsed = time.perf_counter() - start
+        deliveries = messages * recipients
+        sent = sum(sock.sent for sock in socks)
+
+        print(f"{label:>6}: {sent / deliveries:8.1f} bytes/delivery "
+              f"{elapsed / deliveries * 1e6:8.2f} us/delivery")
+        results.append((label, sent / deliveries, elapsed / deliveries))
+        server.getServerSocket().close()
+    return results
+
+
+class HeapTimers:
+    """
+    The timers of the server before the timer wheel: a heap of (deadline,
+    id, timer) like the throttled connections were kept in. A cancelled
+    timer stays in the heap until it comes up.
+    """
+
+    # Constructor.
+    def __init__(self, clock):
+        self.clock = clock
+        self.heap = []
+        self.ids = itertools.count()
+
+    def schedule(self, delay, callback, *args):
+        timer = [callback, args]
+        heapq.heappush(self.heap, (self.clock() + delay, next(self.ids),
+                                   timer))
+        return timer
+
+    def cancel(self, timer):
+        timer[0] = None
+
+    def timeout(self):
+        while self.heap and self.heap[0][2][0] is None:
+            heapq.heappop(self.heap)
+        if not self.heap:
+            return None
+        return max(0, self.heap[0][0] - self.clock())
+
+    def advance(self):
+        now = self.clock()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, (callback, args) = heapq.heappop(self.heap)
+            if callback is not None:
+                callback(*args)
+
+
+def benchTimers(counts, resets):
+    """
+    Measures scheduling, cancelling and firing of per-connection deadlines
+    with the timer wheel and with a heap. Every connection gets an idle
+    timeout between 1 and 300 seconds, resets pushes the deadlines of
+    random connections back by up to a minute as if they sent a message,
+    and the clock then runs through all deadlines with a wakeup every 10 ms
+    of simulated time. The heap cancels and reschedules a moved deadline,
+    the wheel resets it.
+    counts: The numbers of connections to measure.
+    resets: The number of deadlines moved per measurement.
+    """
+    results = []
+    for count in counts:
+        rnd = random.Random(count)
+        delays = [rnd.uniform(1, 300) for _ in range(count)]
+        deadlines = list(delays)
+        moves = []
+        for _ in range(resets):
+            index = rnd.randrange(count)
+            deadlines[index] += rnd.uniform(0.01, 60)
+            moves.append((index, deadlines[index]))
+        for name in ('heap', 'wheel'):
+            now = [0.0]
+            timers = HeapTimers(lambda: now[0]) if name == 'heap' else \
+                TimerWheel(0.01, lambda: now[0])
+            fired = [0]
+
+            def expire():
+                fired[0] += 1
+
+            start = time.perf_counter()
+            handles = [timers.schedule(delay, expire) for delay in delays]
+            scheduleTime = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if name == 'heap':
+                for index, delay in moves:
+                    timers.cancel(handles[index])
+                    handles[index] = timers.schedule(delay, expire)
+            else:
+                for index, delay in moves:
+                    timers.reset(handles[index], delay)
+            resetTime = time.perf_counter() - start
+
+            start = time.perf_counter()
+            wakeups = 0
+            while fired[0] < count:
+                timeout = timers.timeout()
+                now[0] += max(timeout, 0.01)
+                timers.advance()
+                wakeups += 1
+            fireTime = time.perf_counter() - start
+
+            print(f"{count:>7} {name:>5}: "
+                  f"{scheduleTime / count * 1e6:6.2f} us/schedule "
+                  f"{resetTime / resets * 1e6:6.2f} us/reset "
+                  f"{fireTime / count * 1e6:6.2f} us/expiry "
+                  f"{wakeups:7} wakeups")
+            results.append((count, name, scheduleTime / count,
+                            resetTime / resets, fireTime / count))
+    return results
+
+
+def benchLog(messages, queries, fsync, directory=None):
+    """
+    Measures the append throughput of the message log and the latency of
+    searching it.
+    messages: The number of messages to append.
+    queries: The number of searches to time per kind of search.
+    fsync: When the log is forced to disk, one of msglog.FSYNC.
+    directory: Directory to write the log to, a temporary one by default.
+    """
+    temporary = directory is None
+    if temporary:
+        directory = tempfile.mkdtemp(prefix='chatlog-')
+    rooms = [f"#room-{i}" for i in range(50)]
+    try:
+        log = msglog.MessageLog(directory, fsync=fsync)
+        start = time.perf_counter()
+        for i in range(messages):
+            log.append('say', f"Jochem-{i % 1000}", rooms[i % 50],
+                       f"message number {i} about nothing in particular")
+        queued = time.perf_counter() - start
+        log.close()
+        elapsed = time.perf_counter() - start
+        size = sum(os.path.getsize(os.path.join(directory, name))
+                   for name in os.listdir(directory))
+        print(f"append: {messages / elapsed:10.0f} messages/s "
+              f"({queued / messages * 1e6:.2f} us/message on the event loop)"
+              f" {size / 2 ** 20:8.1f} MiB on disk")
+
+        results = {'append_per_s': messages / elapsed}
+        searches = (('nick', lambda q: f"Jochem-{q * 37 % 1000}", False),
+                    ('sender', lambda q: f"Jochem-{q * 37 % 1000}", True),
+                    ('gone', lambda q: f"Jochem-{1000 + q}", True),
+                    ('recent', lambda q: f"number {messages - 1 - q}", False),
+                    ('oldest', lambda q: f"number {q} about", False),
+                    ('missing', lambda q: f"nothing-{q}", False))
+        for name, term, bySender in searches:
+            latencies = []
+            for q in range(queries):
+                start = time.perf_counter()
+                msglog.search(directory, term(q), rooms, 'Jochem-0',
+                              bySender=bySender)
+                latencies.append((time.perf_counter() - start) * 1e3)
+            latencies.sort()
+            print(f"search {name:>7}: p50 {percentile(latencies, 50):9.2f} "
+                  f"ms p99 {percentile(latencies, 99):9.2f} ms")
+            results[name] = (percentile(latencies, 50),
+                             percentile(latencies, 99))
+        return results
+    finally:
+        if temporary:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+def benchBans(banCounts, checks):
+    """
+    Measures the cost of checking an accepted connection against the bans
+    with the legacy list of banned IPs and with the ban list, during a flood
+    of connections from a banned range.
+    banCounts: The numbers of banned addresses, a tenth of them as ranges.
+    checks: The number of connections to check per measurement.
+    """
+    results = []
+    for bans in banCounts:
+        legacy = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}"
+                  for i in range(bans)]
+        banList = BanList()
+        for ip in legacy[bans // 10:]:
+            banList.add(ip)
+        for i in range(bans // 10):
+            banList.add(f"172.{16 + i % 16}.{i >> 4 & 255}.0/24")
+        # The flood comes from the last banned address or, for the ban
+        # list, from addresses all over a banned range.
+        flood = [f"172.16.0.{i & 255}" for i in range(checks)]
+        start = time.perf_counter()
+        for i in range(checks):
+            legacy[-1] in legacy
+        legacyTime = (time.perf_counter() - start) / checks * 1e6
+        start = time.perf_counter()
+        for address in flood:
+            banList.isBanned(address)
+        banTime = (time.perf_counter() - start) / checks * 1e6
+        banList.cache.clear()
+        start = time.perf_counter()
+        for i in range(checks):
+            banList.lookup(flood[i])
+        uncached = (time.perf_counter() - start) / checks * 1e6
+        print(f"{bans:>7} bans: legacy {legacyTime:9.3f} us/check "
+              f"ban list {banTime:7.3f} us/check "
+              f"({uncached:.3f} us uncached)")
+        results.append((bans, legacyTime, banTime, uncached))
+    return results
+
+
+# The user lookups before the registry: a list of dicts scanned with filter.
+class LegacyUsers:
+
+    def __init__(self):
+        self.onlineUsers = []
+
+    def add(self, socket, address, nickname):
+        self.onlineUsers.append({'socket': socket, 'address': address,
+                                 'nickname': nickname})
+
+    def getBySocket(self, socket):
+        try:
+            return list(filter(lambda user: user['socket'] == socket,
+                        self.onlineUsers))[0]
+        except Exception:
+            return None
+
+    def getByNick(self, nickname):
+        try:
+            return list(filter(lambda user: user['nickname'] == nickname,
+                        self.onlineUsers))[0]
+        except Exception:
+            return None
+
+
+def benchLookups(userCounts, messages):
+    """
+    Measures the user lookups done for one incoming whisper, one by socket
+    and one by nickname, for a growing number of online users.
+    userCounts: The numbers of online users to measure.
+    messages: The number of messages to time.
+    """
+    import random
+    results = []
+    for users in userCounts:
+        for name, registry in (('legacy', LegacyUsers()),
+                               ('registry', UserRegistry())):
+            socks = [object() for _ in range(users)]
+            for i, sock in enumerate(socks):
+                registry.add(sock, f"10.0.{i >> 8 & 255}.{i & 255}",
+                             f"Jochem-{i + 1}")
+            rng = random.Random(users)
+            picks = [(socks[rng.randrange(users)],
+                      f"Jochem-{rng.randrange(users) + 1}")
+                     for _ in range(messages)]
+            start = time.perf_counter()
+            for sock, nick in picks:
+                registry.getBySocket(sock)
+                registry.getByNick(nick)
+            perMessage = (time.perf_counter() - start) / messages * 1e6
+            print(f"{name:>8} {users:>7} users: {perMessage:10.3f} "
+                  "us/message")
+            results.append((name, users, perMessage))
+    return results
+
+
+# Returns a free TCP port on localhost.
+def freePort():
+    with s.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# Starts chatserver.py with the given arguments and waits until it accepts
+# connections.
+def startServer(port, *args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.Popen([sys.executable,
+                             os.path.join(here, 'chatserver.py'),
+                             '--port', str(port), *args])
+    for _ in range(100):
+        try:
+            s.create_connection(('127.0.0.1', port)).close()
+            return proc
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+# Returns the given percentile of a sorted list.
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def runChatLoad(port, clients, messages, sslContext=None):
+    """
+    Connects clients to the server on port and lets every client /say
+    messages, one at a time. A client sends its next message once its
+    previous broadcast came back. Returns the broadcasts delivered per second
+    and the latency percentiles in milliseconds. With sslContext the clients
+    connect over TLS.
+    """
+    selector = selectors.DefaultSelector()
+    socks = []
+    for i in range(clients):
+        sock = s.create_connection(('127.0.0.1', port))
+        sock.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+        if sslContext is not None:
+            sock = sslContext.wrap_socket(sock, server_hostname='127.0.0.1')
+        sock.setblocking(0)
+        selector.register(sock, selectors.EVENT_READ, i)
+        socks.append(sock)
+
+    sent = [0] * clients
+    buffers = [b''] * clients
+    latencies = []
+    delivered = 0
+    done = 0
+
+    def send(i):
+        sent[i] += 1
+        line = f"/say bench {i} {time.perf_counter_ns()}\n"
+        socks[i].sendall(line.encode())
+
+    start = time.perf_counter()
+    for i in range(clients):
+        send(i)
+    while done < clients:
+        for key, mask in selector.select(5):
+            i = key.data
+            try:
+                data = key.fileobj.recv(1 << 16)
+            except ssl.SSLWantReadError:
+                continue
+            if not data:
+                raise RuntimeError("server closed a benchmark client")
+            lines = (buffers[i] + data).split(b'\n')
+            buffers[i] = lines.pop()
+            for line in lines:
+                fields = line.split(b' bench ', 1)
+                if len(fields) != 2:
+                    continue
+                delivered += 1
+                sender, stamp = fields[1].split()
+                if int(sender) != i:
+                    continue
+                latencies.append((time.perf_counter_ns() - int(stamp)) / 1e6)
+                if sent[i] < messages:
+                    send(i)
+                else:
+                    done += 1
+    elapsed = time.perf_counter() - start
+
+    for sock in socks:
+        selector.unregister(sock)
+        sock.close()
+    selector.close()
+    latencies.sort()
+    return {'delivered_per_s': delivered / elapsed,
+            'p50_ms': percentile(latencies, 50),
+            'p99_ms': percentile(latencies, 99)}
+
+
+def benchEngines(engines, clients, messages):
+    """
+    Compares the throughput and latency of the server engines under the same
+    chat load.
+    engines: The names of the engines to compare.
+    clients: The number of clients that chat at the same time.
+    messages: The number of messages every client sends.
+    """
+    results = []
+    for engine in engines:
+        result = benchServer(engine, clients, messages, '--engine', engine)
+        results.append((engine, result))
+    return results
+
+
+def benchShards(workerCounts, clients, messages):
+    """
+    Measures how the throughput of the server grows with the number of
+    worker processes.
+    workerCounts: The numbers of workers to measure.
+    clients: The number of clients that chat at the same time.
+    messages: The number of messages every client sends.
+    """
+    results = []
+    for workers in workerCounts:
+        result = benchServer(f"{workers} workers", clients, messages,
+                             '--workers', str(workers))
+        results.append((workers, result))
+    return results
+
+
+# Runs the chat load against a server started with the given arguments and
+# prints the result.
+def benchServer(label, clients, messages, *args):
+    port = freePort()
+    proc = startServer(port, *args)
+    try:
+        # Gives every worker time to start listening.
+        time.sleep(1)
+        result = runChatLoad(port, clients, messages)
+    finally:
+        proc.terminate()
+        proc.wait()
+    print(f"{label:>10}: {result['delivered_per_s']:10.0f} messages/s "
+          f"p50 {result['p50_ms']:7.2f} ms p99 {result['p99_ms']:7.2f} ms")
+    return result
+
+
+# Writes a self-signed certificate for 127.0.0.1 and its key to the
+# directory with the openssl command. Returns their paths.
+def selfSignedCert(directory):
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt',
+                    'ec_paramgen_curve:prime256v1', '-nodes', '-days', '1',
+                    '-subj', '/CN=127.0.0.1', '-addext',
+                    'subjectAltName=IP:127.0.0.1', '-keyout', key,
+                    '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+
+# Connects count times, one connection after the other, and waits for the
+# welcome of every connection. With sslContext the connections use TLS and
+# with resume every connection resumes the session of the first one.
+# Returns the connections per second.
+def connectRate(port, sslContext, count, resume=False):
+    session = None
+    start = time.perf_counter()
+    for _ in range(count):
+        sock = s.create_connection(('127.0.0.1', port))
+        if sslContext is not None:
+            sock = sslContext.wrap_socket(sock, server_hostname='127.0.0.1',
+                                          session=session)
+        with sock:
+            sock.recv(4096)
+            if resume:
+                session = sock.session
+    return count / (time.perf_counter() - start)
+
+
+def benchTLS(engines, handshakes, clients, messages, cert=None, key=None):
+    """
+    Measures the rate of full and resumed TLS handshakes and compares the
+    chat throughput and latency over TLS with plaintext, per engine.
+    engines: The names of the engines to measure.
+    handshakes: The number of connections per handshake measurement.
+    clients: The number of clients that chat at the same time.
+    messages: The number of messages every client sends.
+    cert, key: The certificate and key of the server, a self-signed pair is
+               made with openssl if they are not given.
+    """
+    directory = tempfile.mkdtemp(prefix='chatbench-')
+    try:
+        if cert is None:
+            cert, key = selfSignedCert(directory)
+        sslContext = clientContext(cert)
+        results = []
+        for engine in engines:
+            result = {}
+            for label, args, context in (
+                    ('plaintext', (), None),
+                    ('tls', ('--tls', '--cert', cert, '--key', key),
+                     sslContext)):
+                port = freePort()
+                proc = startServer(port, '--engine', engine, *args)
+                try:
+                    if context is None:
+                        result['connect'] = connectRate(port, None,
+                                                        handshakes)
+                    else:
+                        result['full'] = connectRate(port, context,
+                                                     handshakes)
+                        result['resumed'] = connectRate(port, context,
+                                                        handshakes, True)
+                    result[label] = runChatLoad(port, clients, messages,
+                                                context)
+                finally:
+                    proc.terminate()
+                    proc.wait()
+                load = result[label]
+                print(f"{engine:>8} {label:>9}: "
+                      f"{load['delivered_per_s']:10.0f} messages/s "
+                      f"p50 {load['p50_ms']:7.2f} ms "
+                      f"p99 {load['p99_ms']:7.2f} ms")
+            overhead = 1 - result['tls']['delivered_per_s'] / \
+                result['plaintext']['delivered_per_s']
+            print(f"{engine:>8}  connects: {result['connect']:8.0f}/s "
+                  f"plaintext {result['full']:8.0f}/s full handshake "
+                  f"{result['resumed']:8.0f}/s resumed, TLS costs "
+                  f"{overhead:.0%} of the throughput")
+            results.append((engine, result))
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class Flooder:
+    """
+    A misbehaving client that sends /say messages as fast as the server
+    takes them. Everything it receives is discarded.
+    """
+
+    # Constructor. Connects and starts flooding.
+    def __init__(self, port):
+        self.sock = s.create_connection(('127.0.0.1', port))
+        self.stopped = False
+        self.threads = [threading.Thread(target=self.send, daemon=True),
+                        threading.Thread(target=self.discard, daemon=True)]
+        for thread in self.threads:
+            thread.start()
+
+    def send(self):
+        chunk = b"/say flood flood flood flood flood\n" * 1000
+        try:
+            while not self.stopped:
+                self.sock.sendall(chunk)
+        except OSError:
+            pass
+
+    def discard(self):
+        try:
+            while not self.stopped and self.sock.recv(1 << 16):
+                pass
+        except OSError:
+            pass
+
+    def stop(self):
+        self.stopped = True
+        self.sock.close()
+        for thread in self.threads:
+            thread.join()
+
+
+def benchFlood(clients, messages, limit):
+    """
+    Measures the throughput and latency of well-behaved clients while one
+    client floods the server, without and with a message rate limit.
+    clients: The number of well-behaved clients.
+    messages: The number of messages every well-behaved client sends.
+    limit: The message limit as RATE or RATE:BURST.
+    """
+    results = []
+    for label, args in (('unlimited', ()),
+                        ('limited', ('--message-limit', limit))):
+        port = freePort()
+        proc = startServer(port, *args)
+        flooder = None
+        try:
+            flooder = Flooder(port)
+            time.sleep(0.5)
+            result = runChatLoad(port, clients, messages)
+        finally:
+            if flooder is not None:
+                flooder.stop()
+            proc.terminate()
+            proc.wait()
+        print(f"{label:>10}: {result['delivered_per_s']:10.0f} messages/s "
+              f"p50 {result['p50_ms']:7.2f} ms p99 {result['p99_ms']:7.2f} ms")
+        results.append((label, result))
+    return results
+
+
+def benchLoad(engines, clients, rate, duration, mix, churn, path=None):
+    """
+    Runs the load generator against a server per engine and reports the
+    delivery latency of every command.
+    engines: The names of the engines to measure.
+    clients: The number of simulated clients.
+    rate: The messages per second sent over all clients.
+    duration: The seconds to generate load.
+    mix: The share of every command, see loadgen.parseMix.
+    churn: The clients that reconnect per second.
+    path: The file to write the results of every engine to as JSON.
+    """
+    raiseFileLimit()
+    results = {}
+    for engine in engines:
+        port = freePort()
+        proc = startServer(port, '--engine', engine)
+        try:
+            generator = loadgen.LoadGenerator('127.0.0.1', port, clients,
+                                              rate, duration, mix, churn)
+            result = generator.run()
+        finally:
+            proc.terminate()
+            proc.wait()
+        print(f"{engine}:")
+        loadgen.printResults(result)
+        results[engine] = result
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+def benchReload(clients, rate, duration, reloads):
+    """
+    Runs the load generator against a server started with --handoff and
+    replaces the server by a new process reloads times while it runs.
+    Reports the /say and /whisper messages that were never delivered, which
+    should be none, and the disconnects.
+    clients: The number of simulated clients.
+    rate: The messages per second sent over all clients.
+    duration: The seconds to generate load.
+    reloads: The number of reloads, spread over the duration.
+    """
+    raiseFileLimit()
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'handoff.sock')
+    port = freePort()
+    proc = startServer(port, '--handoff', path)
+    generator = loadgen.LoadGenerator('127.0.0.1', port, clients, rate,
+                                      duration, {'say': 80, 'whisper': 20}, 0)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(generator.run()))
+    thread.start()
+    takeovers = []
+    try:
+        while not all(client.ready for client in generator.clients):
+            time.sleep(0.05)
+        for _ in range(reloads):
+            time.sleep(duration / (reloads + 1))
+            start = time.perf_counter()
+            successor = subprocess.Popen([sys.executable,
+                                          os.path.join(here, 'chatserver.py'),
+                                          '--port', str(port),
+                                          '--handoff', path])
+            code = proc.wait(30)
+            takeovers.append(time.perf_counter() - start)
+            proc = successor
+            if code != 0:
+                raise RuntimeError(f"old server exited with {code}")
+        thread.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+        thread.join()
+        shutil.rmtree(directory)
+    result = results[0]
+    loadgen.printResults(result)
+    delivered = result['latency_ms']['say']['count'] + \
+        result['latency_ms']['whisper']['count']
+    lost = result['sent']['say'] + result['sent']['whisper'] - delivered - \
+        result['errors']
+    if takeovers:
+        print(f"{reloads} reloads, takeover p50 "
+              f"{percentile(sorted(takeovers), 50) * 1e3:.0f} ms, process "
+              f"start included")
+    print(f"{lost} messages lost, {result['disconnects']} disconnects")
+    return lost, result
+
+
+def benchCluster(bursts, messages):
+    """
+    Measures the cost per message of relaying room messages from one node of
+    a cluster over the hub to another, with and without batching. The hub
+    runs on a thread and the nodes are bus endpoints on the main thread,
+    connected by shard.LocalTransport.
+    bursts: The numbers of messages a node sends per loop iteration.
+    messages: The number of messages per measurement.
+    """
+    event = Event(NOTICE, 'x' * 80, stamp='12:00:00')
+    results = []
+    for batch in (False, True):
+        transport = shard.LocalTransport()
+        hub = shard.Hub(transport, batch=batch)
+        threading.Thread(target=hub.run, daemon=True).start()
+        selector = selectors.DefaultSelector()
+        received = [0]
+
+        def onMessage(endpoint, header, payload):
+            if header is not None and header['op'] == 'rooms':
+                received[0] += 1
+
+        nodes = []
+        for _ in range(2):
+            sock = transport.connect()
+            shard.joinBus(sock)
+            nodes.append(shard.BusEndpoint(sock, selector, onMessage, batch))
+        sender = nodes[0]
+        for burst in bursts:
+            received[0] = 0
+            sent = 0
+            start = time.perf_counter()
+            while sent < messages:
+                for _ in range(burst):
+                    header = {'op': 'rooms', 'rooms': ['#lobby'],
+                              'remember': True, 'stamp': event.stamp}
+                    sender.send(header, event.pack())
+                sender.flush()
+                sent += burst
+                # Waits for the burst, as a node's loop iteration would.
+                while received[0] < sent:
+                    for key, mask in selector.select(1):
+                        key.data(mask)
+            perMessage = (time.perf_counter() - start) / sent * 1e6
+            label = 'batched' if batch else 'unbatched'
+            print(f"{label:>9}, {burst:4} per iteration: {perMessage:7.2f} "
+                  f"us/message")
+            results.append((label, burst, perMessage))
+        selector.close()
+    return results
+
+
+# The /list handler before the nickname index, which renders every member
+# of the room for every /list.
+def legacyList(server, message, receiveSock):
+    room = server.currentRoom(receiveSock)
+    lines = []
+    for onlineU in server.onlineUsers.getRoom(room):
+        if not lines:
+            line = f"{onlineU.nickname} {onlineU.address}"
+        else:
+            line = f"\t   {onlineU.nickname} {onlineU.address}"
+        lines.append(line)
+    server.sendMessageOne(server.notice("\n".join(lines)), receiveSock)
+
+
+def benchList(roomSizes, lists):
+    """
+    Measures the time and bytes per /list in one large room for the legacy
+    handler, which lists the whole room, and for the paged handler, when its
+    pages are sent again and when a user joins between every two /lists.
+    roomSizes: The numbers of members of the room to measure.
+    lists: The number of /list commands to time.
+    """
+    results = []
+    for size in roomSizes:
+        server = nullServer(size)
+        socks = list(server.getConnectedSockets())
+        for i, sock in enumerate(socks):
+            user = server.addOnlineUser(sock, '127.0.0.1', f"Jochem-{i + 1}")
+            server.addToRoom(user, '#lobby')
+        server.clock.tick()
+        spammer = socks[0]
+        churner = server.getUserFromSock(socks[-1])
+
+        def legacy(message, sock):
+            legacyList(server, message, sock)
+
+        for name, handler, churn in (('legacy', legacy, False),
+                                     ('paged', server.handleList, False),
+                                     ('paged+join', server.handleList, True)):
+            sent = spammer.sent
+            start = time.perf_counter()
+            for i in range(lists):
+                if churn:
+                    server.removeFromRoom(churner, '#lobby')
+                    server.addToRoom(churner, '#lobby')
+                message = Message("/list", "Jochem-1", server.commands)
+                handler(message, spammer)
+                server.flushPending()
+            perList = (time.perf_counter() - start) / lists * 1e6
+            perReply = (spammer.sent - sent) / lists
+            print(f"{name:>10} {size:>6} users: {perList:10.1f} us/list "
+                  f"{perReply:10.0f} bytes/reply")
+            results.append((name, size, perList, perReply))
+        server.getServerSocket().close()
+    return results
+
+
+# The Message class before the command table, which splits the message once
+# per check and dispatches through an if/elif chain.
+class LegacyMessage:
+
+    def __init__(self, message, sender):
+        message = message.strip()
+        # If message starts with "/", assign the command, otherwise command is
+        # "/say".
+        self.correctMessage = self.__checkMessageCorrect(message)
+        if self.correctMessage is False:
+            return None
+
+        self.sender = sender
+
+        # Sets the used command.
+        if message.split(" ", 1)[0].startswith("/"):
+            self.command = message.split(" ", 1)[0]
+        else:
+            self.command = "/say"
+
+        if self.command == "/nick":
+            self.nick = message.split(" ")[1]
+            self.text = None
+        elif self.command == "/say":
+            self.nick = None
+            if message.startswith("/say"):
+                self.text = message.split(" ", 1)[1]
+            else:
+                self.text = message
+        elif self.command == "/whisper":
+            self.nick = message.split(" ", 2)[1]
+            self.text = message.split(" ", 2)[2]
+        elif self.command == "/list":
+            self.nick = None
+            self.text = None
+        elif self.command == "/help" or self.command == "/?":
+            self.nick = None
+            self.text = None
+        elif self.command == "/whois":
+            self.nick = message.split(" ")[1]
+            self.text = None
+        elif self.command == "/kick":
+            self.nick = message.split(" ")[1]
+            self.text = None
+        elif self.command == "/ipban":
+            self.nick = message.split(" ")[1]
+            self.text = None
+
+    # Returns False if command is invalid, True otherwise.
+    def __checkMessageCorrect(self, message):
+        if message.startswith("/nick"):
+            if len(message.split(" ", 2)) != 2:
+                return False
+        elif message.startswith("/say"):
+            if len(message.split(" ", 2)) < 2:
+                return False
+        elif message.startswith("/whisper"):
+            if len(message.split(" ", 2)) != 3:
+                return False
+        elif message.startswith("/list"):
+            if len(message.split(" ")) != 1:
+                return False
+        elif message.startswith("/help"):
+            if len(message.split(" ")) != 1:
+                return False
+        elif message.startswith("/?"):
+            if len(message.split(" ")) != 1:
+                return False
+        elif message.startswith("/whois"):
+            if len(message.split(" ", 2)) != 2:
+                return False
+        elif message.startswith("/kick"):
+            if len(message.split(" ", 2)) != 2:
+                return False
+        elif message.startswith("/ipban"):
+            if len(message.split(" ", 2)) != 2:
+                return False
+
+        return True
+
+    # Returns the correct message.
+    def getCorrectMessage(self):
+        return self.correctMessage
+
+    # Returns the message sender.
+    def getSender(self):
+        return self.sender
+
+    # Returns the command.
+    def getCommand(self):
+        return self.command
+
+    # Returns the nickname for e.g. kick commands.
+    def getNick(self):
+        return self.nick
+
+    # Returns the text in the command.
+    def getText(self):
+        return self.text
+
+
+# Dispatches a legacy message the way serve() did before the command table.
+def legacyDispatch(message, handlers):
+    if message.getCorrectMessage() is False:
+        return
+    command = message.getCommand()
+    if command == "/say":
+        handlers.handleSay(message)
+    elif command == "/nick":
+        handlers.handleNick(None, message.getNick())
+    elif command == "/whisper":
+        handlers.handleWhisper(message, None)
+    elif command == "/list":
+        handlers.handleList(message, None)
+    elif command == "/help" or command == "/?":
+        handlers.handleHelp(message, None)
+    elif command == "/whois":
+        handlers.handleWhoIs(message, None)
+    elif command == "/kick":
+        handlers.handleKick(message, None)
+    elif command == "/ipban":
+        handlers.handleIpBan(message, None)
+
+
+# Handlers that do nothing, to measure parsing and dispatch only.
+class NullHandlers:
+
+    def __getattr__(self, name):
+        return self.nothing
+
+    def nothing(self, *args):
+        pass
+
+
+def benchParse(messages):
+    """
+    Measures parsing and dispatching one message with the legacy Message
+    class and with the command table of the server.
+    messages: The number of messages to time.
+    """
+    mix = ["hello everyone, how is it going?", "/say good morning",
+           "/whisper Jochem-2 are you there?", "/nick Jochem-42", "/list",
+           "/whois Jochem-3", "/kick Jochem-4", "/?"]
+    frames = [mix[i % len(mix)] for i in range(messages)]
+    handlers = NullHandlers()
+    server = Server(0, 20)
+    commands = {command: (args, handlers.nothing)
+                for command, (args, handler) in server.commands.items()}
+    server.getServerSocket().close()
+
+    results = []
+    start = time.perf_counter()
+    for frame in frames:
+        legacyDispatch(LegacyMessage(frame, "Jochem-1"), handlers)
+    legacy = (time.perf_counter() - start) / messages * 1e6
+    start = time.perf_counter()
+    for frame in frames:
+        message = Message(frame, "Jochem-1", commands)
+        if message.getCorrectMessage():
+            handler = message.getHandler()
+            if handler is not None:
+                handler(message, None)
+    table = (time.perf_counter() - start) / messages * 1e6
+    for name, perMessage in (('legacy', legacy), ('table', table)):
+        print(f"{name:>6}: {perMessage:8.3f} us/message")
+        results.append((name, perMessage))
+    return results
+
+
+# Command line parser.
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser()
+    sub = p.add_subparsers(dest='bench', required=True)
+
+    c = sub.add_parser('connections',
+                       help='wakeup cost versus number of idle clients')
+    c.add_argument('--counts', help='idle client counts', type=int,
+                   nargs='+', default=[100, 1000, 5000, 10000, 20000])
+    c.add_argument('--backends', help='I/O backends to compare', nargs='+',
+                   default=['default'], choices=sorted(BACKENDS))
+    c.add_argument('--wakeups', help='wakeups per measurement', type=int,
+                   default=20000)
+
+    b = sub.add_parser('broadcast',
+                       help='cost of a broadcast versus number of recipients')
+    b.add_argument('--recipients', help='recipient counts', type=int,
+                   nargs='+', default=[1000, 10000])
+    b.add_argument('--rounds', help='loop iterations per measurement',
+                   type=int, default=50)
+    b.add_argument('--batch', help='broadcasts per loop iteration', type=int,
+                   default=4)
+
+    u = sub.add_parser('lookups',
+                       help='user lookup cost versus number of users')
+    u.add_argument('--users', help='online user counts', type=int,
+                   nargs='+', default=[100, 1000, 10000, 100000])
+    u.add_argument('--messages', help='messages per measurement', type=int,
+                   default=2000)
+
+    e = sub.add_parser('engines',
+                       help='throughput and latency of the server engines')
+    e.add_argument('--engines', help='engines to compare', nargs='+',
+                   default=['select', 'asyncio'],
+                   choices=('select', 'asyncio', 'uvloop'))
+    e.add_argument('--clients', help='clients chatting at the same time',
+                   type=int, default=50)
+    e.add_argument('--messages', help='messages per client', type=int,
+                   default=200)
+
+    w = sub.add_parser('shards',
+                       help='throughput versus number of worker processes')
+    w.add_argument('--workers', help='worker counts', type=int, nargs='+',
+                   default=[1, 2, 4])
+    w.add_argument('--clients', help='clients chatting at the same time',
+                   type=int, default=50)
+    w.add_argument('--messages', help='messages per client', type=int,
+                   default=200)
+
+    m = sub.add_parser('parse', help='cost of parsing and dispatching')
+    m.add_argument('--messages', help='messages to time', type=int,
+                   default=200000)
+
+    r = sub.add_parser('rooms',
+                       help='fan-out cost of small rooms versus one room')
+    r.add_argument('--users', help='online users', type=int, default=10000)
+    r.add_argument('--sizes', help='members per room', type=int, nargs='+',
+                   default=[10, 100, 1000, 10000])
+    r.add_argument('--messages', help='messages per measurement', type=int,
+                   default=500)
+
+    g = sub.add_parser('log', help='message log appends and searches')
+    g.add_argument('--messages', help='messages to append', type=int,
+                   default=10000000)
+    g.add_argument('--queries', help='searches per kind of search',
+                   type=int, default=5)
+    g.add_argument('--fsync', help='when the log is forced to disk',
+                   default='batch', choices=msglog.FSYNC)
+    g.add_argument('--dir', help='directory for the log, a temporary one '
+                   'by default')
+
+    n = sub.add_parser('bans', help='cost of checking a connection against '
+                       'the bans')
+    n.add_argument('--bans', help='numbers of bans', type=int, nargs='+',
+                   default=[10, 1000, 100000])
+    n.add_argument('--checks', help='connections to check per measurement',
+                   type=int, default=20000)
+
+    f = sub.add_parser('flood', help='latency of well-behaved clients while '
+                       'one client floods the server')
+    f.add_argument('--clients', help='well-behaved clients', type=int,
+                   default=20)
+    f.add_argument('--messages', help='messages per well-behaved client',
+                   type=int, default=100)
+    f.add_argument('--limit', help='message limit as RATE or RATE:BURST',
+                   default='200:400')
+
+    o = sub.add_parser('protocol', help='bytes and time per message of the '
+                       'text and binary protocols')
+    o.add_argument('--recipients', help='users in the room', type=int,
+                   default=100)
+    o.add_argument('--messages', help='messages per measurement', type=int,
+                   default=2000)
+
+    t = sub.add_parser('tls', help='TLS handshake rate and throughput '
+                       'versus plaintext')
+    t.add_argument('--engines', help='engines to measure', nargs='+',
+                   default=['select', 'asyncio'],
+                   choices=('select', 'asyncio', 'uvloop'))
+    t.add_argument('--handshakes', help='connections per handshake '
+                   'measurement', type=int, default=500)
+    t.add_argument('--clients', help='clients chatting at the same time',
+                   type=int, default=50)
+    t.add_argument('--messages', help='messages per client', type=int,
+                   default=200)
+    t.add_argument('--cert', help='server certificate, self-signed by '
+                   'default')
+    t.add_argument('--key', help='server private key')
+
+    i = sub.add_parser('timers', help='scheduling, cancelling and firing '
+                       'connection deadlines')
+    i.add_argument('--counts', help='numbers of connections', type=int,
+                   nargs='+', default=[1000, 10000, 100000])
+    i.add_argument('--resets', help='deadlines moved per measurement',
+                   type=int, default=200000)
+
+    d = sub.add_parser('load', help='delivery latency under a mix of '
+                       'commands from many clients')
+    d.add_argument('--engines', help='engines to measure', nargs='+',
+                   default=['select', 'asyncio'],
+                   choices=('select', 'asyncio', 'uvloop'))
+    d.add_argument('--clients', help='simulated clients', type=int,
+                   default=1000)
+    d.add_argument('--rate', help='messages per second over all clients',
+                   type=float, default=200)
+    d.add_argument('--duration', help='seconds to generate load',
+                   type=float, default=10)
+    d.add_argument('--mix', help='share of every command',
+                   type=loadgen.parseMix, default=loadgen.MIX)
+    d.add_argument('--churn', help='clients that reconnect per second',
+                   type=float, default=5)
+    d.add_argument('--json', help='file to write the results to as JSON')
+
+    h = sub.add_parser('reload', help='messages lost and clients '
+                       'disconnected while the server is reloaded')
+    h.add_argument('--clients', help='simulated clients', type=int,
+                   default=500)
+    h.add_argument('--rate', help='messages per second over all clients',
+                   type=float, default=500)
+    h.add_argument('--duration', help='seconds to generate load',
+                   type=float, default=10)
+    h.add_argument('--reloads', help='reloads during the load', type=int,
+                   default=3)
+
+    a = sub.add_parser('list', help='cost of /list in a large room')
+    a.add_argument('--sizes', help='users in the room', type=int,
+                   nargs='+', default=[1000, 10000])
+    a.add_argument('--lists', help='/list commands per measurement',
+                   type=int, default=2000)
+
+    k = sub.add_parser('cluster', help='relaying room messages between '
+                       'cluster nodes, with and without batching')
+    k.add_argument('--bursts', help='messages a node sends per loop '
+                   'iteration', type=int, nargs='+', default=[1, 10, 100])
+    k.add_argument('--messages', help='messages per measurement', type=int,
+                   default=100000)
+
+    args = p.parse_args(sys.argv[1:])
+    if args.bench == 'connections':
+        benchConnections(args.counts, args.backends, args.wakeups)
+    elif args.bench == 'broadcast':
+        benchBroadcast(args.recipients, args.rounds, args.batch)
+    elif args.bench == 'lookups':
+        benchLookups(args.users, args.messages)
+    elif args.bench == 'engines':
+        benchEngines(args.engines, args.clients, args.messages)
+    elif args.bench == 'shards':
+        benchShards(args.workers, args.clients, args.messages)
+    elif args.bench == 'parse':
+        benchParse(args.messages)
+    elif args.bench == 'rooms':
+        benchRooms(args.users, args.sizes, args.messages)
+    elif args.bench == 'flood':
+        benchFlood(args.clients, args.messages, args.limit)
+    elif args.bench == 'bans':
+        benchBans(args.bans, args.checks)
+    elif args.bench == 'log':
+        benchLog(args.messages, args.queries, args.fsync, args.dir)
+    elif args.bench == 'protocol':
+        benchProtocol(args.recipients, args.messages)
+    elif args.bench == 'tls':
+        benchTLS(args.engines, args.handshakes, args.clients, args.messages,
+                 args.cert, args.key)
+    elif args.bench == 'timers':
+        benchTimers(args.counts, args.resets)
+    elif args.bench == 'load':
+        benchLoad(args.engines, args.clients, args.rate, args.duration,
+                  args.mix, args.churn, args.json)
+    elif args.bench == 'list':
+        benchList(args.sizes, args.lists)
+    elif args.bench == 'cluster':
+        benchCluster(args.bursts, args.messages)
+    elif args.bench == 'reload':
+        benchReload(args.clients, args.rate, args.duration, args.reloads)
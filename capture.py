@@ -0,0 +1,99 @@
+import json
+import struct
+import time
+
+# A capture file starts with MAGIC and holds one record per event: a header
+# with the kind of the record, the number of the connection, the time since
+# the capture started in microseconds and the length of the data that
+# follows it.
+MAGIC = b'CHATCAP1'
+RECORD = struct.Struct('!BIQI')
+
+# Kinds of records. OPTIONS holds the options of the server as JSON, CONNECT
+# the address of a new client, FRAME a received message as UTF-8, OVERSIZED
+# a message longer than the maximum frame size and CLOSE a connection that
+# was closed.
+OPTIONS = 0
+CONNECT = 1
+FRAME = 2
+OVERSIZED = 3
+CLOSE = 4
+
+# Seconds the records may stay in the buffer of the file. The last of them
+# are lost if the server is killed.
+FLUSH_INTERVAL = 1
+
+
+class CaptureWriter:
+    """
+    Records the accepted connections and the received messages of a server
+    to a file, for replay.py. Records are written to a buffered file from
+    the event loop and flushed at most once per FLUSH_INTERVAL.
+    """
+
+    # Constructor. options are the options of the server that change how it
+    # handles messages, the replay uses them too.
+    def __init__(self, path, options, clock=time.monotonic):
+        self.file = open(path, 'wb', buffering=1 << 16)
+        self.clock = clock
+        self.start = clock()
+        self.flushed = self.start
+        # Numbers of the connections by socket.
+        self.ids = {}
+        self.nextId = 0
+        self.file.write(MAGIC)
+        self.write(OPTIONS, 0, json.dumps(options).encode())
+
+    def write(self, kind, connId, data=b''):
+        now = self.clock()
+        self.file.write(RECORD.pack(kind, connId,
+                                    int((now - self.start) * 1e6), len(data)))
+        self.file.write(data)
+        if now - self.flushed >= FLUSH_INTERVAL:
+            self.file.flush()
+            self.flushed = now
+
+    # Records a new connection from the address.
+    def connect(self, sock, address):
+        self.nextId += 1
+        self.ids[sock] = self.nextId
+        self.write(CONNECT, self.nextId, address.encode())
+
+    # Records a message received on the socket, None if it was too long.
+    def frame(self, sock, frame):
+        connId = self.ids.get(sock)
+        if connId is None:
+            return
+        if frame is None:
+            self.write(OVERSIZED, connId)
+        else:
+            self.write(FRAME, connId, frame.encode('utf-8', 'surrogatepass'))
+
+    # Records that the connection of the socket was closed.
+    def close(self, sock):
+        connId = self.ids.pop(sock, None)
+        if connId is not None:
+            self.write(CLOSE, connId)
+
+    # Writes the buffered records and closes the file.
+    def closeFile(self):
+        self.file.close()
+
+
+# Yields every record of the capture file at path as (kind, connection
+# number, seconds since the capture started, data). A record cut short at
+# the end of the file, e.g. by killing the server, is skipped. Raises
+# ValueError if the file is not a capture.
+def readCapture(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            kind, connId, micros, length = RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield kind, connId, micros / 1e6, data
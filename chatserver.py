@@ -1,170 +1,878 @@
 import socket as s
-import select as sel
-import datetime
+import selectors
+import signal
+import sys
+import time
+import zlib
+
+import msglog
+from bans import MIN_PREFIX, BanList, isTooWide
+from capture import CaptureWriter
+from clock import Clock, MODES
+from connection import Connection, POLICIES
+from framing import FrameError
+from handoff import HandoffListener, requestHandoff, restore
+from history import History
+from metrics import CommandStats, Metrics, MetricsEndpoint
+from protocol import (NOTICE, PING, SAY, SWITCH, WHISPER, WHISPER_SENT,
+                      CommandFramer, Event)
+from ratelimit import RateLimiter, parseLimit
+from registry import DEFAULT_ROOM, UserRegistry
+from tasks import TaskRunner
+from timers import TimerWheel
+from tls import WANT_IO, Handshake, serverContext
 
 HELPTEXT = (" Welcome to the Jochem-ChatServer, available commands are:\n"
             "\t   /nick <new_nick> :: Set a new username.\n"
-            "\t   /say <text> | <text> :: Send a message to every"
-            "online user.\n"
+            "\t   /say <text> | <text> :: Send a message to the room "
+            "you are talking in.\n"
+            "\t   /join <#room> :: Join a room and talk in it, everyone "
+            "starts in #lobby.\n"
+            "\t   /part <#room> :: Leave a room.\n"
+            "\t   /history <n> :: Get the last n messages of the room you "
+            "are talking in.\n"
+            "\t   /search <nick|text> :: Search the message log for "
+            "messages of a user or containing a text.\n"
             "\t   /whisper <receiver_nick> <text> :: Send a message to"
             "a specific user.\n"
-            "\t   /list :: Get a list of every user currenyly online."
+            "\t   /list [prefix*] [page] :: Get a page of the users in the "
+            "room you are talking in, optionally of those whose name starts "
+            "with prefix."
             "\n\t   /whois <user_nick> :: Receive the IP address of "
             "the specified user.\n"
             "\t   /kick <user_nick> :: Kick the specified user from "
-            "the chatroom\n")
+            "the chatroom\n"
+            "\t   /ipban <user_nick> :: Ban the IP address of the specified "
+            "user.\n"
+            "\t   /ban <ip|cidr> [minutes] :: Ban an IP address or range, "
+            "optionally for a number of minutes.\n"
+            "\t   /unban <ip|cidr> :: Lift the ban of an IP address or "
+            "range.\n"
+            "\t   /protocol binary [zlib] :: Switch to the binary protocol, "
+            "optionally compressed.\n"
+            "\t   /pong <token> :: Answer a PING of the server.\n")
+
+
+# Returns the number in text capped at limit, None unless text is a number
+# in ASCII digits. Numbers too long for int() are capped too.
+def parseCount(text, limit):
+    if not (text.isascii() and text.isdecimal()):
+        return None
+    text = text.lstrip('0') or '0'
+    if len(text) > len(str(limit)):
+        return limit
+    return min(int(text), limit)
+
+
+# Longest ban /ban accepts, a year.
+MAX_BAN_MINUTES = 365 * 24 * 60
+
+# Seconds a closing connection gets to send what is queued for it, e.g. the
+# notice of a kick, before it is dropped.
+LINGER_TIMEOUT = 10
+
+# Users per page of /list, the highest page number it accepts and the
+# number of pages kept for sending again.
+LIST_PAGE = 50
+LIST_MAX_PAGE = 1 << 20
+LIST_CACHE = 1024
+
+
+# I/O backends that can be passed to the server with --backend. "default" is
+# the best one the platform offers (epoll on Linux, kqueue on BSD/macOS).
+BACKENDS = {
+    'default': selectors.DefaultSelector,
+    'select': selectors.SelectSelector,
+}
+for _name, _cls in (('poll', 'PollSelector'), ('epoll', 'EpollSelector'),
+                    ('devpoll', 'DevpollSelector'),
+                    ('kqueue', 'KqueueSelector')):
+    if hasattr(selectors, _cls):
+        BACKENDS[_name] = getattr(selectors, _cls)
 
 
 class Server:
 
     # Constructor
-    def __init__(self, port, connections):
-        # Inits socket.
-        self.serverSocket = s.socket(s.AF_INET, s.SOCK_STREAM)
-        self.serverSocket.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
-        self.serverSocket.bind(('', port))
-        self.serverSocket.listen(connections)
+    def __init__(self, port, connections, selector=None,
+                 highWatermark=1 << 20, lowWatermark=1 << 18,
+                 overflowPolicy='pause', maxFrame=4096, reusePort=False,
+                 timestampMode='clock', metrics=False, historySize=100,
+                 replaySize=20, logDir=None, logFsync='batch', logName='0',
+                 banFile=None, messageLimit=None, byteLimit=None,
+                 connectionLimit=None, addressShare=4, sslContext=None,
+                 idleTimeout=None, pingInterval=None, handshakeTimeout=10,
+                 listenSocket=None, capturePath=None):
+        # Inits socket. With reusePort several processes can listen on the
+        # same port and the kernel spreads the connections over them. A
+        # listenSocket that is listening already, e.g. one handed over by
+        # the server this one replaces, is used instead.
+        self.serverSocket = listenSocket
+        if listenSocket is None:
+            self.serverSocket = s.socket(s.AF_INET, s.SOCK_STREAM)
+            self.serverSocket.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
+            if reusePort:
+                self.serverSocket.setsockopt(s.SOL_SOCKET, s.SO_REUSEPORT, 1)
+            self.serverSocket.bind(('', port))
+            self.serverSocket.listen(connections)
         self.serverSocket.setblocking(0)
 
-        # Inits input and output socket list for select module.
-        self.connectedSockets = [self.serverSocket]
-        self.onlineUsers = []
-        self.bannedIps = []
+        # Inits the I/O backend. Sockets are registered once when they are
+        # accepted and unregistered when they are closed, so a wakeup only
+        # costs as much as the number of sockets that are actually ready.
+        self.selector = selector if selector is not None else \
+            selectors.DefaultSelector()
+        self.selector.register(self.serverSocket, selectors.EVENT_READ)
+
+        # Inits the outbound buffer limits and maximum message length of new
+        # connections.
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.overflowPolicy = overflowPolicy
+        self.maxFrame = maxFrame
+
+        # Inits the connections by socket and the connections with data
+        # queued during the current loop iteration.
+        self.connectedSockets = {}
+        self.pendingWrites = {}
+
+        # Inits the online users and the banned ips, which are saved to
+        # banFile if it is given.
+        self.onlineUsers = UserRegistry()
+        self.bans = BanList(banFile)
+
+        # Inits the last messages of every room and the number of them a user
+        # gets when entering a room.
+        self.history = History(historySize)
+        self.replaySize = replaySize
+
+        # Inits the persistent message log, None when it is off, and the
+        # worker thread for blocking tasks such as searching it, which is
+        # started when it is first needed.
+        self.logDir = logDir
+        self.messageLog = None
+        if logDir is not None:
+            self.messageLog = msglog.MessageLog(logDir, logName, logFsync)
+        self.tasks = None
+
+        # Inits the rate limiter, None when nothing is limited.
+        self.limiter = None
+        if messageLimit or byteLimit or connectionLimit:
+            self.limiter = RateLimiter(messageLimit, byteLimit,
+                                       connectionLimit, addressShare)
+
+        # Inits the timers of the event loop, e.g. for resuming throttled
+        # connections, and the seconds a client may be silent, None for as
+        # long as it likes. With pingInterval a client that was silent that
+        # long is sent a PING and disconnected if it stays silent for as
+        # long again.
+        self.timers = TimerWheel()
+        self.idleTimeout = idleTimeout
+        self.pingInterval = pingInterval
+
+        # Inits the TLS context of client connections, None for plaintext,
+        # and the seconds a client gets for its handshake.
+        self.sslContext = sslContext
+        self.handshakeTimeout = handshakeTimeout
+
+        # Inits the timestamp of messages, updated once per loop iteration.
+        self.clock = Clock(timestampMode)
+
+        # Inits the capture of the traffic for replay.py, None when it is
+        # off. The options that change how messages are handled are recorded
+        # with it.
+        self.capture = None
+        if capturePath is not None:
+            self.capture = CaptureWriter(capturePath, dict(
+                highWatermark=highWatermark, lowWatermark=lowWatermark,
+                overflowPolicy=overflowPolicy, maxFrame=maxFrame,
+                timestampMode=timestampMode, historySize=historySize,
+                replaySize=replaySize))
+
+        # Inits the /list pages that were sent as (room, prefix, page) ->
+        # (version of the nickname index, text of the page).
+        self.listPages = {}
+
+        # Inits the commands as command -> (arguments, handler) and the
+        # metrics, which are None when they are off.
+        self.metrics = None
+        self.commands = {}
+        self.registerDefaultCommands()
+        if metrics:
+            self.metrics = Metrics(self.commands)
 
     # Returns the server socket.
     def getServerSocket(self):
         return self.serverSocket
 
-    # Returns the list with all connected sockets.
+    # Returns the I/O backend the server sockets are registered with.
+    def getSelector(self):
+        return self.selector
+
+    # Returns the dict of connections by connected socket.
     def getConnectedSockets(self):
         return self.connectedSockets
 
-    # Appends the list of connected sockets if it is not already in the list.
+    # Returns the connection of the given socket or None.
+    def getConnection(self, sock):
+        return self.connectedSockets.get(sock)
+
+    # Adds the socket to the connected sockets and registers it for reading.
     def appendConnectedSockets(self, sock):
         if sock not in self.connectedSockets:
-            self.connectedSockets.append(sock)
+            sock.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
+            sock.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+            sock.setblocking(0)
+            conn = Connection(sock, self.highWatermark, self.lowWatermark,
+                              self.overflowPolicy, self.maxFrame)
+            conn.events = selectors.EVENT_READ
+            self.connectedSockets[sock] = conn
+            self.selector.register(sock, conn.events)
 
-    # Removes the given socket from the list of connected sockets if it is in.
+    # Removes the given socket from the connected sockets and unregisters it.
     def removeConnectedSockets(self, sock):
-        if sock in self.connectedSockets:
-            self.connectedSockets.remove(sock)
+        conn = self.connectedSockets.pop(sock, None)
+        if conn is not None:
+            if self.capture is not None:
+                self.capture.close(sock)
+            self.selector.unregister(sock)
+            for timer in (conn.resumeTimer, conn.activityTimer,
+                          conn.lingerTimer):
+                if timer is not None:
+                    timer.cancel()
+            if self.limiter is not None:
+                self.limiter.forget(sock)
+            if self.metrics is not None:
+                self.metrics.closed += 1
 
-    # Sends message to every user.
-    def sendMessageAll(self, messageToSend):
-        for sock in self.connectedSockets:
-            if sock is not self.serverSocket:
-                try:
-                    sock.send(messageToSend.encode())
-                except Exception:
-                    sock.close()
-                    self.removeConnectedSockets(sock)
-
-    # Sends message to a specific socket.
-    def sendMessageOne(self, messageToSend, receiverSocket):
-        if receiverSocket is not self.serverSocket:
-            try:
-                receiverSocket.send(messageToSend.encode())
-            except Exception:
-                receiverSocket.close()
-                self.removeConnectedSockets(receiverSocket)
+    # Closes the socket once everything queued for it has been sent. The
+    # socket is not read from anymore in the meantime. A peer that does not
+    # read it within LINGER_TIMEOUT is dropped.
+    def closeConnection(self, sock):
+        conn = self.connectedSockets.get(sock)
+        if conn is None:
+            sock.close()
+            return
+        lingering = conn.closing
+        conn.closing = True
+        self.writeConnection(conn)
+        if not lingering and sock in self.connectedSockets:
+            conn.lingerTimer = self.callLater(LINGER_TIMEOUT,
+                                              self.dropConnection, sock)
+
+    # Closes the socket right away and removes its user without notifying the
+    # other users. Used when a client cannot be written to anymore.
+    def dropConnection(self, sock):
+        self.removeOnlineUser(self.getUserFromSock(sock))
+        self.removeConnectedSockets(sock)
+        sock.close()
+
+    # Writes as much of the outbound buffer of the connection as possible and
+    # updates the events its socket is registered for.
+    def writeConnection(self, conn):
+        sock = conn.getSocket()
+        try:
+            written = conn.flush()
+        except OSError:
+            if self.metrics is not None:
+                self.metrics.sendFailures += 1
+            self.dropConnection(sock)
+            return
+        if self.metrics is not None:
+            self.metrics.bytesOut += written
+        if conn.closing and not conn.hasOutbound():
+            self.removeConnectedSockets(sock)
+            sock.close()
+            return
+        self.updateEvents(conn)
+
+    # Registers the socket of the connection for the events it wants now.
+    def updateEvents(self, conn):
+        events = conn.wantedEvents()
+        if events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.getSocket(), events)
+
+    # Handles the complete messages received on the connection. Stops when
+    # the connection closes or the rate limiter throttles it, the remaining
+    # messages are handled once it is resumed.
+    def processFrames(self, conn):
+        sock = conn.getSocket()
+        framer = conn.framer
+        frames = framer.frames()
+        try:
+            for frame in frames:
+                self.handleFrame(sock, frame)
+                if conn.closing or sock not in self.connectedSockets:
+                    return
+                if self.limiter is not None:
+                    delay = self.limiter.message(sock)
+                    if delay:
+                        self.throttle(conn, delay)
+                        return
+                # The rest is framed by the protocol switched to.
+                if conn.framer is not framer:
+                    frames.close()
+                    self.processFrames(conn)
+                    return
+        except FrameError:
+            self.handleFrame(sock, None)
+            self.closeConnection(sock)
+
+    # Stops reading from the connection for delay seconds.
+    def throttle(self, conn, delay):
+        resumeAt = time.monotonic() + delay
+        if resumeAt <= conn.throttledUntil:
+            return
+        if conn.resumeTimer is not None:
+            conn.resumeTimer.cancel()
+        conn.throttledUntil = resumeAt
+        conn.resumeTimer = self.callLater(delay, self.resume, conn)
+        self.updateEvents(conn)
+        if self.metrics is not None:
+            self.metrics.throttled += 1
+
+    # Handles the messages received while the connection was throttled and
+    # reads from it again.
+    def resume(self, conn):
+        conn.resumeTimer = None
+        conn.throttledUntil = 0
+        self.processFrames(conn)
+        if conn.getSocket() in self.connectedSockets:
+            self.updateEvents(conn)
+
+    # Calls func with args after delay seconds from the event loop. Returns
+    # the timer, which can be cancelled.
+    def callLater(self, delay, func, *args):
+        return self.timers.schedule(delay, func, *args)
+
+    # Returns the seconds the event loop may wait for events, None for as
+    # long as it takes.
+    def pollTimeout(self):
+        return self.timers.timeout()
 
-    # Adds a user dict to the list of online users.
+    # Checks after a while whether the client of the socket is still there,
+    # if idle timeouts or heartbeats are on.
+    def watchActivity(self, sock):
+        if self.idleTimeout is None and self.pingInterval is None:
+            return
+        conn = self.getConnection(sock)
+        conn.lastActive = time.monotonic()
+        self.checkActivity(sock)
+
+    # Disconnects the client of the socket if it was silent for too long and
+    # pings it if it was silent for the ping interval. Receiving only sets
+    # the time the client was last heard from, the timer is checked and
+    # scheduled again when it fires instead of being moved on every message.
+    def checkActivity(self, sock):
+        conn = self.getConnection(sock)
+        if conn is None or conn.closing:
+            return
+        idle = time.monotonic() - conn.lastActive
+        wait = []
+        if self.idleTimeout is not None:
+            if idle >= self.idleTimeout:
+                self.timeOut(sock, "timed out")
+                return
+            wait.append(self.idleTimeout - idle)
+        if self.pingInterval is not None:
+            if idle >= 2 * self.pingInterval:
+                self.timeOut(sock, "did not answer a ping")
+                return
+            if idle >= self.pingInterval and not conn.pinged:
+                conn.pinged = True
+                ping = Event(PING, str(self.clock.millis))
+                self.sendMessageOne(ping, sock)
+            limit = 2 * self.pingInterval if conn.pinged else \
+                self.pingInterval
+            wait.append(limit - idle)
+        conn.activityTimer = self.callLater(min(wait), self.checkActivity,
+                                            sock)
+
+    # Disconnects a silent client right away, its peer may be gone without
+    # closing the connection, and tells its rooms why.
+    def timeOut(self, sock, reason):
+        if self.metrics is not None:
+            self.metrics.timedOut += 1
+        user = self.getUserFromSock(sock)
+        rooms = list(user.rooms) if user is not None else []
+        self.dropConnection(sock)
+        if user is not None:
+            mess = self.notice(f"{user.nickname} {reason}")
+            self.sendMessageRooms(rooms, mess)
+
+    # Queues data on the connection of the socket. It is sent at the end of
+    # the loop iteration, together with anything else queued in the meantime.
+    def queueData(self, data, sock):
+        conn = self.connectedSockets.get(sock)
+        if conn is None or conn.closing:
+            return
+        if not conn.queue(data):
+            self.dropConnection(sock)
+            return
+        self.pendingWrites[conn] = None
+
+    # Writes the data queued during this loop iteration.
+    def flushPending(self):
+        while self.pendingWrites:
+            pending = self.pendingWrites
+            self.pendingWrites = {}
+            for conn in pending:
+                if conn.getSocket() in self.connectedSockets:
+                    self.writeConnection(conn)
+
+    # Queues the event on the connection of the socket in the protocol of
+    # the connection. A compressed connection compresses every event and
+    # flushes the compressor, so the client can decode it right away.
+    def queueEvent(self, event, sock):
+        conn = self.connectedSockets.get(sock)
+        if conn is None:
+            return
+        data = event.encode(conn.binary)
+        if conn.compressor is not None:
+            data = conn.compressor.compress(data) + \
+                conn.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.queueData(data, sock)
+
+    # Sends the event to every user. The event is encoded once per protocol
+    # and the same buffer is queued for every connection using it.
+    def sendMessageAll(self, event):
+        self.broadcastEvent(event)
+
+    # Queues the event for every connected socket.
+    def broadcastEvent(self, event):
+        for sock in list(self.connectedSockets):
+            self.queueEvent(event, sock)
+
+    # Sends the event to the members of the given rooms, once to a user
+    # that is in several of them. With remember the event is added to the
+    # history of the rooms.
+    def sendMessageRooms(self, rooms, event, remember=False):
+        self.roomsEvent(rooms, event, remember)
+
+    # Queues the event for the members of the given rooms. Only the members
+    # are visited, whatever the number of online users.
+    def roomsEvent(self, rooms, event, remember=False):
+        if remember:
+            self.remember(rooms, event)
+        for user in list(self.onlineUsers.getMembers(rooms)):
+            self.queueEvent(event, user.socket)
+
+    # Adds the event to the history of the rooms.
+    def remember(self, rooms, event):
+        for room in rooms:
+            self.history.add(room, event)
+
+    # Queues the last n messages of the room for the socket. The events of
+    # the history keep their encodings, so they are not encoded again.
+    def replayHistory(self, sock, room, n):
+        for event in self.history.last(room, n):
+            self.queueEvent(event, sock)
+
+    # Adds a message to the persistent message log if it is on. kind is one
+    # of msglog.KINDS.
+    def logMessage(self, kind, sender, target, text):
+        if self.messageLog is not None:
+            self.messageLog.append(kind, sender, target, text)
+
+    # Runs func on the worker thread and calls callback from the event loop
+    # with its result and None, or with None and the exception it raised.
+    def runTask(self, func, callback):
+        if self.tasks is None:
+            self.tasks = TaskRunner(self.selector)
+        self.tasks.submit(func, callback)
+
+    # Drops the history of the rooms that are empty now. The history of the
+    # default room is kept for the next user.
+    def forgetEmptyRooms(self, rooms):
+        for room in rooms:
+            if room != DEFAULT_ROOM and not self.onlineUsers.getRoom(room):
+                self.history.forget(room)
+
+    # Sends the event to a specific socket.
+    def sendMessageOne(self, event, receiverSocket):
+        self.queueEvent(event, receiverSocket)
+
+    # Adds a user to the online users and returns it. Returns None if the
+    # socket or nickname is already in use.
     def addOnlineUser(self, socket, address, nickname):
-        userDict = {}
-        userDict['socket'] = socket
-        userDict['address'] = address
-        userDict['nickname'] = nickname
-        self.onlineUsers.append(userDict)
+        return self.onlineUsers.add(socket, address, nickname)
 
-    # Removes a user from the list of online users.
+    # Removes a user from the online users.
     def removeOnlineUser(self, user):
         if user is None:
             return
-        if user in self.onlineUsers:
-            self.onlineUsers.remove(user)
+        rooms = list(user.rooms)
+        self.onlineUsers.remove(user)
+        self.forgetEmptyRooms(rooms)
 
-    # Returns the list of online users.
+    # Returns the registry of online users.
     def getOnlineUsers(self):
         return self.onlineUsers
 
-    # Returns the user dict associated with a the given socket.
+    # Returns the user associated with a the given socket.
     def getUserFromSock(self, socket):
-        try:
-            u = list(filter(lambda user: user['socket'] == socket,
-                     self.getOnlineUsers()))[0]
-        except Exception:
-            u = None
-        return u
+        return self.onlineUsers.getBySocket(socket)
 
-    # Returns the user dict associated with the given nickname.
+    # Returns the user associated with the given nickname.
     def getUserFromNick(self, nickname):
-        try:
-            u = list(filter(lambda user: user['nickname'] == nickname,
-                     self.getOnlineUsers()))[0]
-        except Exception:
-            u = None
-        return u
+        return self.onlineUsers.getByNick(nickname)
+
+    # Adds the user to the room and makes it the room the user talks in.
+    # Returns False if the user already was a member.
+    def addToRoom(self, user, room):
+        return self.onlineUsers.join(user, room)
+
+    # Removes the user from the room.
+    def removeFromRoom(self, user, room):
+        self.onlineUsers.part(user, room)
+        self.forgetEmptyRooms([room])
+
+    # Returns a free default nickname for a new user.
+    def newNickname(self):
+        number = len(self.onlineUsers) + 1
+        while self.onlineUsers.getByNick(f"Jochem-{number}") is not None:
+            number += 1
+        return f"Jochem-{number}"
+
+    # Adds a newly accepted client socket and notifies users. With TLS the
+    # client is added once its handshake completed, bans and the connection
+    # limit are checked before the handshake starts.
+    def acceptClient(self, connectionSock, addr):
+        if self.bans.isBanned(addr[0]):
+            if self.metrics is not None:
+                self.metrics.rejected += 1
+            connectionSock.close()
+            return
+        if self.sslContext is not None:
+            connectionSock.setblocking(0)
+            connectionSock = self.sslContext.wrap_socket(
+                connectionSock, server_side=True,
+                do_handshake_on_connect=False)
+        if self.limiter is not None and \
+                self.limiter.connect(connectionSock, addr[0]):
+            if self.metrics is not None:
+                self.metrics.limited += 1
+            connectionSock.close()
+            return
+        if self.sslContext is not None:
+            handshake = Handshake(connectionSock, self.selector,
+                                  lambda sock: self.addClient(sock, addr),
+                                  self.handshakeFailed)
+            handshake.timer = self.callLater(self.handshakeTimeout,
+                                             handshake.abort)
+            handshake.start()
+            return
+        self.addClient(connectionSock, addr)
+
+    # Closes a socket whose TLS handshake failed.
+    def handshakeFailed(self, sock, error):
+        if self.limiter is not None:
+            self.limiter.forget(sock)
+        if self.metrics is not None:
+            self.metrics.handshakeFailures += 1
+        sock.close()
+
+    # Adds an accepted client that is ready to chat and notifies users.
+    def addClient(self, connectionSock, addr):
+        if self.metrics is not None:
+            self.metrics.accepted += 1
+            if getattr(connectionSock, 'session_reused', False):
+                self.metrics.resumedSessions += 1
+        if self.capture is not None:
+            self.capture.connect(connectionSock, addr[0])
+        self.appendConnectedSockets(connectionSock)
+        self.watchActivity(connectionSock)
+        nickname = self.newNickname()
+        user = self.addOnlineUser(connectionSock, addr[0], nickname)
+        self.addToRoom(user, DEFAULT_ROOM)
+        self.replayHistory(connectionSock, DEFAULT_ROOM, self.replaySize)
+        mess = self.notice(f"{addr[0]} connected with name {nickname}")
+        self.sendMessageRooms([DEFAULT_ROOM], mess)
+
+    # Removes a socket whose peer closed the connection and notifies users.
+    def disconnectClient(self, sock):
+        user = self.getUserFromSock(sock)
+        if user is None:
+            self.dropConnection(sock)
+            return
+        name = user.nickname
+        # naar iedereen sturen
+        mess = self.notice(f"{name} disconnected")
+        rooms = list(user.rooms)
+        self.removeOnlineUser(user)
+        self.removeConnectedSockets(sock)
+        sock.close()
+        self.sendMessageRooms(rooms, mess)
+
+    # Parses one received message and runs its command. frame is None if the
+    # client sent a message longer than the maximum frame size.
+    def handleFrame(self, sock, frame):
+        if self.capture is not None:
+            self.capture.frame(sock, frame)
+        if frame is None:
+            if self.metrics is not None:
+                self.metrics.oversizedFrames += 1
+            mess = self.notice("Message too long.", stamped=False)
+            self.sendMessageOne(mess, sock)
+            return
+        user = self.getUserFromSock(sock)
+        if user is None or not frame.strip():
+            return
+        sender = user.nickname
+        messageParsed = Message(frame, sender, self.commands)
+        # Checks if message syntax is correct.
+        if messageParsed.getCorrectMessage() is False:
+            mess = self.notice("Incorrect syntax. Type '/?' for info.",
+                               stamped=False)
+            self.sendMessageOne(mess, sock)
+            return
+        handler = messageParsed.getHandler()
+        metrics = self.metrics
+        if metrics is not None:
+            stats = metrics.command(messageParsed.getCommand())
+            stats.count += 1
+            start = time.perf_counter()
+        if handler is None:
+            mess = self.notice("Unknown command. Type '/?' for info.",
+                               stamped=False)
+            self.sendMessageOne(mess, sock)
+        else:
+            handler(messageParsed, sock)
+        if metrics is not None:
+            stats.seconds.observe(time.perf_counter() - start)
+
+    # Adds a command. args is one of NO_ARGS, NICK, TEXT, NICK_TEXT and
+    # ANY_TEXT and handler is called with the parsed Message and the sending
+    # socket.
+    def registerCommand(self, command, args, handler):
+        self.commands[command] = (args, handler)
+        if self.metrics is not None and command not in self.metrics.commands:
+            self.metrics.commands[command] = CommandStats()
+
+    # Registers the built-in commands.
+    def registerDefaultCommands(self):
+        self.registerCommand("/say", TEXT, self.handleSay)
+        self.registerCommand("/nick", NICK,
+                             lambda message, sock:
+                             self.handleNick(sock, message.getNick()))
+        self.registerCommand("/whisper", NICK_TEXT, self.handleWhisper)
+        self.registerCommand("/list", ANY_TEXT, self.handleList)
+        self.registerCommand("/join", NICK, self.handleJoin)
+        self.registerCommand("/part", NICK, self.handlePart)
+        self.registerCommand("/history", NICK, self.handleHistory)
+        self.registerCommand("/search", TEXT, self.handleSearch)
+        self.registerCommand("/help", NO_ARGS, self.handleHelp)
+        self.registerCommand("/?", NO_ARGS, self.handleHelp)
+        self.registerCommand("/pong", TEXT, self.handlePong)
+        self.registerCommand("/whois", NICK, self.handleWhoIs)
+        self.registerCommand("/kick", NICK, self.handleKick)
+        self.registerCommand("/ipban", NICK, self.handleIpBan)
+        self.registerCommand("/ban", TEXT, self.handleBan)
+        self.registerCommand("/unban", NICK, self.handleUnban)
+        self.registerCommand("/protocol", TEXT, self.handleProtocol)
 
     # Returns the current time in the format for messages.
     def time(self):
-        time = datetime.datetime.now().strftime("%H:%M:%S")
-        return time
+        return self.clock.stamp
+
+    # Returns an event of the given kind at the current time.
+    def event(self, kind, text, sender='', target=''):
+        return Event(kind, text, sender, target, self.clock.stamp,
+                     self.clock.millis)
+
+    # Returns a notice with the text for users. Without stamped the text
+    # protocol shows it without timestamp.
+    def notice(self, text, stamped=True):
+        return Event(NOTICE, text, '', '',
+                     self.clock.stamp if stamped else None, self.clock.millis)
+
+    # Returns the room the user of the socket talks in. Tells the user and
+    # returns None if the user is not in any room.
+    def currentRoom(self, sock):
+        user = self.getUserFromSock(sock)
+        if user is None:
+            return None
+        if user.room is None:
+            mess = self.notice("You are not in a room. Type '/join <#room>' "
+                               "to join one.")
+            self.sendMessageOne(mess, sock)
+        return user.room
 
     # Handles the say command.
-    def handleSay(self, message):
-        finalMess = f"[{self.time()}] {message.getSender()}:"
-        finalMess += f" {message.getText()}\n"
-        self.sendMessageAll(finalMess)
+    def handleSay(self, message, sendSock):
+        room = self.currentRoom(sendSock)
+        if room is None:
+            return
+        finalMess = self.event(SAY, message.getText(), message.getSender(),
+                               room)
+        self.sendMessageRooms([room], finalMess, remember=True)
+        self.logMessage('say', message.getSender(), room, message.getText())
+
+    # Handles the join command.
+    def handleJoin(self, message, sendSock):
+        room = message.getNick()
+        user = self.getUserFromSock(sendSock)
+        if user is None:
+            return
+        if not room.startswith("#") or len(room) < 2:
+            mess = self.notice("Room names start with '#'.")
+            self.sendMessageOne(mess, sendSock)
+            return
+        if self.addToRoom(user, room):
+            self.replayHistory(sendSock, room, self.replaySize)
+            mess = self.notice(f"{user.nickname} joined {room}")
+            self.sendMessageRooms([room], mess)
+        else:
+            mess = self.notice(f"You are now talking in {room}")
+            self.sendMessageOne(mess, sendSock)
+
+    # Handles the part command.
+    def handlePart(self, message, sendSock):
+        room = message.getNick()
+        user = self.getUserFromSock(sendSock)
+        if user is None:
+            return
+        if room not in user.rooms:
+            mess = self.notice(f"You are not in {room}.")
+            self.sendMessageOne(mess, sendSock)
+            return
+        mess = self.notice(f"{user.nickname} left {room}")
+        self.sendMessageRooms([room], mess)
+        self.removeFromRoom(user, room)
+
+    # Handles the history command.
+    def handleHistory(self, message, receiveSock):
+        room = self.currentRoom(receiveSock)
+        if room is None:
+            return
+        count = parseCount(message.getNick(), self.history.size)
+        if count is None:
+            mess = self.notice("Usage: /history <number of messages>")
+            self.sendMessageOne(mess, receiveSock)
+            return
+        self.replayHistory(receiveSock, room, count)
+
+    # Handles the search command. The log is searched on the worker thread
+    # and the results are sent when it is done.
+    def handleSearch(self, message, sendSock):
+        user = self.getUserFromSock(sendSock)
+        if user is None:
+            return
+        if self.logDir is None:
+            mess = self.notice("The message log is off.")
+            self.sendMessageOne(mess, sendSock)
+            return
+        term = message.getText()
+        rooms = list(user.rooms)
+        nickname = user.nickname
+        # The nickname of a user that is online is searched for as a sender
+        # through the index.
+        bySender = self.onlineUsers.getByNick(term) is not None
+        self.runTask(lambda: msglog.search(self.logDir, term, rooms,
+                                           nickname, bySender=bySender),
+                     lambda results, error:
+                     self.sendSearchResults(sendSock, term, results, error))
+
+    # Sends the results of a search, or that it failed.
+    def sendSearchResults(self, receiveSock, term, results, error=None):
+        if error is not None:
+            mess = self.notice(f"The search for {term} failed.")
+            self.sendMessageOne(mess, receiveSock)
+            return
+        lines = [f"{len(results)} messages found for {term}"]
+        for record in results:
+            lines.append(f"\t   {msglog.formatRecord(record)}")
+        self.sendMessageOne(self.notice("\n".join(lines)), receiveSock)
 
     # Handles the list command.
     def handleList(self, message, receiveSock):
-        finalMess = f"[{self.time()}] "
-        count = 0
-        for onlineU in self.getOnlineUsers():
-            if count == 0:
-                line = f"{onlineU['nickname']} {onlineU['address']}\n"
-            else:
-                line = f"\t   {onlineU['nickname']} {onlineU['address']}\n"
-            finalMess += line
-            count += 1
-        self.sendMessageOne(finalMess, receiveSock)
+        room = self.currentRoom(receiveSock)
+        if room is None:
+            return
+        prefix, page = '', 1
+        for word in message.getText().split():
+            if word.endswith('*'):
+                prefix = word[:-1]
+                continue
+            page = parseCount(word, LIST_MAX_PAGE)
+            if not page:
+                mess = self.notice("Usage: /list [prefix*] [page]")
+                self.sendMessageOne(mess, receiveSock)
+                return
+        self.sendMessageOne(self.listPage(room, prefix, page), receiveSock)
+
+    # Returns the page of the users of the room whose nickname starts with
+    # the prefix, in the order of their nicknames, as a notice with the
+    # current timestamp. The text of the page is kept until the nicknames
+    # of the room change, so a /list costs O(LIST_PAGE) at most.
+    def listPage(self, room, prefix, page):
+        index = self.onlineUsers.getNickIndex(room)
+        if index is None:
+            return self.notice(f"No users in {room}.")
+        key = (room, prefix, page)
+        cached = self.listPages.get(key)
+        if cached is not None and cached[0] == index.version:
+            return self.notice(cached[1])
+
+        start, end = index.find(prefix)
+        pages = -(-(end - start) // LIST_PAGE)
+        if not pages:
+            text = f"No users match {prefix}*."
+        elif page > pages:
+            text = f"There are only {pages} pages."
+        else:
+            first = start + (page - 1) * LIST_PAGE
+            lines = []
+            for nickname in index.nicks[first:min(first + LIST_PAGE, end)]:
+                user = self.onlineUsers.getByNick(nickname)
+                lines.append(f"{nickname} {user.address}")
+            if pages > 1:
+                more = f"{prefix}* " if prefix else ""
+                lines.append(f"page {page} of {pages}, /list {more}<page> "
+                             "for the others")
+            text = "\n\t   ".join(lines)
+        if len(self.listPages) >= LIST_CACHE:
+            self.listPages.clear()
+        self.listPages[key] = (index.version, text)
+        return self.notice(text)
 
     # Handls the help command.
     def handleHelp(self, message, receiveSock):
-        text = "[" + self.time() + "]" + HELPTEXT
-        self.sendMessageOne(text, receiveSock)
+        self.sendMessageOne(self.notice(HELPTEXT.strip()), receiveSock)
 
     # Handles the nick command.
     def handleNick(self, receiveSock, newNick):
         # Checks if username is in use.
-        for user in self.getOnlineUsers():
-            if user['nickname'] == newNick:
-                mess = f"[{self.time()}] username {newNick} already in use\n"
-                self.sendMessageOne(mess, receiveSock)
-                return
+        if self.getUserFromNick(newNick) is not None:
+            mess = self.notice(f"username {newNick} already in use")
+            self.sendMessageOne(mess, receiveSock)
+            return
         # Changes username
         user = self.getUserFromSock(receiveSock)
         if user is None:
-            mess = f"[{self.time()}] Error changing username.\n"
+            mess = self.notice("Error changing username.")
             self.sendMessageOne(mess, receiveSock)
             return
-        for u in self.onlineUsers:
-            if user is u:
-                oldNick = u['nickname']
-                u['nickname'] = newNick
-        # Notifies users of name change.
-        message = f"[{self.time()}] user {oldNick} changed name to {newNick}\n"
-        self.sendMessageAll(message)
+        self.renameUser(user, newNick)
+
+    # Changes the nickname of the user and notifies users.
+    def renameUser(self, user, newNick):
+        oldNick = user.nickname
+        self.onlineUsers.rename(user, newNick)
+        # Notifies the users in the rooms of the user of the name change.
+        message = self.notice(f"user {oldNick} changed name to {newNick}")
+        self.sendMessageRooms(list(user.rooms), message)
 
     # Handles the whoIs command.
     def handleWhoIs(self, message, receiveSock):
         nickname = message.getNick()
         user = self.getUserFromNick(nickname)
         if user is None:
-            finalMess = f"[{self.time()}] Could not find user {nickname}.\n"
+            finalMess = self.notice(f"Could not find user {nickname}.")
         else:
-            ip = user['address']
-            finalMess = f"[{self.time()}] {nickname} has address {ip}\n"
+            ip = user.address
+            finalMess = self.notice(f"{nickname} has address {ip}")
         self.sendMessageOne(finalMess, receiveSock)
 
     # Handles the kick command.
@@ -172,22 +880,21 @@ class Server:
         nickname = message.getNick()
         kickedUser = self.getUserFromNick(nickname)
         if kickedUser is None:
-            finalMess = f"[{self.time()}] Could not find user {nickname}.\n"
+            finalMess = self.notice(f"Could not find user {nickname}.")
             self.sendMessageOne(finalMess, receiveSock)
         else:
             kickerUser = self.getUserFromSock(receiveSock)
             if kickerUser is None:
                 return
-            kickerNickname = kickerUser['nickname']
-            kickedSock = kickedUser['socket']
-            kickedMess = f"[{self.time()}] You have been kicked by "
-            kickedMess += f"{kickerNickname}\n"
+            kickerNickname = kickerUser.nickname
+            kickedSock = kickedUser.socket
+            kickedMess = self.notice("You have been kicked by "
+                                     f"{kickerNickname}")
             self.sendMessageOne(kickedMess, kickedSock)
             self.removeOnlineUser(kickedUser)
-            self.removeConnectedSockets(kickedSock)
-            kickedSock.close()
-            finalMess = f"[{self.time()}] {nickname} has been kicked by "
-            finalMess += f"{kickerNickname}\n"
+            self.closeConnection(kickedSock)
+            finalMess = self.notice(f"{nickname} has been kicked by "
+                                    f"{kickerNickname}")
             self.sendMessageAll(finalMess)
 
     # Handles the whisper command.
@@ -196,139 +903,226 @@ class Server:
         receiveUser = self.getUserFromNick(receiveNickname)
         sendUser = self.getUserFromSock(sendSock)
         if receiveUser is None or sendUser is None:
-            finalMess = f"[{self.time()}] Could not find user "
-            finalMess += f"{receiveNickname}.\n"
+            finalMess = self.notice(f"Could not find user {receiveNickname}.")
             self.sendMessageOne(finalMess, sendSock)
         else:
-            sendNick = sendUser['nickname']
-            senderMess = f"[{self.time()}] whisper to "
-            senderMess += f"{receiveUser['nickname']}: {message.getText()}\n"
-            receiveMess = f"[{self.time()}] {sendNick} whispers: "
-            receiveMess += f"{message.getText()}\n"
-            receiveSock = receiveUser['socket']
+            sendNick = sendUser.nickname
+            senderMess = self.event(WHISPER_SENT, message.getText(),
+                                    sendNick, receiveUser.nickname)
+            receiveMess = self.event(WHISPER, message.getText(), sendNick,
+                                     receiveUser.nickname)
+            receiveSock = receiveUser.socket
             self.sendMessageOne(senderMess, sendSock)
             self.sendMessageOne(receiveMess, receiveSock)
+            self.logMessage('whisper', sendNick, receiveUser.nickname,
+                            message.getText())
 
     # Handles the ipBan command.
     def handleIpBan(self, message, sendSock):
         bannedNickname = message.nick
         bannedUser = self.getUserFromNick(bannedNickname)
         if bannedUser is None:
-            finalMess = f"[{self.time()}] Could not find user "
-            finalMess += f"{bannedNickname}.\n"
+            finalMess = self.notice(f"Could not find user {bannedNickname}.")
             self.sendMessageOne(finalMess, sendSock)
         else:
             sendUser = self.getUserFromSock(sendSock)
             if sendUser is None:
                 return
-            sendNick = sendUser['nickname']
-            bannedIp = bannedUser['address']
-            if bannedIp in self.bannedIps:
-                mess = f"[{self.time()}] IP already banned.\n"
+            sendNick = sendUser.nickname
+            bannedIp = bannedUser.address
+            if self.bans.isBanned(bannedIp):
+                mess = self.notice("IP already banned.")
                 self.sendMessageOne(mess, sendSock)
                 return
-            usersToRemove = []
-            for sockU in self.getOnlineUsers():
-                if sockU["address"] == bannedIp:
-                    sock = sockU['socket']
-                    mess = f"[{self.time()}] You have been IP "
-                    mess += "banned.\n"
-                    usersToRemove.append(sockU)
-                    self.sendMessageOne(mess, sock)
-                    self.removeConnectedSockets(sock)
-                    sock.close()
-            for user in usersToRemove:
-                self.removeOnlineUser(user)
-            if sendUser['address'] == bannedIp:
-                mess = f"[{self.time()}] You have been IP banned.\n"
+            for sockU in self.onlineUsers.getByAddress(bannedIp):
+                sock = sockU.socket
+                mess = self.notice("You have been IP banned.")
+                self.removeOnlineUser(sockU)
+                self.sendMessageOne(mess, sock)
+                self.closeConnection(sock)
+            if sendUser.address == bannedIp:
+                mess = self.notice("You have been IP banned.")
                 self.sendMessageOne(mess, sendSock)
-                self.removeConnectedSockets(sendSock)
                 self.removeOnlineUser(sendUser)
-                sendSock.close()
-            globalMess = f"[{self.time()}] {sendNick} has banned IP"
-            globalMess += f" {bannedIp}\n"
+                self.closeConnection(sendSock)
+            globalMess = self.notice(f"{sendNick} has banned IP {bannedIp}")
             self.sendMessageAll(globalMess)
-            self.bannedIps.append(bannedIp)
+            self.addBan(bannedIp)
+
+    # Handles the ban command.
+    def handleBan(self, message, sendSock):
+        sendUser = self.getUserFromSock(sendSock)
+        if sendUser is None:
+            return
+        network, _, minutes = message.getText().partition(" ")
+        if minutes:
+            minutes = parseCount(minutes, MAX_BAN_MINUTES)
+            if not minutes:
+                mess = self.notice("Usage: /ban <ip|cidr> [minutes]")
+                self.sendMessageOne(mess, sendSock)
+                return
+        expires = time.time() + minutes * 60 if minutes else None
+        try:
+            if isTooWide(network):
+                mess = self.notice(f"Ranges wider than /{MIN_PREFIX[32]} "
+                                   f"(IPv4) or /{MIN_PREFIX[128]} (IPv6) "
+                                   "cannot be banned.")
+                self.sendMessageOne(mess, sendSock)
+                return
+            network = self.addBan(network, expires)
+        except ValueError:
+            mess = self.notice(f"Invalid IP address or range {network}.")
+            self.sendMessageOne(mess, sendSock)
+            return
+        for bannedUser in list(self.getOnlineUsers()):
+            if self.bans.isBanned(bannedUser.address):
+                sock = bannedUser.socket
+                mess = self.notice("You have been IP banned.")
+                self.removeOnlineUser(bannedUser)
+                self.sendMessageOne(mess, sock)
+                self.closeConnection(sock)
+        globalMess = f"{sendUser.nickname} has banned {network}"
+        if minutes:
+            globalMess += f" for {minutes} minutes"
+        self.sendMessageAll(self.notice(globalMess))
+
+    # Handles the unban command.
+    def handleUnban(self, message, sendSock):
+        network = message.getNick()
+        try:
+            removed = self.removeBan(network)
+        except ValueError:
+            removed = False
+        if removed:
+            mess = self.notice(f"{network} is not banned anymore.")
+        else:
+            mess = self.notice(f"{network} is not banned.")
+        self.sendMessageOne(mess, sendSock)
+
+    # Handles the answer to a PING. Receiving it already marked the client as
+    # active.
+    def handlePong(self, message, sendSock):
+        pass
+
+    # Handles the protocol command. The reply is the last line of text, the
+    # connection uses the binary protocol for everything after it.
+    def handleProtocol(self, message, sendSock):
+        words = message.getText().split()
+        conn = self.getConnection(sendSock)
+        if conn is None:
+            return
+        if words[:1] != ['binary'] or words[1:] not in ([], ['zlib']):
+            mess = self.notice("Usage: /protocol binary [zlib]")
+            self.sendMessageOne(mess, sendSock)
+            return
+        if conn.binary:
+            mess = self.notice("The connection uses the binary protocol "
+                               "already.")
+            self.sendMessageOne(mess, sendSock)
+            return
+        compressed = words[1:] == ['zlib']
+        reply = SWITCH + (" zlib" if compressed else "")
+        self.queueData(f"{reply}\n".encode(), sendSock)
+        self.switchProtocol(conn, compressed)
+
+    # Switches the connection to the binary protocol. The data received
+    # after the protocol command is kept for the new framer.
+    def switchProtocol(self, conn, compressed):
+        framer = CommandFramer(self.maxFrame)
+        framer.pending = conn.framer.pending
+        conn.framer = framer
+        conn.binary = True
+        if compressed:
+            conn.compressor = zlib.compressobj()
+
+    # Bans an IP address or CIDR range from connecting until the expiry
+    # time, forever if it is None. Returns the normalised range. Raises
+    # ValueError if network is not an address or range.
+    def addBan(self, network, expires=None):
+        network = self.bans.add(network, expires)
+        self.bans.save()
+        return network
+
+    # Lifts the ban of an IP address or CIDR range. Returns False if it was
+    # not banned.
+    def removeBan(self, network):
+        removed = self.bans.remove(network)
+        if removed:
+            self.bans.save()
+        return removed
+
+    # Replaces the bans by the ones in the ban file, e.g. after it was
+    # edited. Called on SIGHUP.
+    def reloadBans(self):
+        if self.bans.path is None:
+            return
+        try:
+            self.bans.load()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Could not reload the bans: {e}", file=sys.stderr)
+
+    # Writes the messages queued for the message log and the records of the
+    # capture to disk and closes them. Called when the server stops.
+    def close(self):
+        if self.messageLog is not None:
+            self.messageLog.close()
+            self.messageLog = None
+        if self.capture is not None:
+            self.capture.closeFile()
+            self.capture = None
+
+
+# Arguments a command takes.
+NO_ARGS = 0     # /help
+NICK = 1        # /kick <user_nick>
+TEXT = 2        # /say <text>
+NICK_TEXT = 3   # /whisper <receiver_nick> <text>
+ANY_TEXT = 4    # /list [prefix*] [page]
 
 
 class Message:
+    __slots__ = ('correctMessage', 'sender', 'command', 'nick', 'text',
+                 'handler')
+
+    # Constructor. commands maps every command to (arguments, handler); the
+    # message is parsed with a single pass over its words.
+    def __init__(self, message, sender, commands):
+        self.sender = sender
+        self.nick = None
+        self.text = None
+        self.handler = None
+        self.correctMessage = True
 
-    # Constructor.
-    def __init__(self, message, sender):
         message = message.strip()
         # If message starts with "/", assign the command, otherwise command is
         # "/say".
-        self.correctMessage = self.__checkMessageCorrect(message)
-        if self.correctMessage is False:
-            return None
-
-        self.sender = sender
-
-        # Sets the used command.
-        if message.split(" ", 1)[0].startswith("/"):
-            self.command = message.split(" ", 1)[0]
-        else:
+        if not message.startswith("/"):
             self.command = "/say"
+            self.text = message
+            self.handler = commands["/say"][1]
+            return
+        command, sep, rest = message.partition(" ")
+        self.command = command
+        entry = commands.get(command)
+        if entry is None:
+            return
+        args, self.handler = entry
 
-        if self.command == "/nick":
-            self.nick = message.split(" ")[1]
-            self.text = None
-        elif self.command == "/say":
-            self.nick = None
-            if message.startswith("/say"):
-                self.text = message.split(" ", 1)[1]
+        if args == NO_ARGS:
+            self.correctMessage = not sep
+        elif args == ANY_TEXT:
+            self.text = rest
+        elif args == TEXT:
+            self.text = rest
+            self.correctMessage = bool(sep)
+        else:
+            nick, nickSep, text = rest.partition(" ")
+            self.nick = nick
+            if args == NICK:
+                self.correctMessage = bool(sep) and not nickSep
             else:
-                self.text = message
-        elif self.command == "/whisper":
-            self.nick = message.split(" ", 2)[1]
-            self.text = message.split(" ", 2)[2]
-        elif self.command == "/list":
-            self.nick = None
-            self.text = None
-        elif self.command == "/help" or self.command == "/?":
-            self.nick = None
-            self.text = None
-        elif self.command == "/whois":
-            self.nick = message.split(" ")[1]
-            self.text = None
-        elif self.command == "/kick":
-            self.nick = message.split(" ")[1]
-            self.text = None
-        elif self.command == "/ipban":
-            self.nick = message.split(" ")[1]
-            self.text = None
-
-    # Returns False if command is invalid, True otherwise.
-    def __checkMessageCorrect(self, message):
-        if message.startswith("/nick"):
-            if len(message.split(" ", 2)) != 2:
-                return False
-        elif message.startswith("/say"):
-            if len(message.split(" ", 2)) < 2:
-                return False
-        elif message.startswith("/whisper"):
-            if len(message.split(" ", 2)) != 3:
-                return False
-        elif message.startswith("/list"):
-            if len(message.split(" ")) != 1:
-                return False
-        elif message.startswith("/help"):
-            if len(message.split(" ")) != 1:
-                return False
-        elif message.startswith("/?"):
-            if len(message.split(" ")) != 1:
-                return False
-        elif message.startswith("/whois"):
-            if len(message.split(" ", 2)) != 2:
-                return False
-        elif message.startswith("/kick"):
-            if len(message.split(" ", 2)) != 2:
-                return False
-        elif message.startswith("/ipban"):
-            if len(message.split(" ", 2)) != 2:
-                return False
-
-        return True
+                self.text = text
+                self.correctMessage = bool(nickSep)
 
     # Returns the correct message.
     def getCorrectMessage(self):
@@ -350,92 +1144,254 @@ class Message:
     def getText(self):
         return self.text
 
+    # Returns the handler of the command, None for unknown commands.
+    def getHandler(self):
+        return self.handler
 
-def serve(port, cert, key):
+
+def serve(port, cert, key, backend='default', metricsPort=None, tls=False,
+          handoffPath=None, **options):
     """
     Chat server entry point.
     port: The port to listen on.
     cert: The server public certificate.
     key: The server private key.
+    backend: The I/O backend to use, one of the keys of BACKENDS.
+    metricsPort: Local port to serve Prometheus metrics on, None to turn
+                 metrics off.
+    tls: Serves clients over TLS with the certificate and key.
+    handoffPath: Unix socket path a server started later with the same path
+                 takes this one over at. If a server listens at it already,
+                 its sockets, users and state are taken over first.
+    options: Keyword arguments for Server, e.g. the outbound buffer limits.
     """
 
+    # Takes over the sockets of the server being replaced, if there is one.
+    handoff = None
+    if handoffPath is not None:
+        handoff = requestHandoff(handoffPath)
+
     # Initialises socket.
-    server = Server(port, 20)
+    sslContext = serverContext(cert, key) if tls else None
+    server = Server(port, 20, BACKENDS[backend](),
+                    metrics=metricsPort is not None, sslContext=sslContext,
+                    listenSocket=handoff and handoff.listenSocket, **options)
+    endpoint = None
+    if metricsPort is not None:
+        endpoint = MetricsEndpoint(server, metricsPort, listenSocket=handoff
+                                   and handoff.metricsSocket)
+    elif handoff is not None and handoff.metricsSocket is not None:
+        handoff.metricsSocket.close()
+    if handoffPath is not None:
+        if handoff is not None:
+            restore(server, handoff.state, handoff.clientSockets)
+        listener = HandoffListener(server, handoffPath, endpoint)
+        if handoff is not None:
+            try:
+                handoff.confirm()
+            except OSError as e:
+                listener.discard()
+                raise SystemExit(f"handoff failed: {e}")
+        listener.publish()
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.reloadBans())
+    runUntilStopped(server)
 
-    while server.getConnectedSockets():
-        readable, writable, error = sel.select(server.getConnectedSockets(),
-                                               [], [])
 
-        for sock in readable:
+def runUntilStopped(server):
+    """
+    Runs the event loop of the server until the process is stopped with
+    SIGTERM or Ctrl-C, and closes the server then, so the messages queued for
+    the message log and the records of the capture are not lost.
+    server: The Server, or a subclass of it, to run.
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        run(server)
+    finally:
+        server.close()
+
+
+def run(server):
+    """
+    Runs the event loop of the server forever.
+    server: The Server, or a subclass of it, to run.
+    """
+
+    metrics = server.metrics
+    while True:
+        events = server.getSelector().select(server.pollTimeout())
+        server.clock.tick()
+        if metrics is not None:
+            start = time.perf_counter()
+        # Runs the timers that are due, e.g. resuming throttled clients.
+        server.timers.advance()
+
+        for key, mask in events:
+            sock = key.fileobj
+            # Runs the callback of other files registered with the selector.
+            if key.data is not None:
+                key.data(mask)
             # Adds new socket to the server and notifies users.
-            if sock is server.getServerSocket():
-                connectionSock, addr = sock.accept()
-                if addr[0] in server.bannedIps:
-                    connectionSock.close()
-                else:
-                    connectionSock.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
-                    connectionSock.setblocking(0)
-                    server.appendConnectedSockets(connectionSock)
-                    nickname = "Jochem-" + str(len(server.getOnlineUsers())+1)
-                    server.addOnlineUser(connectionSock, addr[0], nickname)
-                    mess = f"[{server.time()}] {addr[0]} connected with name "
-                    mess += f"{nickname}\n"
-                    server.sendMessageAll(mess)
+            elif sock is server.getServerSocket():
+                try:
+                    connectionSock, addr = sock.accept()
+                except (BlockingIOError, InterruptedError):
+                    continue
+                server.acceptClient(connectionSock, addr)
             else:
-                data = sock.recv(1024)
+                # Skips sockets closed by an earlier event of this wakeup.
+                conn = server.getConnection(sock)
+                if conn is None:
+                    continue
+                # Sends queued data the socket has room for now.
+                if mask & selectors.EVENT_WRITE:
+                    server.writeConnection(conn)
+                if not mask & selectors.EVENT_READ or conn.closing or \
+                        conn.throttledUntil or \
+                        sock not in server.getConnectedSockets():
+                    continue
+                try:
+                    received = conn.receive()
+                except WANT_IO + (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    received = 0
 
                 # Removes socket from the server and notifies users.
-                if not data:
-                    user = server.getUserFromSock(sock)
-                    if user is not None:
-                        name = user['nickname']
-                        # naar iedereen sturen
-                        mess = f"[{server.time()}] {name} disconnected\n"
-                        server.removeOnlineUser(user)
-                        server.removeConnectedSockets(sock)
-                        sock.close()
-                        server.sendMessageAll(mess)
-                else:
-                    data = data.decode()
-                    user = server.getUserFromSock(sock)
-                    if user is not None:
-                        sender = user['nickname']
-                        messageParsed = Message(data, sender)
-                        # Checks if message syntax is correct.
-                        if messageParsed.getCorrectMessage() is False:
-                            mess = "Incorrect syntax. Type '/?' for info.\n"
-                            server.sendMessageOne(mess, sock)
-                            continue
-                        command = messageParsed.getCommand()
-                        if command == "/say":
-                            server.handleSay(messageParsed)
-                        elif command == "/nick":
-                            server.handleNick(sock, messageParsed.getNick())
-                        elif command == "/whisper":
-                            server.handleWhisper(messageParsed, sock)
-                        elif command == "/list":
-                            server.handleList(messageParsed, sock)
-                        elif command == "/help" or command == "/?":
-                            server.handleHelp(messageParsed, sock)
-                        elif command == "/whois":
-                            server.handleWhoIs(messageParsed, sock)
-                        elif command == "/kick":
-                            server.handleKick(messageParsed, sock)
-                        elif command == "/ipban":
-                            server.handleIpBan(messageParsed, sock)
-                        else:
-                            mess = "Unknown command. Type '/?' for info.\n"
-                            server.sendMessageOne(mess, sock)
+                if not received:
+                    server.disconnectClient(sock)
+                    continue
+                if metrics is not None:
+                    metrics.bytesIn += received
+                conn.lastActive = server.timers.now
+                conn.pinged = False
+                server.processFrames(conn)
+                if server.limiter is not None and \
+                        sock in server.getConnectedSockets():
+                    delay = server.limiter.received(sock, received)
+                    if delay:
+                        server.throttle(conn, delay)
+
+        server.flushPending()
+        if metrics is not None:
+            metrics.loopSeconds.observe(time.perf_counter() - start)
 
 
 # Command line parser.
 if __name__ == '__main__':
-    import sys
     import argparse
     p = argparse.ArgumentParser()
     p.add_argument('--port', help='port to listen on', default=12345, type=int)
     p.add_argument('--cert', help='server public cert',
                    default='public_html/cert.pem')
     p.add_argument('--key', help='server private key', default='key.pem')
+    p.add_argument('--tls', help='serve clients over TLS with --cert and '
+                   '--key', action='store_true')
+    p.add_argument('--backend', help='I/O backend', default='default',
+                   choices=sorted(BACKENDS))
+    p.add_argument('--high-watermark', help='outbound bytes per client '
+                   'before the overflow policy applies', default=1 << 20,
+                   type=int)
+    p.add_argument('--low-watermark', help='outbound bytes per client to '
+                   'drain to before a paused client is read again',
+                   default=1 << 18, type=int)
+    p.add_argument('--overflow-policy', help='what to do with clients over '
+                   'the high watermark', default='pause', choices=POLICIES)
+    p.add_argument('--max-frame', help='maximum length of a message in '
+                   'bytes', default=4096, type=int)
+    p.add_argument('--engine', help='event loop running the server',
+                   default='select', choices=('select', 'asyncio', 'uvloop'))
+    p.add_argument('--timestamps', help='format of message timestamps',
+                   default='clock', choices=MODES)
+    p.add_argument('--metrics-port', help='local port to serve Prometheus '
+                   'metrics on, metrics are off without it', type=int)
+    p.add_argument('--history', help='messages kept per room, 0 turns the '
+                   'history off', default=100, type=int)
+    p.add_argument('--replay', help='messages of its history a room replays '
+                   'to users entering it', default=20, type=int)
+    p.add_argument('--log-dir', help='directory of the persistent message '
+                   'log, the log is off without it')
+    p.add_argument('--log-fsync', help='when the message log is forced to '
+                   'disk', default='batch', choices=msglog.FSYNC)
+    p.add_argument('--ban-file', help='file the IP bans are saved to and '
+                   'loaded from, reloaded on SIGHUP')
+    p.add_argument('--message-limit', help='messages per second a client '
+                   'may send, as RATE or RATE:BURST', type=parseLimit)
+    p.add_argument('--byte-limit', help='bytes per second a client may '
+                   'send, as RATE or RATE:BURST', type=parseLimit)
+    p.add_argument('--connection-limit', help='new connections per second '
+                   'from one IP address, as RATE or RATE:BURST',
+                   type=parseLimit)
+    p.add_argument('--address-share', help='multiple of the message and '
+                   'byte limits of a client that all clients of one IP '
+                   'address get together', default=4, type=float)
+    p.add_argument('--idle-timeout', help='seconds a client may be silent '
+                   'before it is disconnected', type=float)
+    p.add_argument('--ping-interval', help='seconds of silence after which '
+                   'a client is sent a PING, it is disconnected if it stays '
+                   'silent for as long again', type=float)
+    p.add_argument('--handshake-timeout', help='seconds a client gets for '
+                   'its TLS handshake', default=10, type=float)
+    p.add_argument('--workers', help='number of worker processes sharing '
+                   'the port', default=1, type=int)
+    p.add_argument('--handoff', help='Unix socket path for reloads: a server '
+                   'started with the same path takes over the port and the '
+                   'connected clients of the one running')
+    p.add_argument('--capture', help='file to record the connections and '
+                   'received messages to, for replay.py')
+    p.add_argument('--cluster', help='bus address of the hub of a cluster '
+                   'to join as a node, tcp://HOST:PORT or unix://PATH, see '
+                   'shard.py')
     args = p.parse_args(sys.argv[1:])
-    serve(args.port, args.cert, args.key)
+    if args.workers > 1 and args.engine != 'select':
+        p.error('--workers only works with the select engine')
+    if args.handoff is not None and \
+            (args.workers > 1 or args.engine != 'select'):
+        p.error('--handoff only works with the select engine and one worker')
+    if args.capture is not None and \
+            (args.workers > 1 or args.handoff is not None):
+        p.error('--capture only works with one worker, without --handoff')
+    if args.cluster is not None:
+        import shard
+        if args.workers > 1 or args.engine != 'select' or \
+                args.handoff is not None:
+            p.error('--cluster only works with the select engine and one '
+                    'worker, without --handoff')
+        try:
+            transport = shard.parseBusAddress(args.cluster)
+        except ValueError as e:
+            p.error(str(e))
+    options = dict(highWatermark=args.high_watermark,
+                   lowWatermark=args.low_watermark,
+                   overflowPolicy=args.overflow_policy,
+                   maxFrame=args.max_frame,
+                   timestampMode=args.timestamps,
+                   historySize=args.history,
+                   replaySize=args.replay,
+                   logDir=args.log_dir,
+                   logFsync=args.log_fsync,
+                   banFile=args.ban_file,
+                   messageLimit=args.message_limit,
+                   byteLimit=args.byte_limit,
+                   connectionLimit=args.connection_limit,
+                   addressShare=args.address_share,
+                   idleTimeout=args.idle_timeout,
+                   pingInterval=args.ping_interval,
+                   handshakeTimeout=args.handshake_timeout,
+                   capturePath=args.capture)
+    if args.cluster is not None:
+        shard.serveNode(args.port, args.cert, args.key, transport,
+                        args.backend, args.metrics_port, args.tls, **options)
+    elif args.workers > 1:
+        import shard
+        shard.serve(args.port, args.cert, args.key, args.backend,
+                    args.workers, args.metrics_port, args.tls, **options)
+    elif args.engine == 'select':
+        serve(args.port, args.cert, args.key, args.backend, args.metrics_port,
+              args.tls, args.handoff, **options)
+    else:
+        import aioserver
+        aioserver.serve(args.port, args.cert, args.key, args.backend,
+                        args.engine == 'uvloop', args.metrics_port, args.tls,
+                        **options)
@@ -1,51 +1,57 @@
 from threading import Thread
 from gui import MainWindow
-import socket as s
-import select as sel
+from aioclient import ChatConnection
+import asyncio
 
 
 class ChatClient(Thread):
-    def __init__(self, port, ip, window):
+    """
+    Connects the window to the chat server. The connection runs on an
+    asyncio event loop in this thread and the window is one consumer of its
+    incoming lines.
+    """
+
+    def __init__(self, port, ip, window, sslContext=None):
         """
         port: port to connect to.
-        cert: public certificate (task 3)
-        ip: IP to bind to (task 3)
+        ip: IP of the server.
+        window: the MainWindow to show the messages in.
+        sslContext: the TLS context to connect with, None for plaintext.
         """
-        super().__init__()
+        super().__init__(daemon=True)
 
         self.window = window
-        self.port = port
-        self.ip = ip
-
-        self.wake_socket = self.window.wake_thread
-        self.socket = s.socket(s.AF_INET, s.SOCK_STREAM)
-        self.socket.connect((ip, port))
+        self.loop = asyncio.new_event_loop()
+        self.connection = ChatConnection(ip, port, ssl=sslContext)
+        self.connection.onDisconnect = self.disconnected
 
     def run(self):
-        while not self.window.quit_event.is_set():
-            try:
-                readable, _, _ = sel.select([self.socket, self.wake_socket],
-                                            [], [])
-                for sock in readable:
-                    if sock is self.wake_socket:
-                        self.socket.close()
-                        exit(0)
-                    data = sock.recv(1024)
-                    if data:
-                        self.window.write(data.decode())
-                    else:
-                        sock.close()
-            except Exception:
-                self.socket.close()
-                break
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self.receive())
+        self.loop.close()
+
+    async def receive(self):
+        await self.connection.start()
+        async for line in self.connection:
+            self.window.writeln(line)
+
+    def disconnected(self, exc, delay):
+        mess = "Disconnected. You might have been kicked or IP banned."
+        mess += f" Reconnecting in {delay:.1f} seconds."
+        self.window.writeln(mess)
 
     def text_entered(self, line):
+        self.loop.call_soon_threadsafe(self.send, line)
+
+    def send(self, line):
         try:
-            self.socket.send(line.encode())
-        except Exception:
-            mess = "Cannot send message. You might have been kicked or IP"
-            mess += " banned."
-            self.window.writeln(mess)
+            self.connection.sendNowait(line)
+        except ConnectionError:
+            self.window.writeln("Cannot send message, the connection is "
+                                "closed.")
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.connection.close)
 
 
 # Command line argument parser.
@@ -57,10 +63,19 @@ if __name__ == '__main__':
     p.add_argument('--port', help='port to connect to',
                    default=12345, type=int)
     p.add_argument('--ip', help='IP to bind to', default='127.0.0.1', type=str)
+    p.add_argument('--scrollback', help='lines kept in the window',
+                   default=5000, type=int)
+    p.add_argument('--tls', help='connect over TLS', action='store_true')
+    p.add_argument('--cafile', help='CA certificates to check the server '
+                   'certificate against, e.g. its own self-signed one')
     args = p.parse_args(sys.argv[1:])
 
-    w = MainWindow()
-    client = ChatClient(args.port, args.ip, w)
+    sslContext = None
+    if args.tls:
+        from tls import clientContext
+        sslContext = clientContext(args.cafile)
+    w = MainWindow(scrollback=args.scrollback)
+    client = ChatClient(args.port, args.ip, w, sslContext)
     w.set_client(client)
     client.start()
     w.start()
@@ -0,0 +1,39 @@
+import time
+
+# Formats of the timestamps in messages.
+# clock: Local wall clock time as HH:MM:SS.
+# epoch-ms: Milliseconds since the Unix epoch, for machine clients.
+# monotonic: Milliseconds of the monotonic clock, for latency measurements.
+MODES = ('clock', 'epoch-ms', 'monotonic')
+
+
+class Clock:
+    """
+    The timestamp for messages. The event loop calls tick once per
+    iteration, and the clock format is only rendered when the second
+    changes, so handlers just read the cached string.
+    """
+
+    # Constructor.
+    def __init__(self, mode='clock'):
+        if mode not in MODES:
+            raise ValueError(f"unknown timestamp mode {mode}")
+        self.mode = mode
+        self.second = None
+        self.stamp = ''
+        # Milliseconds since the epoch, the timestamp of binary messages.
+        self.millis = 0
+        self.tick()
+
+    # Updates the timestamp.
+    def tick(self):
+        self.millis = time.time_ns() // 1000000
+        if self.mode == 'clock':
+            second = self.millis // 1000
+            if second != self.second:
+                self.second = second
+                self.stamp = time.strftime("%H:%M:%S", time.localtime(second))
+        elif self.mode == 'epoch-ms':
+            self.stamp = str(self.millis)
+        else:
+            self.stamp = str(time.monotonic_ns() // 1000000)
@@ -0,0 +1,226 @@
+import collections
+import itertools
+import os
+import selectors
+import ssl
+
+from framing import LineFramer
+from tls import WANT_IO
+
+# Policies for clients whose outbound buffer stays over the high watermark.
+# drop: Drops the oldest queued messages until the buffer fits again.
+# disconnect: Disconnects the client.
+# pause: Stops reading from the client until its buffer drains below the low
+#        watermark. A paused client whose buffer keeps growing past
+#        PAUSE_LIMIT times the high watermark is disconnected.
+POLICIES = ('drop', 'disconnect', 'pause')
+PAUSE_LIMIT = 4
+
+# Maximum number of buffers written with a single sendmsg call.
+try:
+    IOV_MAX = min(os.sysconf('SC_IOV_MAX'), 1024)
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+# Maximum number of bytes written with a single write to a TLS socket, which
+# has no sendmsg. Small messages are joined to fill one TLS record instead of
+# being encrypted and sent one by one.
+TLS_WRITE = 1 << 14
+
+
+class Connection:
+
+    # Constructor.
+    def __init__(self, sock, highWatermark=1 << 20, lowWatermark=1 << 18,
+                 policy='pause', maxFrame=4096):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy {policy}")
+        if lowWatermark > highWatermark:
+            raise ValueError("low watermark is above the high watermark")
+        self.sock = sock
+        self.tls = isinstance(sock, ssl.SSLSocket)
+        self.highWatermark = highWatermark
+        self.lowWatermark = lowWatermark
+        self.policy = policy
+
+        # Splits the received bytes into messages, and whether the client
+        # switched to the binary protocol, with a compressor if it is
+        # compressed.
+        self.framer = LineFramer(maxFrame)
+        self.binary = False
+        self.compressor = None
+
+        # Queue of outbound byte strings and the number of queued bytes. The
+        # first entry may be partially sent already, headOffset bytes of it
+        # have been written to the socket.
+        self.outbound = collections.deque()
+        self.outboundSize = 0
+        self.headOffset = 0
+        # Data of a TLS write that has to be repeated with the same bytes
+        # once the socket is ready. It is not in outbound anymore but still
+        # counted in outboundSize.
+        self.retry = None
+
+        # The events the socket is registered for, whether reading is paused
+        # because of backpressure, the monotonic time until which reading is
+        # paused by the rate limiter (0 if it is not) and whether the
+        # connection closes once the outbound buffer is empty.
+        self.events = 0
+        self.paused = False
+        self.throttledUntil = 0
+        self.closing = False
+
+        # The timer that resumes reading after the rate limiter paused it,
+        # the monotonic time the client was last heard from, whether it was
+        # sent a PING since, the timer checking that it is still there and
+        # the timer dropping it if it does not drain while closing.
+        self.resumeTimer = None
+        self.lastActive = 0
+        self.pinged = False
+        self.activityTimer = None
+        self.lingerTimer = None
+
+    # Returns the socket of the connection.
+    def getSocket(self):
+        return self.sock
+
+    # Returns the number of bytes waiting to be sent.
+    def getOutboundSize(self):
+        return self.outboundSize
+
+    # Returns True if there are bytes waiting to be sent.
+    def hasOutbound(self):
+        return self.outboundSize > 0
+
+    # Receives data from the socket into the framer. Returns the number of
+    # bytes received, 0 if the peer closed the connection. A TLS socket may
+    # hold decrypted data that did not fit in the receive buffer, which the
+    # selector does not report, so that is received as well.
+    def receive(self):
+        received = self.framer.receive(self.sock)
+        if self.tls:
+            while received and self.sock.pending():
+                received += self.framer.receive(self.sock)
+        return received
+
+    # Queues data to be sent. Returns False if the client went over its limit
+    # and has to be disconnected, True otherwise.
+    def queue(self, data):
+        if not data:
+            return True
+        self.outbound.append(data)
+        self.outboundSize += len(data)
+        if self.outboundSize <= self.highWatermark:
+            return True
+
+        if self.policy == 'drop' and self.compressor is None:
+            self.__dropOldest()
+        elif self.policy == 'pause':
+            self.paused = True
+            if self.outboundSize > PAUSE_LIMIT * self.highWatermark:
+                return False
+        else:
+            # A compressed stream cannot skip what it refers back to, so a
+            # compressed client is disconnected instead of dropped from.
+            return False
+        return True
+
+    # Drops the oldest queued messages until the buffer is under the high
+    # watermark. The partially sent head and the newest message are kept so
+    # the client never receives a truncated message.
+    def __dropOldest(self):
+        keepHead = 1 if self.headOffset else 0
+        while self.outboundSize > self.highWatermark and \
+                len(self.outbound) > keepHead + 1:
+            if keepHead:
+                head = self.outbound.popleft()
+                dropped = self.outbound.popleft()
+                self.outbound.appendleft(head)
+            else:
+                dropped = self.outbound.popleft()
+            self.outboundSize -= len(dropped)
+
+    # Writes as much of the outbound buffer as the socket accepts. Pending
+    # messages are written together with one sendmsg call where the socket
+    # supports it. Returns the number of bytes written. Socket errors other
+    # than a full send buffer are raised to the caller.
+    def flush(self):
+        if self.tls:
+            return self.__flushTLS()
+        written = 0
+        sendmsg = getattr(self.sock, 'sendmsg', None)
+        while self.outbound:
+            if sendmsg is not None and len(self.outbound) > 1:
+                buffers = list(itertools.islice(self.outbound, IOV_MAX))
+            else:
+                buffers = [self.outbound[0]]
+            if self.headOffset:
+                buffers[0] = memoryview(buffers[0])[self.headOffset:]
+            wanted = sum(map(len, buffers))
+            try:
+                if len(buffers) > 1:
+                    sent = sendmsg(buffers)
+                else:
+                    sent = self.sock.send(buffers[0])
+            except (BlockingIOError, InterruptedError):
+                break
+            written += sent
+            self.outboundSize -= sent
+
+            # Pops the buffers that were sent completely.
+            consumed = self.headOffset + sent
+            while self.outbound and consumed >= len(self.outbound[0]):
+                consumed -= len(self.outbound.popleft())
+            self.headOffset = consumed
+
+            # Stops once the socket did not take everything it was offered.
+            if sent < wanted:
+                break
+
+        if self.paused and self.outboundSize <= self.lowWatermark:
+            self.paused = False
+        return written
+
+    # Writes the outbound buffer to a TLS socket in writes of up to
+    # TLS_WRITE bytes. A write that has to wait is repeated with the same
+    # data, as OpenSSL requires.
+    def __flushTLS(self):
+        written = 0
+        while self.retry is not None or self.outbound:
+            if self.retry is None:
+                self.retry = self.__takeOutbound(TLS_WRITE)
+            try:
+                sent = self.sock.send(self.retry)
+            except WANT_IO + (BlockingIOError, InterruptedError):
+                break
+            self.retry = None
+            written += sent
+            self.outboundSize -= sent
+
+        if self.paused and self.outboundSize <= self.lowWatermark:
+            self.paused = False
+        return written
+
+    # Removes up to limit bytes from the front of the outbound buffer and
+    # returns them joined. Returns at least the first buffer.
+    def __takeOutbound(self, limit):
+        buffers = []
+        size = 0
+        while self.outbound and (not buffers or
+                                 size + len(self.outbound[0]) <= limit):
+            data = self.outbound.popleft()
+            if self.headOffset:
+                data = data[self.headOffset:]
+                self.headOffset = 0
+            buffers.append(data)
+            size += len(data)
+        return b''.join(buffers)
+
+    # Returns the selector events the connection is interested in.
+    def wantedEvents(self):
+        events = 0
+        if not self.paused and not self.throttledUntil and not self.closing:
+            events |= selectors.EVENT_READ
+        if self.outbound or self.retry is not None:
+            events |= selectors.EVENT_WRITE
+        return events
@@ -0,0 +1,189 @@
+import struct
+
+
+# Raised when a stream contains a frame that cannot be parsed.
+class FrameError(ValueError):
+    pass
+
+
+# Longest varint accepted, enough for any 64 bit number.
+MAX_VARINT = 10
+
+
+# Returns n as a varint: 7 bits per byte, least significant first, with the
+# high bit set on every byte but the last. Numbers below 128 take one byte.
+def encodeVarint(n):
+    if n < 0x80:
+        return bytes((n,))
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7f | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+# Returns the varint at start in data and the offset after it, or None if
+# data ends before the varint does. Raises FrameError if the varint is
+# longer than MAX_VARINT bytes.
+def decodeVarint(data, start=0):
+    value = shift = 0
+    for i in range(start, min(len(data), start + MAX_VARINT)):
+        byte = data[i]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, i + 1
+        shift += 7
+    if len(data) - start >= MAX_VARINT:
+        raise FrameError("varint is too long")
+    return None
+
+
+class LineFramer:
+    """
+    Splits the byte stream of a connection into newline delimited messages.
+    Data is received into a reusable buffer with recv_into and complete lines
+    are decoded as UTF-8. Because a line ends at a newline byte, a multibyte
+    character split over two reads is decoded once its line is complete.
+    """
+
+    # Constructor.
+    def __init__(self, maxFrame=4096, recvSize=4096):
+        self.maxFrame = maxFrame
+        self.recvBuffer = bytearray(recvSize)
+        self.recvView = memoryview(self.recvBuffer)
+        # Received bytes that are not part of a complete line yet.
+        self.pending = bytearray()
+        # Set while the rest of an oversized line is skipped.
+        self.discarding = False
+
+    # Receives data from the socket into the framer. Returns the number of
+    # bytes received, 0 if the peer closed the connection.
+    def receive(self, sock):
+        received = sock.recv_into(self.recvView)
+        if received:
+            self.pending += self.recvView[:received]
+        return received
+
+    # Adds data that was received by other means.
+    def feed(self, data):
+        self.pending += data
+
+    # Yields every complete line as a string without the line ending. Yields
+    # None in place of a line longer than the maximum frame size.
+    def frames(self):
+        pending = self.pending
+        start = 0
+        try:
+            while True:
+                end = pending.find(b'\n', start)
+                if end == -1:
+                    break
+                # Counts the line as consumed before the caller sees it.
+                lineStart, start = start, end + 1
+                if self.discarding:
+                    self.discarding = False
+                elif end - lineStart > self.maxFrame:
+                    yield None
+                else:
+                    yield pending[lineStart:end].decode('utf-8', 'replace') \
+                        .rstrip('\r')
+        finally:
+            if start:
+                del pending[:start]
+
+        if len(pending) > self.maxFrame:
+            pending.clear()
+            if not self.discarding:
+                self.discarding = True
+                yield None
+
+
+class LengthFramer:
+    """
+    Splits a byte stream into frames that are prefixed with their length as a
+    4 byte big endian integer. Yields the frames as bytes.
+    """
+
+    HEADER = struct.Struct('!I')
+
+    # Constructor.
+    def __init__(self, maxFrame=1 << 24, recvSize=1 << 16):
+        self.maxFrame = maxFrame
+        self.recvBuffer = bytearray(recvSize)
+        self.recvView = memoryview(self.recvBuffer)
+        self.pending = bytearray()
+
+    # Returns the frame for the given payload.
+    @classmethod
+    def encode(cls, payload):
+        return cls.HEADER.pack(len(payload)) + payload
+
+    # Receives data from the socket into the framer. Returns the number of
+    # bytes received, 0 if the peer closed the connection.
+    def receive(self, sock):
+        received = sock.recv_into(self.recvView)
+        if received:
+            self.pending += self.recvView[:received]
+        return received
+
+    # Adds data that was received by other means.
+    def feed(self, data):
+        self.pending += data
+
+    # Yields every complete frame. Raises FrameError if a frame is longer
+    # than the maximum frame size, the stream cannot be resynchronised then.
+    def frames(self):
+        pending = self.pending
+        size = self.HEADER.size
+        start = 0
+        try:
+            while len(pending) - start >= size:
+                length, = self.HEADER.unpack_from(pending, start)
+                if length > self.maxFrame:
+                    raise FrameError(f"frame of {length} bytes is too long")
+                end = start + size + length
+                if end > len(pending):
+                    break
+                # Counts the frame as consumed before the caller sees it.
+                start = end
+                yield bytes(pending[end - length:end])
+        finally:
+            if start:
+                del pending[:start]
+
+
+class VarintFramer(LengthFramer):
+    """
+    Splits a byte stream into frames that are prefixed with their length as a
+    varint, one byte for frames of up to 127 bytes and two for frames of up
+    to 16383 bytes. Yields the frames as bytes.
+    """
+
+    # Returns the frame for the given payload.
+    @classmethod
+    def encode(cls, payload):
+        return encodeVarint(len(payload)) + payload
+
+    # Yields every complete frame. Raises FrameError if a frame is longer
+    # than the maximum frame size, the stream cannot be resynchronised then.
+    def frames(self):
+        pending = self.pending
+        start = 0
+        try:
+            while start < len(pending):
+                header = decodeVarint(pending, start)
+                if header is None:
+                    break
+                length, begin = header
+                if length > self.maxFrame:
+                    raise FrameError(f"frame of {length} bytes is too long")
+                end = begin + length
+                if end > len(pending):
+                    break
+                # Counts the frame as consumed before the caller sees it.
+                start = end
+                yield bytes(pending[begin:end])
+        finally:
+            if start:
+                del pending[:start]
@@ -2,30 +2,30 @@ import tkinter as tk
 import tkinter.scrolledtext as tkst
 
 import sys
-import os
 import queue
 import threading
 
 
 class MainWindow:
 
-    def __init__(self, master=None, client=None):
+    def __init__(self, master=None, client=None, scrollback=5000, tick=50):
+        """
+        scrollback: number of lines the text box keeps.
+        tick: milliseconds between updates of the text box.
+        """
         master = master or tk.Tk()
         self._master = master
 
-        # Create queue for communication between GUI and client thread
-        self.write_queue = queue.Queue()
-        self.write_event = '<<message>>'
-        self._master.bind(self.write_event, self._process_write)
+        # Create queue for communication between GUI and client thread. The
+        # queued text is written to the text box once per tick.
+        self.write_queue = queue.SimpleQueue()
+        self._scrollback = scrollback
+        self._tick = tick
 
         self._master.protocol("WM_DELETE_WINDOW", self._on_close_window)
 
         self.quit_event = threading.Event()
 
-        self.wake_thread, self.write_wake_thread = os.pipe()
-        self.wake_thread = os.fdopen(self.wake_thread, 'r')
-        self.write_wake_thread = os.fdopen(self.write_wake_thread, 'w')
-
         # Set initial state
         self._line = ""
         self._client = client
@@ -71,6 +71,8 @@ class MainWindow:
         master.minsize(master.winfo_width(), master.winfo_height())
         master.geometry("500x350")
 
+        self._master.after(self._tick, self._process_write)
+
     def start(self):
         self._master.lift()
         self._master.mainloop()
@@ -87,17 +89,37 @@ class MainWindow:
 
     def write(self, text):
         """
-        Writes a string to the text box.
+        Writes a string to the text box on the next tick. Can be called from
+        any thread.
         """
         self.write_queue.put(text)
-        self._master.event_generate(self.write_event, when='tail')
 
-    def _process_write(self, event):
-        while not self.write_queue.empty():
+    def _process_write(self):
+        # Writes everything queued since the last tick with one insert.
+        chunks = []
+        try:
+            while True:
+                chunks.append(self.write_queue.get_nowait())
+        except queue.Empty:
+            pass
+        if chunks:
+            text = ''.join(chunks)
+            # Only the last lines of a large batch would survive the trim.
+            if text.count('\n') > self._scrollback:
+                text = '\n'.join(text.split('\n')[-self._scrollback - 1:])
             self._txtlog.config(state='normal')
-            self._txtlog.insert(tk.END, self.write_queue.get())
-            self._txtlog.yview(tk.END)
+            self._txtlog.insert(tk.END, text)
+            self._trim()
             self._txtlog.config(state='disabled')
+            self._txtlog.yview(tk.END)
+        self._master.after(self._tick, self._process_write)
+
+    def _trim(self):
+        # Deletes the oldest lines above the scrollback limit. The text box
+        # always ends with an empty line after the last newline.
+        lines = int(self._txtlog.index('end-1c').split('.')[0]) - 1
+        if lines > self._scrollback:
+            self._txtlog.delete('1.0', f'{lines - self._scrollback + 1}.0')
 
     def writeln(self, text):
         """
@@ -127,8 +149,8 @@ class MainWindow:
 
     def _on_close_window(self):
         self.quit_event.set()
-        self.write_wake_thread.write(' ')
-        self.write_wake_thread.flush()
+        if self._client is not None:
+            self._client.close()
         sys.exit()
 
 
@@ -0,0 +1,283 @@
+import os
+import pickle
+import selectors
+import socket as s
+import struct
+import sys
+import time
+import zlib
+
+from protocol import Event
+
+# File descriptors passed per message, below the SCM_RIGHTS limit of Linux.
+MAX_FDS = 250
+
+# Bytes of the pickled state sent per message.
+CHUNK = 1 << 16
+
+# Kinds of handoff messages, the first byte of every message.
+FDS = b'F'
+STATE = b'S'
+END = b'E'
+OK = b'OK'
+
+
+# Raised when a handoff cannot be completed.
+class HandoffError(Exception):
+    pass
+
+
+# Raises HandoffError unless the peer of the Unix socket runs as the same
+# user, the handoff gives it every client socket. Without SO_PEERCRED only
+# the permissions of the socket file protect it.
+def checkPeer(sock):
+    if not hasattr(s, 'SO_PEERCRED'):
+        return
+    creds = sock.getsockopt(s.SOL_SOCKET, s.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    if uid != os.getuid():
+        raise HandoffError(f"handoff peer runs as uid {uid}")
+
+
+# Returns the state of the server and the sockets it needs to continue:
+# the listening sockets followed by one socket per client. TLS clients are
+# disconnected first, their session cannot leave the process, and what can
+# be written to the clients now is written.
+def snapshot(server, metricsEndpoint=None):
+    for sock, conn in list(server.getConnectedSockets().items()):
+        if conn.tls:
+            server.disconnectClient(sock)
+    server.flushPending()
+
+    socks = [server.getServerSocket()]
+    if metricsEndpoint is not None:
+        socks.append(metricsEndpoint.listenSocket)
+    connections = []
+    now = time.monotonic()
+    for sock, conn in list(server.getConnectedSockets().items()):
+        user = server.getUserFromSock(sock)
+        if user is None or conn.closing:
+            continue
+        outbound = list(conn.outbound)
+        if outbound and conn.headOffset:
+            outbound[0] = outbound[0][conn.headOffset:]
+        connections.append({
+            'address': user.address,
+            'nickname': user.nickname,
+            'rooms': list(user.rooms),
+            'room': user.room,
+            'pending': bytes(conn.framer.pending),
+            'discarding': getattr(conn.framer, 'discarding', False),
+            'binary': conn.binary,
+            'compressed': conn.compressor is not None,
+            'outbound': b''.join(outbound),
+            'throttle': max(0, conn.throttledUntil - now)
+            if conn.throttledUntil else 0,
+            'limits': server.limiter.socketState(sock)
+            if server.limiter is not None else {},
+        })
+        socks.append(sock)
+
+    history = {room: [(event.pack(), event.stamp)
+                      for event in ring.last(len(ring))]
+               for room, ring in server.history.rooms.items()}
+    state = {'metrics': metricsEndpoint is not None,
+             'bans': server.bans.entries(),
+             'history': history,
+             'connections': connections}
+    return state, socks
+
+
+# Gives the server the state and client sockets of the server it takes
+# over from. The clients are added as they were, without notices.
+def restore(server, state, socks):
+    server.bans.clear()
+    for network, expires in state['bans']:
+        server.bans.add(network, expires)
+    for room, events in state['history'].items():
+        for packed, stamp in events:
+            server.history.add(room, Event.unpack(packed, stamp))
+
+    restored = []
+    for record, sock in zip(state['connections'], socks):
+        server.appendConnectedSockets(sock)
+        conn = server.getConnection(sock)
+        if server.limiter is not None:
+            server.limiter.restore(sock, record['address'],
+                                   record['limits'])
+        if record['binary']:
+            server.switchProtocol(conn, False)
+            if record['compressed']:
+                # A raw deflate stream continues the stream of the old
+                # compressor, which was flushed after every message.
+                conn.compressor = zlib.compressobj(wbits=-zlib.MAX_WBITS)
+        else:
+            conn.framer.discarding = record['discarding']
+        conn.framer.feed(record['pending'])
+        user = server.addOnlineUser(sock, record['address'],
+                                    record['nickname'])
+        for room in record['rooms']:
+            server.addToRoom(user, room)
+        if record['room'] is not None:
+            server.addToRoom(user, record['room'])
+        if record['outbound']:
+            server.queueData(record['outbound'], sock)
+        server.watchActivity(sock)
+        if record['throttle']:
+            server.throttle(conn, record['throttle'])
+        restored.append(conn)
+
+    # Handles the complete messages the old server received but did not get
+    # to, once every user is back.
+    for conn in restored:
+        if not conn.throttledUntil and \
+                conn.getSocket() in server.getConnectedSockets():
+            server.processFrames(conn)
+
+
+# Sends the state and the sockets over the Unix socket.
+def sendState(sock, state, socks):
+    fds = [fd.fileno() for fd in socks]
+    for start in range(0, len(fds), MAX_FDS):
+        s.send_fds(sock, [FDS], fds[start:start + MAX_FDS])
+    data = pickle.dumps(state, pickle.HIGHEST_PROTOCOL)
+    for start in range(0, len(data), CHUNK):
+        sock.sendall(STATE + data[start:start + CHUNK])
+    sock.sendall(END)
+
+
+# Receives the state and the sockets sent with sendState. Returns the state
+# and the file descriptors.
+def receiveState(sock):
+    fds = []
+    chunks = []
+    while True:
+        data, received, flags, _ = s.recv_fds(sock, CHUNK + 1, MAX_FDS)
+        fds.extend(received)
+        if flags & s.MSG_CTRUNC:
+            raise HandoffError("file descriptors were truncated")
+        if not data:
+            raise HandoffError("the old server closed the handoff")
+        if data[:1] == STATE:
+            chunks.append(data[1:])
+        elif data[:1] == END:
+            return pickle.loads(b''.join(chunks)), fds
+
+
+class Handoff:
+    """
+    The state and sockets received from the server that is taken over. The
+    old server keeps its sockets open, without reading from them, until the
+    new server confirms it took over.
+    """
+
+    # Constructor.
+    def __init__(self, sock, state, fds):
+        self.sock = sock
+        self.state = state
+        self.listenSocket = s.socket(fileno=fds[0])
+        self.metricsSocket = None
+        if state['metrics']:
+            self.metricsSocket = s.socket(fileno=fds[1])
+        self.clientSockets = [s.socket(fileno=fd)
+                              for fd in fds[1 + state['metrics']:]]
+
+    # Tells the old server to exit.
+    def confirm(self):
+        self.sock.sendall(OK)
+        self.sock.close()
+
+
+# Asks the server listening for successors at path to hand over. Returns the
+# Handoff, or None if no server listens at path.
+def requestHandoff(path, timeout=30):
+    sock = s.socket(s.AF_UNIX, s.SOCK_SEQPACKET)
+    try:
+        sock.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    sock.settimeout(timeout)
+    checkPeer(sock)
+    state, fds = receiveState(sock)
+    return Handoff(sock, state, fds)
+
+
+class HandoffListener:
+    """
+    Listens for a new server process at a Unix socket path from the event
+    loop of the select engine. A new process started with the same path
+    connects to it, receives the listening socket, the client sockets and
+    the state of the server, and confirms once it serves the clients; this
+    process exits then. If the new process does not confirm this process
+    carries on.
+    """
+
+    # Constructor. The socket is bound at a temporary path next to path,
+    # so a server that still listens at path keeps it until publish moves
+    # the socket there.
+    def __init__(self, server, path, metricsEndpoint=None, timeout=30):
+        self.server = server
+        self.path = path
+        self.metricsEndpoint = metricsEndpoint
+        self.timeout = timeout
+        self.boundPath = f"{path}.{os.getpid()}"
+        if os.path.exists(self.boundPath):
+            os.unlink(self.boundPath)
+        self.listenSocket = s.socket(s.AF_UNIX, s.SOCK_SEQPACKET)
+        self.listenSocket.bind(self.boundPath)
+        os.chmod(self.boundPath, 0o600)
+        self.listenSocket.listen(1)
+        self.listenSocket.setblocking(0)
+        server.getSelector().register(self.listenSocket,
+                                      selectors.EVENT_READ, self.onAccept)
+
+    # Moves the socket to path, replacing the socket of the server taken
+    # over from, once it confirmed. New processes connect to this one then.
+    def publish(self):
+        os.rename(self.boundPath, self.path)
+        self.boundPath = self.path
+
+    # Closes the socket and removes it if it was not published.
+    def discard(self):
+        self.server.getSelector().unregister(self.listenSocket)
+        self.listenSocket.close()
+        if self.boundPath != self.path:
+            os.unlink(self.boundPath)
+
+    # Hands the server over to the process that connected. The event loop
+    # waits meanwhile, so no client is read from or written to.
+    def onAccept(self, mask):
+        try:
+            sock, _ = self.listenSocket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        with sock:
+            try:
+                sock.settimeout(self.timeout)
+                checkPeer(sock)
+                state, socks = snapshot(self.server, self.metricsEndpoint)
+                sendState(sock, state, socks)
+                confirmed = sock.recv(len(OK)) == OK
+            except (OSError, HandoffError) as e:
+                print(f"handoff failed: {e}", file=sys.stderr)
+                return
+        if not confirmed:
+            print("handoff failed: the new server did not confirm",
+                  file=sys.stderr)
+            return
+        self.retire()
+
+    # Closes this process' copies of the sockets and exits. The connections
+    # stay open in the new process. The path belongs to the new process.
+    def retire(self):
+        server = self.server
+        server.close()
+        for sock in list(server.getConnectedSockets()):
+            sock.close()
+        server.getServerSocket().close()
+        if self.metricsEndpoint is not None:
+            self.metricsEndpoint.listenSocket.close()
+        self.listenSocket.close()
+        raise SystemExit(0)
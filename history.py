@@ -0,0 +1,63 @@
+class RingBuffer:
+    """
+    A fixed number of slots that are reused in turn, so appending never
+    allocates and the oldest item is overwritten once the buffer is full.
+    """
+
+    __slots__ = ('slots', 'next', 'count')
+
+    # Constructor.
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.next = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, item):
+        self.slots[self.next] = item
+        self.next = (self.next + 1) % len(self.slots)
+        if self.count < len(self.slots):
+            self.count += 1
+
+    # Returns a list of the last n items, oldest first.
+    def last(self, n):
+        n = max(0, min(n, self.count))
+        start = (self.next - n) % len(self.slots)
+        if start + n <= len(self.slots):
+            return self.slots[start:start + n]
+        return self.slots[start:] + self.slots[:self.next]
+
+
+class History:
+    """
+    The last messages of every room as the events that were sent, which keep
+    their encodings, so they are replayed without formatting or encoding
+    them again. Every room keeps at most size messages.
+    """
+
+    # Constructor. A size of 0 turns the history off.
+    def __init__(self, size=100):
+        self.size = size
+        self.rooms = {}
+
+    # Adds a message to the history of the room.
+    def add(self, room, message):
+        if not self.size:
+            return
+        ring = self.rooms.get(room)
+        if ring is None:
+            ring = self.rooms[room] = RingBuffer(self.size)
+        ring.append(message)
+
+    # Returns the last n messages of the room, oldest first.
+    def last(self, room, n):
+        ring = self.rooms.get(room)
+        if ring is None:
+            return []
+        return ring.last(n)
+
+    # Drops the history of the room.
+    def forget(self, room):
+        self.rooms.pop(room, None)
@@ -0,0 +1,366 @@
+import errno
+import json
+import random
+import selectors
+import socket as s
+import time
+
+# Default share of every command in the generated messages.
+MIX = {'say': 70, 'whisper': 20, 'nick': 5, 'list': 5}
+
+# Marks generated messages, followed by the kind, the sending client, a
+# sequence number and the send time in nanoseconds.
+TAG = b' lg '
+
+# Connections that may wait for their welcome at the same time, below the
+# listen backlog of the server.
+CONNECT_BATCH = 16
+
+
+# Returns a command mix parsed from "say=70,whisper=20,...". Raises
+# ValueError for unknown commands or weights.
+def parseMix(text):
+    mix = {}
+    for part in text.split(','):
+        command, _, weight = part.partition('=')
+        if command not in MIX or not weight:
+            raise ValueError(f"invalid mix entry {part}")
+        mix[command] = float(weight)
+    if sum(mix.values()) <= 0:
+        raise ValueError("the mix needs a positive weight")
+    return mix
+
+
+# Returns the count, percentiles and maximum of a list of latencies.
+def summarize(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(pct):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * pct / 100))
+        return round(latencies[index], 3)
+
+    return {'count': len(latencies), 'p50': percentile(50),
+            'p90': percentile(90), 'p99': percentile(99),
+            'p999': percentile(99.9),
+            'max': round(latencies[-1], 3) if latencies else None}
+
+
+class SimClient:
+    __slots__ = ('index', 'sock', 'nickname', 'buffer', 'outbound',
+                 'connectStart', 'ready', 'renames', 'pendingNick',
+                 'pendingLists')
+
+    # Constructor.
+    def __init__(self, index):
+        self.index = index
+        self.sock = None
+        self.renames = 0
+        self.reset()
+
+    # Forgets the state of the previous connection.
+    def reset(self):
+        self.nickname = None
+        self.buffer = b''
+        self.outbound = b''
+        self.connectStart = 0
+        self.ready = False
+        self.pendingNick = None
+        self.pendingLists = []
+
+
+class LoadGenerator:
+    """
+    Drives many simulated clients from one thread over one selector. Messages
+    are sent open loop at a fixed total rate by random clients, following
+    the command mix. Generated /say and /whisper messages carry their send
+    time, so the client that receives one measures its delivery latency.
+    """
+
+    # Constructor.
+    def __init__(self, host, port, clients=100, rate=1000, duration=10,
+                 mix=MIX, churn=0, drain=1, seed=None):
+        self.address = (host, port)
+        self.rate = rate
+        self.duration = duration
+        self.mix = mix
+        self.churn = churn
+        self.drain = drain
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.clients = [SimClient(i) for i in range(clients)]
+        self.connecting = 0
+        self.waiting = []
+
+        self.sent = dict.fromkeys(MIX, 0)
+        self.latencies = {kind: [] for kind in list(MIX) + ['connect']}
+        self.deliveries = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.errors = 0
+
+    # Starts connecting the client.
+    def connect(self, client):
+        client.reset()
+        sock = s.socket(s.AF_INET, s.SOCK_STREAM)
+        sock.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+        sock.setblocking(0)
+        client.connectStart = time.perf_counter_ns()
+        code = sock.connect_ex(self.address)
+        if code not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            raise ConnectionError(f"cannot connect: {errno.errorcode[code]}")
+        client.sock = sock
+        self.connecting += 1
+        self.selector.register(sock, selectors.EVENT_READ, client)
+
+    # Connects waiting clients while fewer than CONNECT_BATCH are connecting.
+    def connectWaiting(self):
+        while self.waiting and self.connecting < CONNECT_BATCH:
+            self.connect(self.waiting.pop())
+
+    # Closes the connection of the client.
+    def close(self, client):
+        if client.sock is None:
+            return
+        if not client.ready:
+            self.connecting -= 1
+        self.selector.unregister(client.sock)
+        client.sock.close()
+        client.sock = None
+        client.reset()
+
+    # Closes and reconnects the client.
+    def reconnect(self, client):
+        self.close(client)
+        self.waiting.append(client)
+        self.connectWaiting()
+
+    # Sends data and what is left of earlier data to the client's socket.
+    def write(self, client, data):
+        client.outbound += data
+        try:
+            sent = client.sock.send(client.outbound)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.disconnects += 1
+            self.reconnect(client)
+            return
+        client.outbound = client.outbound[sent:]
+        events = selectors.EVENT_READ
+        if client.outbound:
+            events |= selectors.EVENT_WRITE
+        self.selector.modify(client.sock, events, client)
+
+    # Sends one message of the mix from a random ready client.
+    def sendOne(self, ready):
+        client = self.random.choice(ready)
+        kind = self.random.choices(list(self.mix),
+                                   weights=list(self.mix.values()))[0]
+        now = time.perf_counter_ns()
+        tag = f"lg {kind[0]} {client.index} {self.sent[kind]} {now}"
+        if kind == 'say':
+            line = f"/say {tag}\n"
+        elif kind == 'whisper':
+            target = self.random.choice(ready)
+            line = f"/whisper {target.nickname} {tag}\n"
+        elif kind == 'nick':
+            if client.pendingNick is not None:
+                return
+            client.renames += 1
+            nickname = f"lg{client.index}x{client.renames}"
+            client.pendingNick = (nickname, now)
+            line = f"/nick {nickname}\n"
+        else:
+            client.pendingLists.append(now)
+            line = "/list\n"
+        self.sent[kind] += 1
+        self.write(client, line.encode())
+
+    def onEvent(self, client, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.write(client, b'')
+            if client.sock is None:
+                return
+        if not mask & selectors.EVENT_READ:
+            return
+        try:
+            data = client.sock.recv(1 << 16)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnects += 1
+            self.reconnect(client)
+            return
+        now = time.perf_counter_ns()
+        lines = (client.buffer + data).split(b'\n')
+        client.buffer = lines.pop()
+        for line in lines:
+            self.onLine(client, line, now)
+
+    def onLine(self, client, line, now):
+        if line.startswith(b'PING '):
+            self.write(client, b'/pong ' + line[5:] + b'\n')
+            return
+        tagged = line.find(TAG)
+        if not client.ready:
+            # Skips the replayed history up to the own connect notice.
+            marker = line.find(b' connected with name ')
+            if marker != -1 and tagged == -1:
+                client.ready = True
+                client.nickname = line[marker + 21:].decode()
+                self.connecting -= 1
+                self.connects += 1
+                self.latencies['connect'].append(
+                    (now - client.connectStart) / 1e6)
+                self.connectWaiting()
+            return
+        if tagged != -1:
+            self.deliveries += 1
+            kind, sender, _, stamp = line[tagged + len(TAG):].split()[:4]
+            # Measures /say at its sender and /whisper at its receiver.
+            if kind == b's' and int(sender) == client.index:
+                self.latencies['say'].append((now - int(stamp)) / 1e6)
+            elif kind == b'w' and b' whispers: ' in line:
+                self.latencies['whisper'].append((now - int(stamp)) / 1e6)
+            return
+        if client.pendingNick is not None:
+            nickname, start = client.pendingNick
+            if line.endswith(b' changed name to ' + nickname.encode()):
+                client.nickname = nickname
+                client.pendingNick = None
+                self.latencies['nick'].append((now - start) / 1e6)
+                return
+            if line.endswith(b' already in use'):
+                client.pendingNick = None
+                self.errors += 1
+                return
+        if client.pendingLists:
+            # The first line of a /list reply is "[time] nickname address".
+            fields = line.split(b' ')
+            if len(fields) == 3 and (b'.' in fields[2] or b':' in fields[2]):
+                start = client.pendingLists.pop(0)
+                self.latencies['list'].append((now - start) / 1e6)
+                return
+        if b'Could not find user' in line or b'Incorrect syntax' in line:
+            self.errors += 1
+
+    # Handles the events that are ready within timeout seconds.
+    def poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            self.onEvent(key.data, mask)
+
+    # Connects every client, then generates load for the duration and waits
+    # drain seconds for messages in flight. Returns the results.
+    def run(self):
+        self.waiting = list(reversed(self.clients))
+        self.connectWaiting()
+        while self.connecting or self.waiting:
+            self.poll(1)
+        setup = summarize(self.latencies['connect'])
+        self.latencies['connect'] = []
+        self.connects = 0
+
+        start = time.perf_counter()
+        end = start + self.duration
+        scheduled = 0
+        churned = 0
+        while True:
+            now = time.perf_counter()
+            if now >= end:
+                break
+            ready = [client for client in self.clients if client.ready]
+            if ready:
+                due = int((now - start) * self.rate)
+                while scheduled < due:
+                    self.sendOne(ready)
+                    scheduled += 1
+            if self.churn:
+                due = int((now - start) * self.churn)
+                while churned < due and ready:
+                    self.reconnect(self.random.choice(ready))
+                    churned += 1
+            self.poll(min(0.01, 1 / self.rate))
+        elapsed = time.perf_counter() - start
+        drainEnd = time.perf_counter() + self.drain
+        while time.perf_counter() < drainEnd:
+            self.poll(0.01)
+
+        for client in self.clients:
+            self.close(client)
+        self.selector.close()
+        latencies = {kind: summarize(values)
+                     for kind, values in self.latencies.items()}
+        latencies['setup'] = setup
+        return {
+            'clients': len(self.clients),
+            'rate': self.rate,
+            'duration_s': round(elapsed, 3),
+            'mix': self.mix,
+            'churn_per_s': self.churn,
+            'sent': self.sent,
+            'sent_per_s': round(sum(self.sent.values()) / elapsed, 1),
+            'deliveries': self.deliveries,
+            'deliveries_per_s': round(self.deliveries / elapsed, 1),
+            'reconnects': self.connects,
+            'disconnects': self.disconnects,
+            'errors': self.errors,
+            'latency_ms': latencies,
+        }
+
+
+# Prints a summary of the results.
+def printResults(results):
+    print(f"{results['clients']} clients, "
+          f"{results['sent_per_s']:.0f} messages/s sent, "
+          f"{results['deliveries_per_s']:.0f} deliveries/s, "
+          f"{results['reconnects']} reconnects, "
+          f"{results['disconnects']} disconnects, {results['errors']} errors")
+    for kind, stats in results['latency_ms'].items():
+        if stats['count']:
+            print(f"{kind:>8}: {stats['count']:8} p50 {stats['p50']:8.2f} ms "
+                  f"p99 {stats['p99']:8.2f} ms max {stats['max']:8.2f} ms")
+
+
+# Command line parser.
+if __name__ == '__main__':
+    import sys
+    import argparse
+    p = argparse.ArgumentParser(description='Generates load on a running '
+                                'chat server.')
+    p.add_argument('--host', help='host of the server', default='127.0.0.1')
+    p.add_argument('--port', help='port of the server', default=12345,
+                   type=int)
+    p.add_argument('--clients', help='simulated clients', default=100,
+                   type=int)
+    p.add_argument('--rate', help='messages per second over all clients',
+                   default=1000, type=float)
+    p.add_argument('--duration', help='seconds to generate load',
+                   default=10, type=float)
+    p.add_argument('--mix', help='share of every command, e.g. '
+                   'say=70,whisper=20,nick=5,list=5', type=parseMix,
+                   default=MIX)
+    p.add_argument('--churn', help='clients that reconnect per second',
+                   default=0, type=float)
+    p.add_argument('--drain', help='seconds to wait for messages in flight '
+                   'after the load stops', default=1, type=float)
+    p.add_argument('--seed', help='seed of the random choices', type=int)
+    p.add_argument('--json', help='file to write the results to as JSON, '
+                   '- for stdout')
+    args = p.parse_args(sys.argv[1:])
+    generator = LoadGenerator(args.host, args.port, args.clients, args.rate,
+                              args.duration, args.mix, args.churn,
+                              args.drain, args.seed)
+    results = generator.run()
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=1)
+        print()
+    else:
+        printResults(results)
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=1)
@@ -0,0 +1,240 @@
+import bisect
+import selectors
+import socket as s
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    # Constructor. The last bucket counts everything above the last bound.
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Returns the Prometheus text lines of the histogram.
+    def render(self, name, labels=''):
+        lines = []
+        cumulative = 0
+        sep = ',' if labels else ''
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels}{sep}le="{bound}"}} '
+                         f'{cumulative}')
+        lines.append(f'{name}_bucket{{{labels}{sep}le="+Inf"}} {self.count}')
+        suffix = f'{{{labels}}}' if labels else ''
+        lines.append(f'{name}_sum{suffix} {self.sum}')
+        lines.append(f'{name}_count{suffix} {self.count}')
+        return lines
+
+
+class CommandStats:
+    __slots__ = ('count', 'seconds')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = Histogram()
+
+
+class Metrics:
+    """
+    Counters and histograms of the server. Everything is allocated up front
+    and updated in place. The server keeps None instead of a Metrics when
+    metrics are off, so the hot path only pays for a None check.
+    """
+
+    # Constructor. commands are the commands to keep statistics for.
+    def __init__(self, commands):
+        self.accepted = 0
+        self.rejected = 0
+        self.limited = 0
+        self.handshakeFailures = 0
+        self.resumedSessions = 0
+        self.timedOut = 0
+        self.throttled = 0
+        self.closed = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.sendFailures = 0
+        self.oversizedFrames = 0
+        self.loopSeconds = Histogram()
+        self.commands = {command: CommandStats() for command in commands}
+        self.unknown = CommandStats()
+
+    # Returns the statistics of a command, unknown commands share theirs.
+    def command(self, command):
+        return self.commands.get(command, self.unknown)
+
+    # Returns the metrics of the server in the Prometheus text format.
+    def render(self, server):
+        connections = server.getConnectedSockets().values()
+        queued = [conn.getOutboundSize() for conn in connections]
+        lines = []
+
+        def metric(name, kind, help, value):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+
+        metric('chat_connections_accepted_total', 'counter',
+               'Accepted client connections.', self.accepted)
+        metric('chat_connections_rejected_total', 'counter',
+               'Connections refused because of a ban.', self.rejected)
+        metric('chat_connections_limited_total', 'counter',
+               'Connections refused by the connection rate limit.',
+               self.limited)
+        metric('chat_tls_handshake_failures_total', 'counter',
+               'Connections closed because their TLS handshake failed.',
+               self.handshakeFailures)
+        metric('chat_tls_sessions_resumed_total', 'counter',
+               'Accepted connections that resumed a TLS session.',
+               self.resumedSessions)
+        metric('chat_clients_throttled_total', 'counter',
+               'Times a client was paused by the message or byte rate '
+               'limit.', self.throttled)
+        metric('chat_clients_timed_out_total', 'counter',
+               'Clients disconnected for being silent too long.',
+               self.timedOut)
+        metric('chat_connections_closed_total', 'counter',
+               'Closed client connections.', self.closed)
+        metric('chat_connected_clients', 'gauge',
+               'Currently connected clients.', len(queued))
+        metric('chat_online_users', 'gauge', 'Currently online users.',
+               len(server.getOnlineUsers()))
+        metric('chat_bytes_received_total', 'counter',
+               'Bytes received from clients.', self.bytesIn)
+        metric('chat_bytes_sent_total', 'counter', 'Bytes sent to clients.',
+               self.bytesOut)
+        metric('chat_send_failures_total', 'counter',
+               'Clients dropped because writing to them failed.',
+               self.sendFailures)
+        metric('chat_oversized_frames_total', 'counter',
+               'Messages rejected for exceeding the maximum frame size.',
+               self.oversizedFrames)
+        metric('chat_outbound_queued_bytes', 'gauge',
+               'Bytes waiting in the outbound buffers of all clients.',
+               sum(queued))
+        metric('chat_outbound_queue_max_bytes', 'gauge',
+               'Largest outbound buffer of a single client.',
+               max(queued, default=0))
+
+        lines.append('# HELP chat_messages_total Messages handled by '
+                     'command.')
+        lines.append('# TYPE chat_messages_total counter')
+        stats = list(self.commands.items()) + [('unknown', self.unknown)]
+        for command, stat in stats:
+            lines.append(f'chat_messages_total{{command="{command}"}} '
+                         f'{stat.count}')
+        lines.append('# HELP chat_handler_seconds Time spent in command '
+                     'handlers.')
+        lines.append('# TYPE chat_handler_seconds histogram')
+        for command, stat in stats:
+            lines.extend(stat.seconds.render('chat_handler_seconds',
+                                             f'command="{command}"'))
+        lines.append('# HELP chat_loop_iteration_seconds Time the event loop '
+                     'spends on one wakeup.')
+        lines.append('# TYPE chat_loop_iteration_seconds histogram')
+        lines.extend(self.loopSeconds.render('chat_loop_iteration_seconds'))
+        return '\n'.join(lines) + '\n'
+
+
+# Returns the HTTP response with the metrics of the server.
+def httpResponse(server):
+    body = server.metrics.render(server).encode()
+    head = ("HTTP/1.0 200 OK\r\n"
+            "Content-Type: text/plain; version=0.0.4\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n")
+    return head.encode() + body
+
+
+class MetricsEndpoint:
+    """
+    Serves the metrics over HTTP on a local port from the event loop of the
+    select engine. Every request gets the metrics, whatever its path.
+    """
+
+    # Constructor. A listenSocket that is listening already is used instead
+    # of binding port.
+    def __init__(self, server, port, host='127.0.0.1', listenSocket=None):
+        self.server = server
+        self.selector = server.getSelector()
+        self.listenSocket = listenSocket
+        if listenSocket is None:
+            self.listenSocket = s.socket(s.AF_INET, s.SOCK_STREAM)
+            self.listenSocket.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
+            self.listenSocket.bind((host, port))
+            self.listenSocket.listen(8)
+        self.listenSocket.setblocking(0)
+        self.selector.register(self.listenSocket, selectors.EVENT_READ,
+                               self.onAccept)
+
+    def onAccept(self, mask):
+        try:
+            sock, _ = self.listenSocket.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(0)
+        request = bytearray()
+
+        def onEvent(mask):
+            if mask & selectors.EVENT_READ:
+                try:
+                    data = sock.recv(4096)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    data = b''
+                request.extend(data)
+                if data and b'\r\n\r\n' not in request and \
+                        len(request) < 65536:
+                    return
+                if not data:
+                    self.close(sock)
+                    return
+                pending[0] = memoryview(httpResponse(self.server))
+                self.selector.modify(sock, selectors.EVENT_WRITE, onEvent)
+            if mask & selectors.EVENT_WRITE or pending[0] is not None:
+                try:
+                    sent = sock.send(pending[0])
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError:
+                    self.close(sock)
+                    return
+                pending[0] = pending[0][sent:]
+                if not pending[0]:
+                    self.close(sock)
+
+        pending = [None]
+        self.selector.register(sock, selectors.EVENT_READ, onEvent)
+
+    def close(self, sock):
+        self.selector.unregister(sock)
+        sock.close()
+
+
+# Serves the metrics over HTTP on a local port from an asyncio event loop.
+async def serveMetricsAsync(server, port, host='127.0.0.1'):
+    import asyncio
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        writer.write(httpResponse(server))
+        await writer.drain()
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,398 @@
+import heapq
+import mmap
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+# A record is a header followed by the UTF-8 sender, target and text. The
+# header holds the length of the three fields together, the timestamp in
+# milliseconds since the epoch, the kind and the sender and target lengths.
+RECORD = struct.Struct('!IqBHH')
+
+# An index entry holds the timestamp, the offset of the record in its segment
+# and the CRC-32 of the sender, which ends the entry.
+INDEX = struct.Struct('!qII')
+SENDER_CRC = struct.Struct('!I')
+
+# Kinds of logged messages. The target of a room message is the room, the
+# target of a whisper the nickname of the receiver.
+KINDS = ('say', 'whisper')
+
+# When the writer forces appended messages to disk.
+# batch: After every batch of messages.
+# second: At most once a second.
+# never: Leaves it to the operating system.
+FSYNC = ('batch', 'second', 'never')
+
+# Bytes scanned at a time by search, so other threads get the interpreter in
+# between.
+SCAN_CHUNK = 1 << 20
+
+
+class MessageLog:
+    """
+    Append-only log of the chat messages in segment files of at most
+    segmentSize bytes. Messages are appended from the event loop into a queue
+    and written in batches by a writer thread, so the event loop never waits
+    for the disk. Every segment has an index file with an entry per record.
+    Several writers, e.g. the workers of the multi-process mode, share a
+    directory by using different names.
+    """
+
+    # Constructor.
+    def __init__(self, directory, name='0', fsync='batch',
+                 segmentSize=64 << 20, batchSize=4096):
+        if fsync not in FSYNC:
+            raise ValueError(f"unknown fsync mode {fsync}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.name = name
+        self.fsync = fsync
+        self.segmentSize = segmentSize
+        self.batchSize = batchSize
+        self.queue = queue.SimpleQueue()
+
+        # Every run starts a new segment, so a segment that was cut short by
+        # a crash is never appended to.
+        numbers = [number for writer, number in listSegments(directory)
+                   if writer == name]
+        self.segment = max(numbers, default=0)
+        self.logFile = None
+        self.indexFile = None
+        self.position = 0
+        self.lastStamp = 0
+        self.lastSync = time.monotonic()
+        self.openSegment()
+
+        self.thread = threading.Thread(target=self.run, name='message-log',
+                                       daemon=True)
+        self.thread.start()
+
+    # Queues a message for the log. kind is one of KINDS.
+    def append(self, kind, sender, target, text):
+        self.queue.put((time.time_ns() // 1000000, KINDS.index(kind), sender,
+                        target, text))
+
+    # Writes the queued messages and stops the writer.
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def openSegment(self):
+        if self.logFile is not None:
+            self.sync()
+            self.logFile.close()
+            self.indexFile.close()
+        self.segment += 1
+        base = os.path.join(self.directory,
+                            f"{self.name}-{self.segment:08d}")
+        self.logFile = open(base + '.log', 'ab', buffering=0)
+        self.indexFile = open(base + '.idx', 'ab', buffering=0)
+        self.position = 0
+
+    def sync(self):
+        os.fsync(self.logFile.fileno())
+        os.fsync(self.indexFile.fileno())
+        self.lastSync = time.monotonic()
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            batch = [self.queue.get()]
+            while len(batch) < self.batchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = batch[:batch.index(None)]
+            self.write(batch)
+        self.sync()
+        self.logFile.close()
+        self.indexFile.close()
+
+    # Writes a batch of messages with one write per file.
+    def write(self, batch):
+        records = []
+        entries = []
+        for stamp, kind, sender, target, text in batch:
+            if self.position >= self.segmentSize:
+                self.flush(records, entries)
+                records, entries = [], []
+                self.openSegment()
+            # Keeps the timestamps in a segment ordered when the clock steps
+            # back.
+            stamp = self.lastStamp = max(stamp, self.lastStamp)
+            sender = sender.encode()
+            target = target.encode()
+            text = text.encode()
+            records.append(RECORD.pack(len(sender) + len(target) + len(text),
+                                       stamp, kind, len(sender), len(target)))
+            records.append(sender)
+            records.append(target)
+            records.append(text)
+            entries.append(INDEX.pack(stamp, self.position,
+                                      zlib.crc32(sender)))
+            self.position += RECORD.size + len(sender) + len(target) + \
+                len(text)
+        self.flush(records, entries)
+        if self.fsync == 'batch' or self.fsync == 'second' and \
+                time.monotonic() - self.lastSync >= 1:
+            self.sync()
+
+    # Writes the records before their index entries, so an entry never
+    # points past the end of the log.
+    def flush(self, records, entries):
+        if records:
+            self.logFile.write(b''.join(records))
+            self.indexFile.write(b''.join(entries))
+
+
+# Returns the (writer, number) of every segment in the directory, oldest
+# first for every writer.
+def listSegments(directory):
+    segments = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return segments
+    for name in names:
+        base, ext = os.path.splitext(name)
+        writer, sep, number = base.rpartition('-')
+        if ext == '.log' and sep and number.isdigit():
+            segments.append((writer, int(number)))
+    segments.sort()
+    return segments
+
+
+class Segment:
+    """
+    A segment mapped into memory for reading. The pages are read by the
+    operating system as they are touched, so a search never loads a segment
+    as a whole.
+    """
+
+    # Constructor.
+    def __init__(self, directory, writer, number):
+        base = os.path.join(directory, f"{writer}-{number:08d}")
+        # Maps the index before the log, which the writer appends to first.
+        self.index = mapFile(base + '.idx')
+        self.log = mapFile(base + '.log')
+        self.count = len(self.index) // INDEX.size
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.index:
+            self.index.close()
+        if self.log:
+            self.log.close()
+
+    # Returns the timestamp, offset and sender CRC of entry i.
+    def entry(self, i):
+        return INDEX.unpack_from(self.index, i * INDEX.size)
+
+    # Returns (timestamp, kind, sender, target, text) of the record at the
+    # offset, or None if the record is not completely written.
+    def record(self, offset):
+        if offset + RECORD.size > len(self.log):
+            return None
+        length, stamp, kind, senderLen, targetLen = \
+            RECORD.unpack_from(self.log, offset)
+        start = offset + RECORD.size
+        if start + length > len(self.log):
+            return None
+        fields = self.log[start:start + length]
+        sender = fields[:senderLen].decode('utf-8', 'replace')
+        target = fields[senderLen:senderLen + targetLen] \
+            .decode('utf-8', 'replace')
+        text = fields[senderLen + targetLen:].decode('utf-8', 'replace')
+        return stamp, KINDS[kind], sender, target, text
+
+    # Returns the number of the last entry whose record starts at or before
+    # the offset, by a binary search over the index.
+    def entryAt(self, offset):
+        low, high = 0, self.count - 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.entry(middle)[1] <= offset:
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    # Returns the number of the first entry with a timestamp of at least
+    # stamp, by a binary search over the index.
+    def entryFrom(self, stamp):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < stamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # Yields (entry, record) for every record sent by the nickname, newest
+    # first. Only the index is searched for the CRC of the nickname, so a
+    # segment without messages of the nickname costs one scan of its index.
+    def findBySender(self, nickname):
+        crc = SENDER_CRC.pack(zlib.crc32(nickname.encode()))
+        end = self.count * INDEX.size
+        while end > 0:
+            found = self.index.rfind(crc, 0, end)
+            if found == -1:
+                return
+            # Overlaps the next search with the CRC, a match may start
+            # within it.
+            end = found + len(crc) - 1
+            if found % INDEX.size != INDEX.size - len(crc):
+                continue
+            i = found // INDEX.size
+            record = self.record(self.entry(i)[1])
+            if record is not None and record[2] == nickname:
+                yield i, record
+
+    # Yields (entry, record) for every record containing data, newest first.
+    def findBackwards(self, data):
+        if not self.count or not data:
+            return
+        end = self.entry(self.count - 1)[1]
+        record = self.record(end)
+        if record is not None:
+            end += RECORD.size + RECORD.unpack_from(self.log, end)[0]
+        while end > 0:
+            start = max(0, end - SCAN_CHUNK)
+            found = self.log.rfind(data, start, end)
+            if found == -1:
+                # Overlaps the chunks by the length of data.
+                end = start + len(data) - 1 if start else 0
+                continue
+            i = self.entryAt(found)
+            offset = self.entry(i)[1]
+            record = self.record(offset)
+            if record is not None:
+                yield i, record
+            end = offset
+
+
+# Maps a file read-only. Returns an empty bytes for an empty or missing file,
+# which cannot be mapped.
+def mapFile(path):
+    try:
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (FileNotFoundError, ValueError):
+        return b''
+
+
+def search(directory, term, rooms, nickname, limit=20, bySender=False):
+    """
+    Searches the log for the messages sent by the nickname term or containing
+    term, newest first. Returns at most limit of them as (timestamp, kind,
+    sender, target, text), oldest first.
+    directory: The directory of the log.
+    term: The nickname or text to search for.
+    rooms: Only messages said in these rooms are returned...
+    nickname: ...and whispers from or to this nickname.
+    bySender: Only returns the messages sent by the nickname term, found
+              through the index instead of by scanning the segments.
+    """
+    data = term.encode()
+    byWriter = {}
+    for writer, number in listSegments(directory):
+        byWriter.setdefault(writer, []).append(number)
+    results = []
+    for writer, numbers in byWriter.items():
+        found = []
+        for number in reversed(numbers):
+            with Segment(directory, writer, number) as segment:
+                matches = segment.findBySender(term) if bySender else \
+                    segment.findBackwards(data)
+                for i, record in matches:
+                    stamp, kind, sender, target, text = record
+                    if kind == 'say' and target not in rooms:
+                        continue
+                    if kind == 'whisper' and nickname not in (sender, target):
+                        continue
+                    if sender != term and term not in text:
+                        continue
+                    found.append(record)
+                    if len(found) == limit:
+                        break
+            if len(found) == limit:
+                break
+        results.extend(reversed(found))
+    results.sort(key=lambda record: record[0])
+    return results[-limit:]
+
+
+# Yields every record of the log in the given time range as (timestamp, kind,
+# sender, target, text), oldest first. With sender only the messages of that
+# nickname are read.
+def export(directory, since=0, until=None, sender=None):
+    writers = sorted({writer for writer, number in listSegments(directory)})
+    return heapq.merge(*(exportWriter(directory, writer, since, until,
+                                      sender) for writer in writers),
+                       key=lambda record: record[0])
+
+
+# Yields the records of one writer for export.
+def exportWriter(directory, writer, since, until, sender):
+    crc = zlib.crc32(sender.encode()) if sender is not None else None
+    for name, number in listSegments(directory):
+        if name != writer:
+            continue
+        with Segment(directory, writer, number) as segment:
+            for i in range(segment.entryFrom(since), segment.count):
+                stamp, offset, senderCrc = segment.entry(i)
+                if until is not None and stamp >= until:
+                    break
+                if crc is not None and senderCrc != crc:
+                    continue
+                record = segment.record(offset)
+                if record is None or \
+                        sender is not None and record[2] != sender:
+                    continue
+                yield record
+
+
+# Returns the record formatted as a chat line.
+def formatRecord(record):
+    stamp, kind, sender, target, text = record
+    when = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp / 1000))
+    if kind == 'whisper':
+        return f"[{when}] {sender} whispers to {target}: {text}"
+    return f"[{when}] {target} {sender}: {text}"
+
+
+# Offline export tool.
+if __name__ == '__main__':
+    import sys
+    import json
+    import argparse
+    p = argparse.ArgumentParser(description='Exports the message log.')
+    p.add_argument('directory', help='directory of the log')
+    p.add_argument('--since', help='first timestamp in ms since the epoch',
+                   default=0, type=int)
+    p.add_argument('--until', help='timestamp in ms since the epoch to stop '
+                   'at', type=int)
+    p.add_argument('--sender', help='only export messages of this nickname')
+    p.add_argument('--format', help='output format', default='text',
+                   choices=('text', 'json'))
+    args = p.parse_args(sys.argv[1:])
+    for record in export(args.directory, args.since, args.until,
+                         args.sender):
+        if args.format == 'json':
+            print(json.dumps(dict(zip(('timestamp', 'kind', 'sender',
+                                       'target', 'text'), record))))
+        else:
+            print(formatRecord(record))
@@ -0,0 +1,160 @@
+import zlib
+
+from framing import FrameError, VarintFramer, decodeVarint, encodeVarint
+
+# Kinds of events. A notice is any other text from the server, e.g. the
+# reply to a command or a user joining a room. A ping asks the client to
+# answer with /pong and its text.
+NOTICE = 0
+SAY = 1
+WHISPER = 2
+WHISPER_SENT = 3
+PING = 4
+KINDS = ('notice', 'say', 'whisper', 'whisper-sent', 'ping')
+
+# A binary event is a varint length prefixed frame holding a header followed
+# by the UTF-8 sender, target and text. The header is the timestamp in
+# milliseconds since the epoch shifted left by KIND_BITS with the kind in
+# the low bits, as a STAMP_SIZE byte big endian number, followed by the
+# sender and target lengths as varints. With its length prefix a room
+# message takes 9 bytes besides its sender, target and text.
+KIND_BITS = 3
+STAMP_SIZE = 6
+
+# The line the server sends in the text protocol right before it switches
+# to the binary protocol, with " zlib" appended if it is compressed.
+SWITCH = 'PROTOCOL binary'
+
+
+class Event:
+    """
+    A message from the server to clients. The text and binary encodings are
+    made when a client first needs them and kept, so a message sent to many
+    clients, or replayed from the history, is encoded at most once per
+    protocol.
+    """
+
+    __slots__ = ('kind', 'text', 'sender', 'target', 'stamp', 'millis',
+                 'line', 'frame')
+
+    # Constructor. stamp is the timestamp as rendered in the text protocol,
+    # None for a message without one, and millis the time in milliseconds
+    # since the epoch.
+    def __init__(self, kind, text, sender='', target='', stamp=None,
+                 millis=0):
+        self.kind = kind
+        self.text = text
+        self.sender = sender
+        self.target = target
+        self.stamp = stamp
+        self.millis = millis
+        self.line = None
+        self.frame = None
+
+    # Returns the encoded event, as a binary frame or as a line of text.
+    def encode(self, binary):
+        if binary:
+            if self.frame is None:
+                self.frame = VarintFramer.encode(self.pack())
+            return self.frame
+        if self.line is None:
+            self.line = self.render().encode()
+        return self.line
+
+    # Returns the event as a line of the text protocol.
+    def render(self):
+        if self.kind == SAY:
+            body = f"{self.target} {self.sender}: {self.text}"
+        elif self.kind == WHISPER:
+            body = f"{self.sender} whispers: {self.text}"
+        elif self.kind == WHISPER_SENT:
+            body = f"whisper to {self.target}: {self.text}"
+        elif self.kind == PING:
+            body = f"PING {self.text}"
+        else:
+            body = self.text
+        if self.stamp is None:
+            return f"{body}\n"
+        return f"[{self.stamp}] {body}\n"
+
+    # Returns the fields of the event as bytes, without the length prefix.
+    def pack(self):
+        sender = self.sender.encode()
+        target = self.target.encode()
+        header = (self.millis << KIND_BITS | self.kind).to_bytes(STAMP_SIZE,
+                                                                 'big')
+        return header + encodeVarint(len(sender)) + \
+            encodeVarint(len(target)) + sender + target + self.text.encode()
+
+    # Returns the event packed in data. The text timestamp is not packed.
+    # Raises FrameError if data is not a packed event.
+    @classmethod
+    def unpack(cls, data, stamp=None):
+        header = int.from_bytes(data[:STAMP_SIZE], 'big')
+        kind = header & ((1 << KIND_BITS) - 1)
+        millis = header >> KIND_BITS
+        lengths = decodeVarint(data, STAMP_SIZE)
+        if lengths is not None:
+            senderLen, start = lengths
+            lengths = decodeVarint(data, start)
+        if lengths is None:
+            raise FrameError("event header is cut off")
+        targetLen, start = lengths
+        if start + senderLen + targetLen > len(data):
+            raise FrameError("event is shorter than its header says")
+        if kind >= len(KINDS):
+            raise FrameError(f"unknown event kind {kind}")
+        try:
+            sender = bytes(data[start:start + senderLen]).decode()
+            start += senderLen
+            target = bytes(data[start:start + targetLen]).decode()
+            text = bytes(data[start + targetLen:]).decode()
+        except UnicodeDecodeError:
+            raise FrameError("event is not valid UTF-8") from None
+        return cls(kind, text, sender, target, stamp, millis)
+
+    def __repr__(self):
+        return f"Event({KINDS[self.kind]}, {self.text!r}, " \
+            f"sender={self.sender!r}, target={self.target!r})"
+
+
+class CommandFramer(VarintFramer):
+    """
+    Splits the byte stream of a binary protocol client into commands. Every
+    command is a varint length prefixed UTF-8 string. Newlines are replaced,
+    so a command cannot forge extra lines for text clients.
+    """
+
+    # Yields every complete command as a string. Raises FrameError if a
+    # command is longer than the maximum frame size.
+    def frames(self):
+        try:
+            for frame in super().frames():
+                yield frame.decode('utf-8', 'replace').replace('\n', ' ')
+        except FrameError:
+            self.pending.clear()
+            raise
+
+
+class EventReader:
+    """
+    Decodes the events the server sends to a binary protocol client,
+    decompressing them first if the connection is compressed.
+    """
+
+    # Constructor.
+    def __init__(self, compressed=False, maxFrame=1 << 24):
+        self.decompressor = zlib.decompressobj() if compressed else None
+        self.framer = VarintFramer(maxFrame)
+
+    # Adds received data.
+    def feed(self, data):
+        if self.decompressor is not None:
+            data = self.decompressor.decompress(data)
+        self.framer.feed(data)
+
+    # Yields every complete event. Raises FrameError if a frame is not an
+    # event.
+    def events(self):
+        for frame in self.framer.frames():
+            yield Event.unpack(frame)
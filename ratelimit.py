@@ -0,0 +1,189 @@
+import time
+
+
+class TokenBucket:
+    """
+    Allows rate tokens per second with bursts of up to burst tokens. Taking
+    tokens always succeeds, but a bucket taken below zero is in debt and
+    its owner has to wait until it refilled to zero.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    # Constructor. The bucket starts full.
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    # Takes amount tokens. Returns the seconds until the bucket is out of
+    # debt, 0 if it is not in debt.
+    def take(self, amount, now):
+        tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        tokens -= amount
+        self.tokens = tokens
+        self.stamp = now
+        return -tokens / self.rate if tokens < 0 else 0
+
+    # Returns whether the bucket refilled to its burst, i.e. whether it is
+    # the same as a new bucket.
+    def isFull(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class AddressLimits:
+    __slots__ = ('messages', 'bytes', 'connections')
+
+    def __init__(self):
+        self.messages = None
+        self.bytes = None
+        self.connections = None
+
+    # Returns whether all buckets refilled, so the limits can be dropped.
+    def isFull(self, now):
+        return all(bucket is None or bucket.isFull(now)
+                   for bucket in (self.messages, self.bytes, self.connections))
+
+
+class SocketLimits:
+    __slots__ = ('address', 'messages', 'bytes')
+
+    def __init__(self, address):
+        self.address = address
+        self.messages = None
+        self.bytes = None
+
+
+# Returns a (rate, burst) limit parsed from "RATE" or "RATE:BURST". The burst
+# defaults to one second worth of tokens. Raises ValueError for other text.
+def parseLimit(text):
+    rate, _, burst = text.partition(':')
+    rate = float(rate)
+    burst = float(burst) if burst else max(rate, 1)
+    if rate <= 0 or burst < 1:
+        raise ValueError(f"invalid rate limit {text}")
+    return rate, burst
+
+
+class RateLimiter:
+    """
+    Token buckets for the messages and bytes every connection sends and for
+    the messages, bytes and new connections of every IP address. A limit is
+    (rate, burst) or None for no limit. An address gets addressShare times
+    the message and byte limits of one connection over all its connections.
+    Every call costs O(1): buckets are created on first use, the buckets of
+    a socket are dropped when it disconnects and the buckets of an address
+    are dropped once they refilled.
+    """
+
+    # Constructor.
+    def __init__(self, messageLimit=None, byteLimit=None,
+                 connectionLimit=None, addressShare=4, clock=time.monotonic):
+        self.messageLimit = messageLimit
+        self.byteLimit = byteLimit
+        self.connectionLimit = connectionLimit
+        self.addressShare = addressShare
+        self.clock = clock
+
+        self.bySocket = {}
+        # Limits by address, least recently looked at first.
+        self.byAddress = {}
+
+    # Returns the limits of the address, moved to the back of byAddress.
+    # Looks at the two least recently used addresses and drops their limits
+    # if all their buckets refilled. Limits that did not refill, e.g. of an
+    # address in debt that waits between connections, move to the back.
+    def addressLimits(self, address, now):
+        limits = self.byAddress.pop(address, None)
+        if limits is None:
+            limits = AddressLimits()
+        for _ in range(min(2, len(self.byAddress))):
+            oldest = next(iter(self.byAddress))
+            oldestLimits = self.byAddress.pop(oldest)
+            if not oldestLimits.isFull(now):
+                self.byAddress[oldest] = oldestLimits
+        self.byAddress[address] = limits
+        return limits
+
+    # Counts a new connection of the socket from the address. Returns 0 if
+    # it is allowed, otherwise the seconds until the address may connect
+    # again. The socket is only tracked if it is allowed.
+    def connect(self, sock, address):
+        if self.connectionLimit is not None:
+            now = self.clock()
+            limits = self.addressLimits(address, now)
+            if limits.connections is None:
+                limits.connections = TokenBucket(*self.connectionLimit, now)
+            delay = limits.connections.take(1, now)
+            if delay:
+                # Refused connections do not count.
+                limits.connections.tokens += 1
+                return delay
+        self.bySocket[sock] = SocketLimits(address)
+        return 0
+
+    # Returns the token buckets of the socket as a dict of (tokens, stamp)
+    # by kind, for handing the socket to another process.
+    def socketState(self, sock):
+        socketLimits = self.bySocket.get(sock)
+        if socketLimits is None:
+            return {}
+        state = {}
+        for kind in ('messages', 'bytes'):
+            bucket = getattr(socketLimits, kind)
+            if bucket is not None:
+                state[kind] = (bucket.tokens, bucket.stamp)
+        return state
+
+    # Tracks a socket of the address that connected before, e.g. to the
+    # server that handed it over, without counting a new connection. state
+    # is what socketState returned for it; the buckets keep their tokens.
+    # The stamps are of the monotonic clock, which all processes share.
+    def restore(self, sock, address, state=None):
+        socketLimits = self.bySocket[sock] = SocketLimits(address)
+        for kind, limit in (('messages', self.messageLimit),
+                            ('bytes', self.byteLimit)):
+            if limit is not None and state and kind in state:
+                bucket = TokenBucket(*limit, state[kind][1])
+                bucket.tokens = min(bucket.burst, state[kind][0])
+                setattr(socketLimits, kind, bucket)
+
+    # Forgets the socket.
+    def forget(self, sock):
+        self.bySocket.pop(sock, None)
+
+    # Counts a message of the socket. Returns the seconds the socket has to
+    # wait before it is read from again, 0 if it does not have to wait.
+    def message(self, sock):
+        if self.messageLimit is None:
+            return 0
+        return self.take(sock, 'messages', self.messageLimit, 1)
+
+    # Counts bytes received from the socket. Returns the seconds the socket
+    # has to wait before it is read from again, 0 if it does not have to
+    # wait.
+    def received(self, sock, count):
+        if self.byteLimit is None:
+            return 0
+        return self.take(sock, 'bytes', self.byteLimit, count)
+
+    def take(self, sock, kind, limit, amount):
+        socketLimits = self.bySocket.get(sock)
+        if socketLimits is None:
+            return 0
+        now = self.clock()
+        bucket = getattr(socketLimits, kind)
+        if bucket is None:
+            bucket = TokenBucket(*limit, now)
+            setattr(socketLimits, kind, bucket)
+        delay = bucket.take(amount, now)
+
+        addressLimits = self.addressLimits(socketLimits.address, now)
+        bucket = getattr(addressLimits, kind)
+        if bucket is None:
+            rate, burst = limit
+            bucket = TokenBucket(rate * self.addressShare,
+                                 burst * self.addressShare, now)
+            setattr(addressLimits, kind, bucket)
+        return max(delay, bucket.take(amount, now))
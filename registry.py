@@ -0,0 +1,185 @@
+import bisect
+import itertools
+
+# The room every user joins when connecting.
+DEFAULT_ROOM = '#lobby'
+
+# Versions of the nickname indexes. Every change takes the next one, so a
+# version is never reused, not even by a room that is created again.
+VERSIONS = itertools.count(1)
+
+
+class User:
+    __slots__ = ('socket', 'address', 'nickname', 'rooms', 'room')
+
+    # Constructor. rooms holds the joined rooms in the order they were
+    # joined and room is the one messages are said in.
+    def __init__(self, socket, address, nickname):
+        self.socket = socket
+        self.address = address
+        self.nickname = nickname
+        self.rooms = {}
+        self.room = None
+
+    def __repr__(self):
+        return f"User({self.nickname!r}, {self.address!r})"
+
+
+class NickIndex:
+    """
+    The nicknames of the members of a room in sorted order. The version
+    changes with every change of the nicknames, so anything derived from
+    them can be kept until the version changes.
+    """
+
+    __slots__ = ('nicks', 'version')
+
+    # Constructor.
+    def __init__(self):
+        self.nicks = []
+        self.version = next(VERSIONS)
+
+    def __len__(self):
+        return len(self.nicks)
+
+    def add(self, nickname):
+        bisect.insort(self.nicks, nickname)
+        self.version = next(VERSIONS)
+
+    def remove(self, nickname):
+        del self.nicks[bisect.bisect_left(self.nicks, nickname)]
+        self.version = next(VERSIONS)
+
+    # Returns the range of positions of the nicknames that start with the
+    # prefix as (start, end).
+    def find(self, prefix):
+        start = bisect.bisect_left(self.nicks, prefix)
+        end = bisect.bisect_left(self.nicks, prefix + '\U0010ffff', start)
+        return start, end
+
+
+class UserRegistry:
+    """
+    The online users, indexed by socket, nickname and IP address, and the
+    members of every room, also by nickname in a NickIndex. Every lookup and
+    update is O(1), except that keeping the nicknames of a room sorted
+    moves O(members) pointers. Iterating the registry yields the users in
+    the order they connected.
+    """
+
+    # Constructor.
+    def __init__(self):
+        self.bySocket = {}
+        self.byNick = {}
+        self.byAddress = {}
+        self.rooms = {}
+        self.nickIndexes = {}
+
+    def __len__(self):
+        return len(self.bySocket)
+
+    def __iter__(self):
+        return iter(self.bySocket.values())
+
+    def __contains__(self, user):
+        return self.bySocket.get(user.socket) is user
+
+    # Adds a new user and returns it. Returns None if the socket or the
+    # nickname is already in use.
+    def add(self, socket, address, nickname):
+        if socket in self.bySocket or nickname in self.byNick:
+            return None
+        user = User(socket, address, nickname)
+        self.bySocket[socket] = user
+        self.byNick[nickname] = user
+        self.byAddress.setdefault(address, {})[user] = None
+        return user
+
+    # Removes the user if it is registered.
+    def remove(self, user):
+        if self.bySocket.get(user.socket) is not user:
+            return
+        del self.bySocket[user.socket]
+        del self.byNick[user.nickname]
+        sameAddress = self.byAddress[user.address]
+        del sameAddress[user]
+        if not sameAddress:
+            del self.byAddress[user.address]
+        for room in list(user.rooms):
+            self.part(user, room)
+
+    # Changes the nickname of the user. Returns False if the nickname is in
+    # use, True otherwise.
+    def rename(self, user, nickname):
+        if nickname in self.byNick:
+            return False
+        for room in user.rooms:
+            index = self.nickIndexes[room]
+            index.remove(user.nickname)
+            index.add(nickname)
+        del self.byNick[user.nickname]
+        user.nickname = nickname
+        self.byNick[nickname] = user
+        return True
+
+    # Returns the user connected with the given socket or None.
+    def getBySocket(self, socket):
+        return self.bySocket.get(socket)
+
+    # Returns the user with the given nickname or None.
+    def getByNick(self, nickname):
+        return self.byNick.get(nickname)
+
+    # Returns a list of the users connected from the given IP address.
+    def getByAddress(self, address):
+        return list(self.byAddress.get(address, ()))
+
+    # Adds the user to the room and makes it the room the user says messages
+    # in. Returns False if the user already was a member, True otherwise.
+    def join(self, user, room):
+        user.room = room
+        members = self.rooms.setdefault(room, {})
+        if user in members:
+            return False
+        members[user] = None
+        user.rooms[room] = None
+        index = self.nickIndexes.get(room)
+        if index is None:
+            index = self.nickIndexes[room] = NickIndex()
+        index.add(user.nickname)
+        return True
+
+    # Removes the user from the room. The room the user says messages in
+    # becomes the room joined last of the remaining ones. Returns False if
+    # the user was not a member, True otherwise.
+    def part(self, user, room):
+        members = self.rooms.get(room)
+        if members is None or user not in members:
+            return False
+        del members[user]
+        if not members:
+            del self.rooms[room]
+            del self.nickIndexes[room]
+        else:
+            self.nickIndexes[room].remove(user.nickname)
+        del user.rooms[room]
+        if user.room == room:
+            user.room = next(reversed(user.rooms), None)
+        return True
+
+    # Returns the members of the room in the order they joined.
+    def getRoom(self, room):
+        return self.rooms.get(room, {})
+
+    # Returns the NickIndex of the room, None if it has no members.
+    def getNickIndex(self, room):
+        return self.nickIndexes.get(room)
+
+    # Returns the members of the given rooms, each of them once.
+    def getMembers(self, rooms):
+        if len(rooms) == 1:
+            return self.getRoom(rooms[0])
+        members = {}
+        for room in rooms:
+            members.update(self.getRoom(room))
+        return members
@@ -0,0 +1,202 @@
+import cProfile
+import json
+import pstats
+import selectors
+import time
+import tracemalloc
+
+import capture
+from chatserver import Server
+from connection import Connection
+
+
+class ReplaySocket:
+    """
+    Stands in for the socket of a captured client. Everything sent to it is
+    counted and dropped, as by a client that reads infinitely fast.
+    """
+
+    __slots__ = ('sent', 'closed')
+
+    def __init__(self):
+        self.sent = 0
+        self.closed = False
+
+    def send(self, data):
+        self.sent += len(data)
+        return len(data)
+
+    def sendmsg(self, buffers):
+        sent = sum(map(len, buffers))
+        self.sent += sent
+        return sent
+
+    def close(self):
+        self.closed = True
+
+
+class ReplayServer(Server):
+    """
+    Server fed from a capture instead of sockets. The connections are not
+    registered with the selector, everything else is done by the handlers
+    of Server as in the captured run.
+    """
+
+    def appendConnectedSockets(self, sock):
+        if sock not in self.connectedSockets:
+            conn = Connection(sock, self.highWatermark, self.lowWatermark,
+                              self.overflowPolicy, self.maxFrame)
+            conn.events = selectors.EVENT_READ
+            self.connectedSockets[sock] = conn
+
+    def removeConnectedSockets(self, sock):
+        conn = self.connectedSockets.pop(sock, None)
+        if conn is not None:
+            for timer in (conn.resumeTimer, conn.activityTimer,
+                          conn.lingerTimer):
+                if timer is not None:
+                    timer.cancel()
+            if self.metrics is not None:
+                self.metrics.closed += 1
+
+    def updateEvents(self, conn):
+        conn.events = conn.wantedEvents()
+
+
+def replay(path, profile=None, memory=False):
+    """
+    Feeds the capture at path through a ReplayServer as fast as possible and
+    returns the results: the number of records, the seconds it took and the
+    count and seconds of every command. The captured timing is not kept,
+    the messages of every connection are handled in the captured order.
+    path: The capture file written with chatserver.py --capture.
+    profile: File to write the cProfile statistics of the replay to, None
+             for no profile.
+    memory: Traces the allocations of the replay with tracemalloc and adds
+            the peak and the largest allocation sites to the results.
+    Profiling and tracing slow the replay down, the command times of a
+    replay without them are the ones to compare.
+    """
+    records = capture.readCapture(path)
+    kind, _, _, data = next(records)
+    if kind != capture.OPTIONS:
+        raise ValueError(f"{path} does not start with the server options")
+    server = ReplayServer(0, 20, metrics=True, **json.loads(data))
+    socks = {}
+    replaySockets = []
+    counts = dict.fromkeys(('connects', 'frames', 'closes'), 0)
+    captured = 0
+
+    profiler = cProfile.Profile() if profile is not None else None
+    if memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    start = time.perf_counter()
+    for kind, connId, captured, data in records:
+        server.clock.tick()
+        if kind == capture.CONNECT:
+            sock = socks[connId] = ReplaySocket()
+            replaySockets.append(sock)
+            server.addClient(sock, (data.decode(), 0))
+            counts['connects'] += 1
+        elif kind == capture.FRAME or kind == capture.OVERSIZED:
+            sock = socks.get(connId)
+            if sock is not None and sock in server.getConnectedSockets():
+                frame = data.decode() if kind == capture.FRAME else None
+                server.handleFrame(sock, frame)
+                counts['frames'] += 1
+        elif kind == capture.CLOSE:
+            sock = socks.pop(connId, None)
+            # Connections the server closed itself, e.g. by a kick, are
+            # closed by the replay already.
+            if sock is not None and sock in server.getConnectedSockets():
+                server.disconnectClient(sock)
+            counts['closes'] += 1
+        server.flushPending()
+    elapsed = time.perf_counter() - start
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(profile)
+
+    results = dict(counts, seconds=round(elapsed, 6),
+                   captured_seconds=round(captured, 6),
+                   bytes_out=sum(sock.sent for sock in replaySockets),
+                   commands={})
+    for command, stats in server.metrics.commands.items():
+        if stats.count:
+            results['commands'][command] = {
+                'count': stats.count,
+                'seconds': round(stats.seconds.sum, 6)}
+    if memory:
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, cProfile.__file__),
+            tracemalloc.Filter(False, tracemalloc.__file__)])
+        results['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results['allocations'] = [
+            {'site': str(stat.traceback[0]), 'bytes': stat.size,
+             'count': stat.count}
+            for stat in snapshot.statistics('lineno')[:10]]
+    server.getServerSocket().close()
+    return results
+
+
+# Prints the results of a replay, next to the results of an earlier replay
+# if there are any.
+def printResults(results, before=None):
+    rate = results['frames'] / results['seconds'] if results['seconds'] \
+        else 0
+    print(f"{results['connects']} connects, {results['frames']} messages, "
+          f"{results['closes']} closes in {results['seconds']:.3f} s "
+          f"({rate:.0f} messages/s, captured over "
+          f"{results['captured_seconds']:.1f} s)")
+    previous = before['commands'] if before is not None else {}
+    for command, stats in sorted(results['commands'].items()):
+        perCall = stats['seconds'] / stats['count'] * 1e6
+        line = f"{command:>10}: {stats['count']:8} calls " \
+            f"{perCall:9.2f} us/call"
+        old = previous.get(command)
+        if old is not None:
+            oldPerCall = old['seconds'] / old['count'] * 1e6
+            line += f" (before {oldPerCall:9.2f} us/call, " \
+                f"{perCall / oldPerCall:5.2f}x)"
+        print(line)
+    if 'peak_bytes' in results:
+        print(f"peak traced memory {results['peak_bytes'] / 1024:.0f} KiB, "
+              f"largest allocation sites:")
+        for allocation in results['allocations']:
+            print(f"  {allocation['bytes'] / 1024:9.1f} KiB "
+                  f"{allocation['count']:8} blocks {allocation['site']}")
+
+
+# Command line parser.
+if __name__ == '__main__':
+    import sys
+    import argparse
+    p = argparse.ArgumentParser(description='Replays a capture of '
+                                'chatserver.py --capture through the command '
+                                'handlers as fast as possible.')
+    p.add_argument('capture', help='capture file')
+    p.add_argument('--profile', help='file to write cProfile statistics to, '
+                   'the functions with the most cumulative time are printed')
+    p.add_argument('--tracemalloc', help='traces allocations and prints the '
+                   'largest allocation sites', action='store_true')
+    p.add_argument('--json', help='file to write the results to as JSON')
+    p.add_argument('--compare', help='results of an earlier replay, as '
+                   'written with --json, to compare the handlers with')
+    args = p.parse_args(sys.argv[1:])
+    try:
+        results = replay(args.capture, args.profile, args.tracemalloc)
+    except (OSError, ValueError) as e:
+        p.error(str(e))
+    before = None
+    if args.compare:
+        with open(args.compare) as f:
+            before = json.load(f)
+    printResults(results, before)
+    if args.profile:
+        pstats.Stats(args.profile).sort_stats('cumulative').print_stats(15)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
@@ -0,0 +1,811 @@
+import json
+import multiprocessing
+import os
+import selectors
+import shutil
+import signal
+import socket as s
+import struct
+import sys
+import tempfile
+
+import chatserver
+from chatserver import BACKENDS, Server
+from connection import Connection
+from framing import FrameError, LengthFramer
+from metrics import MetricsEndpoint
+from protocol import Event
+from tls import serverContext
+
+# A bus message is a length prefixed frame holding the length of a JSON
+# header, the header and an optional binary payload.
+BUS_HEADER = struct.Struct('!I')
+
+# Outbound buffer limit of a bus connection. The bus never drops messages.
+BUS_LIMIT = 1 << 30
+
+# Payload bytes after which a batch is closed and a new one started, so a
+# batch stays far below the maximum frame size.
+BATCH_LIMIT = 1 << 20
+
+# Nodes a cluster hub accepts by default. Default nicknames are numbered with
+# a stride of the number of nodes, see ShardedServer.newNickname.
+MAX_NODES = 64
+
+
+# Returns the bus frame for the header and payload.
+def encodeBusMessage(header, payload=b''):
+    data = json.dumps(header, separators=(',', ':')).encode()
+    return LengthFramer.encode(BUS_HEADER.pack(len(data)) + data + payload)
+
+
+# Returns the header and payload of a bus frame.
+def decodeBusMessage(frame):
+    length, = BUS_HEADER.unpack_from(frame)
+    end = BUS_HEADER.size + length
+    return json.loads(frame[BUS_HEADER.size:end]), frame[end:]
+
+
+# Yields the header and payload of every message of a batch. The header of a
+# batch lists [header, payload length] per message and its payload is the
+# payloads of the messages joined.
+def unpackBatch(header, payload):
+    start = 0
+    for part, length in header['parts']:
+        yield part, payload[start:start + length]
+        start += length
+
+
+class UnixTransport:
+    """
+    Bus connections over a Unix socket at path, for the workers of one
+    machine.
+    """
+
+    # Constructor.
+    def __init__(self, path):
+        self.path = path
+
+    # Accepts the connections of the nodes for the hub.
+    def listen(self, hub):
+        sock = s.socket(s.AF_UNIX, s.SOCK_STREAM)
+        sock.bind(self.path)
+        listenForHub(sock, hub)
+
+    # Returns a connection to the hub.
+    def connect(self):
+        sock = s.socket(s.AF_UNIX, s.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def __str__(self):
+        return f"unix://{self.path}"
+
+
+class TcpTransport:
+    """
+    Bus connections over TCP, for nodes on several machines. The bus is not
+    authenticated or encrypted, the hub has to listen on a trusted network.
+    """
+
+    # Constructor.
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    # Accepts the connections of the nodes for the hub.
+    def listen(self, hub):
+        sock = s.socket(s.AF_INET, s.SOCK_STREAM)
+        sock.setsockopt(s.SOL_SOCKET, s.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        listenForHub(sock, hub)
+
+    # Returns a connection to the hub.
+    def connect(self):
+        sock = s.create_connection((self.host, self.port))
+        sock.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+        return sock
+
+    def __str__(self):
+        return f"tcp://{self.host}:{self.port}"
+
+
+class LocalTransport:
+    """
+    Bus connections within one process over socket pairs, e.g. to run a hub
+    and its nodes in one process in tests and benchmarks. The hub must
+    listen before nodes connect and run on a thread of its own, a node
+    waits for the hub to welcome it.
+    """
+
+    # Constructor.
+    def __init__(self):
+        self.hub = None
+
+    def listen(self, hub):
+        self.hub = hub
+
+    # Returns a connection to the hub.
+    def connect(self):
+        sock, hubSock = s.socketpair()
+        self.hub.attach(hubSock)
+        return sock
+
+    def __str__(self):
+        return "local"
+
+
+# Registers a listening socket with the selector of the hub, which attaches
+# every connection accepted on it.
+def listenForHub(sock, hub):
+    sock.listen(64)
+    sock.setblocking(0)
+
+    def onAccept(mask):
+        try:
+            conn, _ = sock.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        if conn.family != s.AF_UNIX:
+            conn.setsockopt(s.IPPROTO_TCP, s.TCP_NODELAY, 1)
+        hub.attach(conn)
+
+    hub.selector.register(sock, selectors.EVENT_READ, onAccept)
+
+
+# Returns the transport of a bus address, tcp://HOST:PORT or unix://PATH.
+# Raises ValueError for other addresses.
+def parseBusAddress(text):
+    scheme, sep, rest = text.partition('://')
+    if sep and scheme == 'unix' and rest:
+        return UnixTransport(rest)
+    if sep and scheme == 'tcp':
+        host, colon, port = rest.rpartition(':')
+        if colon and host and port.isdigit():
+            return TcpTransport(host.strip('[]'), int(port))
+    raise ValueError(f"not a bus address: {text}")
+
+
+# Joins the bus over a connected socket. The hub gives the node a shard
+# number, the one asked for if shard is not None, and the number of nodes it
+# accepts. Returns (shard, shards). Raises SystemExit if the hub turns the
+# node down.
+def joinBus(sock, shard=None):
+    sock.sendall(encodeBusMessage({'op': 'hello', 'shard': shard}))
+    size = LengthFramer.HEADER.size
+    head = sock.recv(size, s.MSG_WAITALL)
+    frame = b''
+    if len(head) == size:
+        length, = LengthFramer.HEADER.unpack(head)
+        frame = sock.recv(length, s.MSG_WAITALL)
+    if len(frame) < BUS_HEADER.size:
+        raise SystemExit("the hub closed the connection")
+    header, _ = decodeBusMessage(frame)
+    if header['op'] != 'welcome':
+        raise SystemExit(f"the hub turned the node down: {header['op']}")
+    return header['shard'], header['shards']
+
+
+class BusEndpoint:
+    """
+    One non-blocking connection on the bus. Messages are collected by send
+    and written as one batch by flush, so everything sent during one loop
+    iteration costs one frame, one JSON header and one write. Without batch
+    every message is a frame of its own.
+    """
+
+    # Constructor. callback is called with the endpoint, header and payload
+    # of every received message and with None as header when the connection
+    # closes.
+    def __init__(self, sock, selector, callback, batch=True):
+        sock.setblocking(0)
+        self.sock = sock
+        self.selector = selector
+        self.callback = callback
+        self.batch = batch
+        self.conn = Connection(sock, BUS_LIMIT, BUS_LIMIT, 'pause')
+        self.conn.events = selectors.EVENT_READ
+        self.framer = LengthFramer()
+        self.closed = False
+        # The [header, payload length] and the payloads of the messages of
+        # the current batch.
+        self.parts = []
+        self.payloads = []
+        self.batchSize = 0
+        selector.register(sock, selectors.EVENT_READ, self.onEvent)
+
+    # Queues a message.
+    def send(self, header, payload=b''):
+        if self.closed:
+            return
+        if not self.batch:
+            self.conn.queue(encodeBusMessage(header, payload))
+            return
+        self.parts.append([header, len(payload)])
+        self.payloads.append(payload)
+        self.batchSize += len(payload)
+        if self.batchSize >= BATCH_LIMIT:
+            self.seal()
+
+    # Queues the current batch as one frame.
+    def seal(self):
+        if not self.parts:
+            return
+        if len(self.parts) == 1:
+            frame = encodeBusMessage(self.parts[0][0], self.payloads[0])
+        else:
+            frame = encodeBusMessage({'op': 'batch', 'parts': self.parts},
+                                     b''.join(self.payloads))
+        self.conn.queue(frame)
+        self.parts = []
+        self.payloads = []
+        self.batchSize = 0
+
+    # Writes the queued messages the socket has room for.
+    def flush(self):
+        if self.closed:
+            return
+        self.seal()
+        try:
+            self.conn.flush()
+        except OSError:
+            self.close()
+            return
+        events = selectors.EVENT_READ
+        if self.conn.hasOutbound():
+            events |= selectors.EVENT_WRITE
+        if events != self.conn.events:
+            self.conn.events = events
+            self.selector.modify(self.sock, events)
+
+    # Closes the connection and tells the callback.
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.selector.unregister(self.sock)
+        self.sock.close()
+        self.callback(self, None, b'')
+
+    def onEvent(self, mask):
+        if mask & selectors.EVENT_WRITE:
+            self.flush()
+        if not mask & selectors.EVENT_READ or self.closed:
+            return
+        try:
+            received = self.framer.receive(self.sock)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            received = 0
+        if not received:
+            self.close()
+            return
+        for frame in self.framer.frames():
+            header, payload = decodeBusMessage(frame)
+            if header['op'] != 'batch':
+                self.callback(self, header, payload)
+                continue
+            for part, data in unpackBatch(header, payload):
+                if self.closed:
+                    return
+                self.callback(self, part, data)
+
+
+class Hub:
+    """
+    Relays messages between the nodes of the bus, the workers of one machine
+    or the servers of a cluster, and owns the global nickname table, so two
+    nodes can never hand out the same nickname. It also keeps the rooms of
+    every user, for nodes that join later. A message for one user, such as a
+    whisper, only goes to the node of that user.
+    """
+
+    # Constructor. The hub accepts up to maxNodes nodes over the transport.
+    # batch is passed to the BusEndpoint of every node.
+    def __init__(self, transport, maxNodes=MAX_NODES, batch=True):
+        self.selector = selectors.DefaultSelector()
+        self.maxNodes = maxNodes
+        self.batch = batch
+        transport.listen(self)
+
+        # Endpoints by shard and the shard of every endpoint.
+        self.endpoints = {}
+        self.shards = {}
+        # Online users as (shard, uid) -> [nickname, address, rooms], the
+        # owner of every nickname and the bans as network -> expiry time.
+        self.users = {}
+        self.owners = {}
+        self.bans = {}
+
+    # Adds a connection of a node.
+    def attach(self, sock):
+        BusEndpoint(sock, self.selector, self.onMessage, self.batch)
+
+    # Sends a message to every node except the given shard.
+    def sendOthers(self, shard, header, payload=b''):
+        for other, endpoint in self.endpoints.items():
+            if other != shard:
+                endpoint.send(header, payload)
+
+    def onMessage(self, endpoint, header, payload):
+        if header is None:
+            self.removeShard(endpoint)
+            return
+        op = header['op']
+        if op == 'hello':
+            self.addShard(endpoint, header['shard'])
+            return
+        shard = self.shards.get(endpoint)
+        if shard is None:
+            return
+        if op == 'broadcast' or op == 'rooms':
+            self.sendOthers(shard, header, payload)
+        elif op == 'deliver' or op == 'close':
+            target = self.endpoints.get(header['shard'])
+            if target is not None:
+                del header['shard']
+                target.send(header, payload)
+        elif op == 'join':
+            key = (shard, header['uid'])
+            nick = header['nick']
+            if nick in self.owners:
+                endpoint.send({'op': 'join-rejected', 'uid': header['uid']})
+                return
+            rooms = dict.fromkeys(header['rooms'])
+            self.users[key] = [nick, header['address'], rooms]
+            self.owners[nick] = key
+            self.sendOthers(shard, {'op': 'joined', 'shard': shard,
+                                    'uid': header['uid'], 'nick': nick,
+                                    'address': header['address'],
+                                    'rooms': list(rooms)})
+        elif op == 'enter' or op == 'part':
+            user = self.users.get((shard, header['uid']))
+            if user is None:
+                return
+            if op == 'enter':
+                user[2][header['room']] = None
+            else:
+                user[2].pop(header['room'], None)
+            self.sendOthers(shard, {'op': op + 'ed', 'shard': shard,
+                                    'uid': header['uid'],
+                                    'room': header['room']})
+        elif op == 'leave':
+            self.removeUser((shard, header['uid']))
+        elif op == 'rename':
+            key = (shard, header['uid'])
+            nick = header['nick']
+            if key not in self.users or nick in self.owners:
+                endpoint.send({'op': 'rename-rejected',
+                               'uid': header['uid'], 'nick': nick})
+                return
+            del self.owners[self.users[key][0]]
+            self.users[key][0] = nick
+            self.owners[nick] = key
+            renamed = {'op': 'renamed', 'shard': shard,
+                       'uid': header['uid'], 'nick': nick}
+            for other in self.endpoints.values():
+                other.send(renamed)
+        elif op == 'ban':
+            self.bans[header['network']] = header['expires']
+            self.sendOthers(shard, header)
+        elif op == 'unban':
+            self.bans.pop(header['network'], None)
+            self.sendOthers(shard, header)
+
+    # Registers the endpoint of a node and sends it its shard number and the
+    # current state. A node that asks for a shard that is taken, or joins a
+    # full hub, is turned down.
+    def addShard(self, endpoint, shard):
+        if shard is None:
+            shard = next((free for free in range(self.maxNodes)
+                          if free not in self.endpoints), None)
+        if shard is None or shard in self.endpoints or \
+                not 0 <= shard < self.maxNodes:
+            endpoint.send({'op': 'full'})
+            endpoint.flush()
+            endpoint.close()
+            return
+        self.endpoints[shard] = endpoint
+        self.shards[endpoint] = shard
+        endpoint.send({'op': 'welcome', 'shard': shard,
+                       'shards': self.maxNodes})
+        # The welcome goes out on its own, the node reads it before it
+        # starts its event loop.
+        endpoint.seal()
+        for (owner, uid), (nick, address, rooms) in self.users.items():
+            endpoint.send({'op': 'joined', 'shard': owner, 'uid': uid,
+                           'nick': nick, 'address': address,
+                           'rooms': list(rooms)})
+        for network, expires in self.bans.items():
+            endpoint.send({'op': 'ban', 'network': network,
+                           'expires': expires})
+
+    # Forgets a node whose connection closed, together with its users.
+    def removeShard(self, endpoint):
+        shard = self.shards.pop(endpoint, None)
+        if shard is None:
+            return
+        del self.endpoints[shard]
+        for key in [key for key in self.users if key[0] == shard]:
+            self.removeUser(key)
+
+    def removeUser(self, key):
+        user = self.users.pop(key, None)
+        if user is None:
+            return
+        if self.owners.get(user[0]) == key:
+            del self.owners[user[0]]
+        self.sendOthers(key[0], {'op': 'left', 'shard': key[0],
+                                 'uid': key[1]})
+
+    # Handles the messages that arrive within timeout seconds, None for as
+    # long as it takes, and sends what they caused.
+    def poll(self, timeout=None):
+        for key, mask in self.selector.select(timeout):
+            key.data(mask)
+        for endpoint in list(self.endpoints.values()):
+            endpoint.flush()
+
+    def run(self):
+        while True:
+            self.poll()
+
+
+class RemoteSocket:
+    """
+    Stands in for the socket of a user connected to another shard. Data sent
+    to it and requests to close it are forwarded to the owning shard.
+    """
+
+    __slots__ = ('shard', 'uid')
+
+    def __init__(self, shard, uid):
+        self.shard = shard
+        self.uid = uid
+
+    # The owning shard closes the real socket.
+    def close(self):
+        pass
+
+
+class ShardedServer(Server):
+    """
+    Server that owns one shard of the connections, as a worker of one
+    machine or a node of a cluster. The users of the other shards are kept
+    in the registry with a RemoteSocket, so the handlers of Server see every
+    online user.
+    """
+
+    # Constructor. The server joins the bus over the transport as the given
+    # shard, or as the one the hub gives it if shard is None.
+    def __init__(self, port, connections, selector, transport, shard=None,
+                 reusePort=True, **options):
+        sock = transport.connect()
+        shard, self.shards = joinBus(sock, shard)
+        self.shard = shard
+        super().__init__(port, connections, selector, reusePort=reusePort,
+                         logName=str(shard), **options)
+
+        # Uids of the local users and the stand-ins of the remote users.
+        self.nextUid = 0
+        self.uidOfSock = {}
+        self.sockOfUid = {}
+        self.remoteSockets = {}
+
+        self.bus = BusEndpoint(sock, self.selector, self.onBusMessage)
+
+    # Default nicknames are numbered with a stride of the shard count so two
+    # shards never pick the same one.
+    def newNickname(self):
+        number = self.shard + 1
+        while self.onlineUsers.getByNick(f"Jochem-{number}") is not None:
+            number += self.shards
+        return f"Jochem-{number}"
+
+    def addOnlineUser(self, socket, address, nickname):
+        user = super().addOnlineUser(socket, address, nickname)
+        if user is not None:
+            self.nextUid += 1
+            self.uidOfSock[socket] = self.nextUid
+            self.sockOfUid[self.nextUid] = socket
+            self.bus.send({'op': 'join', 'uid': self.nextUid,
+                           'nick': nickname, 'address': address,
+                           'rooms': []})
+        return user
+
+    # Removes a user. Only the owning shard announces that a user left, the
+    # other shards just forget it.
+    def removeOnlineUser(self, user):
+        if user is None or user not in self.onlineUsers:
+            return
+        super().removeOnlineUser(user)
+        uid = self.uidOfSock.pop(user.socket, None)
+        if uid is not None:
+            del self.sockOfUid[uid]
+            self.bus.send({'op': 'leave', 'uid': uid})
+
+    # Sends the event over the bus. The event travels as its fields, so
+    # every shard encodes it in the protocols of its own connections.
+    def sendEvent(self, header, event):
+        header['stamp'] = event.stamp
+        self.bus.send(header, event.pack())
+
+    def queueEvent(self, event, sock):
+        if isinstance(sock, RemoteSocket):
+            self.sendEvent({'op': 'deliver', 'shard': sock.shard,
+                            'uid': sock.uid}, event)
+        else:
+            super().queueEvent(event, sock)
+
+    def broadcastEvent(self, event):
+        super().broadcastEvent(event)
+        self.sendEvent({'op': 'broadcast'}, event)
+
+    # Queues the event for the local members and lets the other shards do
+    # the same for theirs.
+    def roomsEvent(self, rooms, event, remember=False):
+        if remember:
+            self.remember(rooms, event)
+        self.localRoomsEvent(rooms, event)
+        self.sendEvent({'op': 'rooms', 'rooms': rooms, 'remember': remember},
+                       event)
+
+    # Queues the event for the members of the rooms connected to this shard.
+    def localRoomsEvent(self, rooms, event):
+        for user in list(self.onlineUsers.getMembers(rooms)):
+            if not isinstance(user.socket, RemoteSocket):
+                Server.queueEvent(self, event, user.socket)
+
+    def addToRoom(self, user, room):
+        joined = super().addToRoom(user, room)
+        uid = self.uidOfSock.get(user.socket)
+        if joined and uid is not None:
+            self.bus.send({'op': 'enter', 'uid': uid, 'room': room})
+        return joined
+
+    def removeFromRoom(self, user, room):
+        super().removeFromRoom(user, room)
+        uid = self.uidOfSock.get(user.socket)
+        if uid is not None:
+            self.bus.send({'op': 'part', 'uid': uid, 'room': room})
+
+    def closeConnection(self, sock):
+        if isinstance(sock, RemoteSocket):
+            self.bus.send({'op': 'close', 'shard': sock.shard,
+                           'uid': sock.uid})
+        else:
+            super().closeConnection(sock)
+
+    def dropConnection(self, sock):
+        if isinstance(sock, RemoteSocket):
+            self.closeConnection(sock)
+        else:
+            super().dropConnection(sock)
+
+    def flushPending(self):
+        super().flushPending()
+        self.bus.flush()
+
+    # Asks the hub for the nickname. The rename is done once the hub
+    # confirms it.
+    def handleNick(self, receiveSock, newNick):
+        if self.getUserFromNick(newNick) is not None:
+            mess = self.notice(f"username {newNick} already in use")
+            self.sendMessageOne(mess, receiveSock)
+            return
+        uid = self.uidOfSock.get(receiveSock)
+        if uid is None:
+            mess = self.notice("Error changing username.")
+            self.sendMessageOne(mess, receiveSock)
+            return
+        self.bus.send({'op': 'rename', 'uid': uid, 'nick': newNick})
+
+    def addBan(self, network, expires=None):
+        network = super().addBan(network, expires)
+        self.bus.send({'op': 'ban', 'network': network, 'expires': expires})
+        return network
+
+    def removeBan(self, network):
+        removed = super().removeBan(network)
+        if removed:
+            self.bus.send({'op': 'unban', 'network': network})
+        return removed
+
+    # Gives a local user holding the nickname a new default nickname. Used
+    # when the hub gave the nickname to a user of another shard first, the
+    # claim of the local user is rejected by the hub in that case.
+    def releaseNick(self, nick):
+        user = self.getUserFromNick(nick)
+        if user is None or isinstance(user.socket, RemoteSocket):
+            return
+        newNick = self.newNickname()
+        self.onlineUsers.rename(user, newNick)
+        mess = self.notice(f"username {nick} already in use, you are now "
+                           f"{newNick}")
+        Server.queueEvent(self, mess, user.socket)
+
+    def onBusMessage(self, endpoint, header, payload):
+        if header is None:
+            raise SystemExit("lost the connection to the hub")
+        op = header['op']
+        if op == 'broadcast' or op == 'rooms' or op == 'deliver':
+            try:
+                event = Event.unpack(payload, header['stamp'])
+            except FrameError as e:
+                print(f"dropped a {op} message from the bus: {e}",
+                      file=sys.stderr)
+                return
+        if op == 'broadcast':
+            Server.broadcastEvent(self, event)
+        elif op == 'rooms':
+            if header['remember']:
+                self.remember(header['rooms'], event)
+            self.localRoomsEvent(header['rooms'], event)
+        elif op == 'deliver':
+            sock = self.sockOfUid.get(header['uid'])
+            if sock is not None:
+                Server.queueEvent(self, event, sock)
+        elif op == 'close':
+            sock = self.sockOfUid.get(header['uid'])
+            if sock is not None:
+                self.removeOnlineUser(self.getUserFromSock(sock))
+                Server.closeConnection(self, sock)
+        elif op == 'joined':
+            key = (header['shard'], header['uid'])
+            remote = RemoteSocket(*key)
+            self.releaseNick(header['nick'])
+            user = self.onlineUsers.add(remote, header['address'],
+                                        header['nick'])
+            if user is not None:
+                self.remoteSockets[key] = remote
+                for room in header['rooms']:
+                    self.onlineUsers.join(user, room)
+        elif op == 'entered' or op == 'parted':
+            remote = self.remoteSockets.get((header['shard'], header['uid']))
+            user = self.getUserFromSock(remote)
+            if user is None:
+                return
+            if op == 'entered':
+                self.addToRoom(user, header['room'])
+            else:
+                self.removeFromRoom(user, header['room'])
+        elif op == 'left':
+            remote = self.remoteSockets.pop((header['shard'], header['uid']),
+                                            None)
+            if remote is not None:
+                Server.removeOnlineUser(self, self.getUserFromSock(remote))
+        elif op == 'renamed':
+            if header['shard'] == self.shard:
+                sock = self.sockOfUid.get(header['uid'])
+            else:
+                sock = self.remoteSockets.get((header['shard'],
+                                               header['uid']))
+            user = self.getUserFromSock(sock)
+            if user is None:
+                return
+            self.releaseNick(header['nick'])
+            if header['shard'] == self.shard:
+                self.renameUser(user, header['nick'])
+            else:
+                self.onlineUsers.rename(user, header['nick'])
+        elif op == 'rename-rejected':
+            sock = self.sockOfUid.get(header['uid'])
+            if sock is not None:
+                mess = self.notice(f"username {header['nick']} already in "
+                                   "use")
+                self.sendMessageOne(mess, sock)
+        elif op == 'join-rejected':
+            sock = self.sockOfUid.get(header['uid'])
+            user = self.getUserFromSock(sock)
+            if user is not None:
+                self.releaseNick(user.nickname)
+                self.bus.send({'op': 'join', 'uid': header['uid'],
+                               'nick': user.nickname,
+                               'address': user.address,
+                               'rooms': list(user.rooms)})
+        elif op == 'ban':
+            self.bans.add(header['network'], header['expires'])
+        elif op == 'unban':
+            self.bans.remove(header['network'])
+
+
+# Runs one worker process. Worker n serves its metrics on metricsPort + n.
+def runWorker(port, backend, shard, transport, metricsPort, sslContext,
+              options):
+    server = ShardedServer(port, 20, BACKENDS[backend](), transport, shard,
+                           metrics=metricsPort is not None,
+                           sslContext=sslContext, **options)
+    if metricsPort is not None:
+        MetricsEndpoint(server, metricsPort + shard)
+    signal.signal(signal.SIGHUP, lambda signum, frame: server.reloadBans())
+    chatserver.runUntilStopped(server)
+
+
+def serve(port, cert, key, backend='default', workers=2, metricsPort=None,
+          tls=False, **options):
+    """
+    Chat server entry point for the multi-process mode. Every worker accepts
+    connections on the same port with SO_REUSEPORT and the workers talk over
+    a hub in this process.
+    port: The port to listen on.
+    cert: The server public certificate.
+    key: The server private key.
+    backend: The I/O backend of the workers, one of the keys of BACKENDS.
+    workers: The number of worker processes.
+    metricsPort: Local port of the Prometheus metrics of the first worker,
+                 the others use the ports after it. None turns metrics off.
+    tls: Serves clients over TLS with the certificate and key.
+    options: Keyword arguments for Server, e.g. the outbound buffer limits.
+    """
+    # The workers inherit one TLS context, so they share its session ticket
+    # keys and a client resumes its session whichever worker it reaches.
+    sslContext = serverContext(cert, key) if tls else None
+    busDir = tempfile.mkdtemp(prefix='chatserver-')
+    transport = UnixTransport(os.path.join(busDir, 'bus'))
+    hub = Hub(transport, workers)
+    processes = [multiprocessing.Process(target=runWorker,
+                                         args=(port, backend, shard,
+                                               transport, metricsPort,
+                                               sslContext, options),
+                                         daemon=True)
+                 for shard in range(workers)]
+    # Cleans up the workers and the bus on termination as well, and lets the
+    # workers reload the bans on SIGHUP.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def reloadBans(signum, frame):
+        for process in processes:
+            if process.pid is not None:
+                os.kill(process.pid, signal.SIGHUP)
+
+    signal.signal(signal.SIGHUP, reloadBans)
+    try:
+        for process in processes:
+            process.start()
+        hub.run()
+    finally:
+        for process in processes:
+            process.terminate()
+        shutil.rmtree(busDir, ignore_errors=True)
+
+
+def serveNode(port, cert, key, transport, backend='default', metricsPort=None,
+              tls=False, **options):
+    """
+    Chat server entry point for a node of a cluster. The node joins the hub
+    at the transport and shares its users, rooms and bans with the other
+    nodes, which may run on other machines.
+    port: The port to listen on.
+    cert: The server public certificate.
+    key: The server private key.
+    transport: The transport of the bus, see parseBusAddress.
+    backend: The I/O backend to use, one of the keys of BACKENDS.
+    metricsPort: Local port to serve Prometheus metrics on, None to turn
+                 metrics off.
+    tls: Serves clients over TLS with the certificate and key.
+    options: Keyword arguments for Server, e.g. the outbound buffer limits.
+    """
+    sslContext = serverContext(cert, key) if tls else None
+    server = ShardedServer(port, 20, BACKENDS[backend](), transport,
+                           reusePort=False, metrics=metricsPort is not None,
+                           sslContext=sslContext, **options)
+    if metricsPort is not None:
+        MetricsEndpoint(server, metricsPort)
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, lambda signum, frame: server.reloadBans())
+    chatserver.runUntilStopped(server)
+
+
+# Command line parser of the cluster hub.
+if __name__ == '__main__':
+    import argparse
+    p = argparse.ArgumentParser(description='Hub of a cluster of chat '
+                                'servers started with --cluster ADDRESS.')
+    p.add_argument('--listen', help='bus address to listen on, '
+                   'tcp://HOST:PORT or unix://PATH',
+                   default='tcp://127.0.0.1:12400', type=parseBusAddress)
+    p.add_argument('--max-nodes', help='number of nodes the hub accepts',
+                   default=MAX_NODES, type=int)
+    args = p.parse_args(sys.argv[1:])
+    Hub(args.listen, args.max_nodes).run()
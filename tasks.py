@@ -0,0 +1,55 @@
+import collections
+import queue
+import selectors
+import socket as s
+import threading
+import traceback
+
+
+class TaskRunner:
+    """
+    Runs blocking functions on a worker thread and calls their callbacks from
+    the event loop of the select engine. The worker wakes the event loop
+    through a socket pair that is registered with the selector.
+    """
+
+    # Constructor.
+    def __init__(self, selector):
+        self.tasks = queue.SimpleQueue()
+        self.done = collections.deque()
+        self.wakeup, self.notify = s.socketpair()
+        self.wakeup.setblocking(0)
+        self.notify.setblocking(0)
+        selector.register(self.wakeup, selectors.EVENT_READ, self.onWakeup)
+        self.thread = threading.Thread(target=self.run, name='tasks',
+                                       daemon=True)
+        self.thread.start()
+
+    # Runs func on the worker thread. callback is called on the event loop
+    # with its result and None, or with None and the exception it raised.
+    def submit(self, func, callback):
+        self.tasks.put((func, callback))
+
+    def run(self):
+        while True:
+            func, callback = self.tasks.get()
+            try:
+                result, error = func(), None
+            except Exception as e:
+                traceback.print_exc()
+                result, error = None, e
+            self.done.append((callback, result, error))
+            try:
+                self.notify.send(b'\0')
+            except BlockingIOError:
+                # The event loop has wakeups pending already.
+                pass
+
+    def onWakeup(self, mask):
+        try:
+            self.wakeup.recv(4096)
+        except BlockingIOError:
+            pass
+        while self.done:
+            callback, result, error = self.done.popleft()
+            callback(result, error)
@@ -0,0 +1,203 @@
+import math
+import time
+
+# Slots per level of the wheel as a power of two, and the number of levels.
+# With a resolution of 10 ms the wheel spans 64 ** 4 ticks, about 46 hours.
+SLOT_BITS = 6
+SLOTS = 1 << SLOT_BITS
+MASK = SLOTS - 1
+LEVELS = 4
+SPAN = SLOTS ** LEVELS
+
+
+class Timer:
+    """
+    A callback scheduled on a TimerWheel. The wheel drops its reference once
+    the timer fired or was cancelled.
+    """
+
+    __slots__ = ('wheel', 'expires', 'callback', 'args', 'level', 'index')
+
+    # Constructor.
+    def __init__(self, wheel, expires, callback, args):
+        self.wheel = wheel
+        self.expires = expires
+        self.callback = callback
+        self.args = args
+        self.level = 0
+        self.index = 0
+
+    # Cancels the timer. Does nothing if it fired or was cancelled already.
+    def cancel(self):
+        if self.wheel is not None:
+            self.wheel.remove(self)
+
+    # Returns True while the timer is scheduled.
+    def active(self):
+        return self.wheel is not None
+
+
+class TimerWheel:
+    """
+    Timers of the event loop in a hierarchical timing wheel. Every level has
+    SLOTS slots and every slot of a level spans SLOTS slots of the level
+    below it. A timer goes into the slot of the lowest level whose span
+    reaches its expiry and moves down a level when the wheel reaches the
+    slot it is in, until it fires from the lowest level. Scheduling and
+    cancelling cost O(1), a timer moves down at most LEVELS - 1 times, and
+    a bitmap of the occupied slots per level lets the wheel skip straight
+    to the next tick that has work, however long the loop slept. Resetting
+    a timer to a later expiry only records it, the expiry is checked when
+    the wheel reaches the timer.
+    """
+
+    # Constructor. resolution is the length of a tick in seconds, timers
+    # never fire early but up to one tick late.
+    def __init__(self, resolution=0.01, clock=time.monotonic):
+        self.resolution = resolution
+        self.clock = clock
+        self.now = clock()
+        # The last tick the wheel processed.
+        self.tick = int(self.now / resolution)
+        self.slots = [[{} for _ in range(SLOTS)] for _ in range(LEVELS)]
+        # Bit i of occupied[level] is set if slots[level][i] has timers.
+        self.occupied = [0] * LEVELS
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # Returns the tick at which a timer due after delay seconds fires, at
+    # least the next one.
+    def expiry(self, delay):
+        expires = math.ceil((self.clock() + delay) / self.resolution)
+        return expires if expires > self.tick else self.tick + 1
+
+    # Calls callback with args after delay seconds. Returns the Timer.
+    def schedule(self, delay, callback, *args):
+        timer = Timer(self, self.expiry(delay), callback, args)
+        self.insert(timer)
+        self.count += 1
+        return timer
+
+    # Moves the timer to fire delay seconds from now, and schedules it again
+    # if it fired or was cancelled. A later expiry is only recorded: the
+    # timer stays in its slot and moves on when the wheel gets there, so
+    # pushing a deadline back does not touch the wheel. An earlier expiry
+    # moves the timer right away.
+    def reset(self, timer, delay):
+        expires = self.expiry(delay)
+        if timer.wheel is None:
+            timer.wheel = self
+            self.count += 1
+        elif expires >= timer.expires:
+            timer.expires = expires
+            return
+        else:
+            slot = self.slots[timer.level][timer.index]
+            del slot[timer]
+            if not slot:
+                self.occupied[timer.level] &= ~(1 << timer.index)
+        timer.expires = expires
+        self.insert(timer)
+
+    # Puts the timer in its slot relative to the current tick. Timers past
+    # the span of the wheel go in the last slot they can and are put back
+    # once they get there.
+    def insert(self, timer):
+        delta = timer.expires - self.tick
+        if delta < SLOTS:
+            level = 0
+            index = timer.expires & MASK
+        else:
+            if delta >= SPAN:
+                delta = SPAN - 1
+            level = (delta.bit_length() - 1) // SLOT_BITS
+            if level >= LEVELS:
+                level = LEVELS - 1
+            index = ((self.tick + delta) >> (level * SLOT_BITS)) & MASK
+        timer.level = level
+        timer.index = index
+        self.slots[level][index][timer] = None
+        self.occupied[level] |= 1 << index
+
+    # Removes a scheduled timer.
+    def remove(self, timer):
+        slot = self.slots[timer.level][timer.index]
+        del slot[timer]
+        if not slot:
+            self.occupied[timer.level] &= ~(1 << timer.index)
+        timer.wheel = None
+        self.count -= 1
+
+    # Returns the next tick after the current one at which a slot fires or
+    # moves down, None if no timer is scheduled.
+    def nextTick(self):
+        if not self.count:
+            return None
+        best = None
+        for level in range(LEVELS):
+            bits = self.occupied[level]
+            if not bits:
+                continue
+            shift = level * SLOT_BITS
+            block = self.tick >> shift
+            # Rotates the bitmap so bit 0 is the slot after the current one.
+            start = (block & MASK) + 1
+            rotated = ((bits >> start) | (bits << (SLOTS - start))) & \
+                ((1 << SLOTS) - 1)
+            distance = (rotated & -rotated).bit_length()
+            tick = (block + distance) << shift
+            if best is None or tick < best:
+                best = tick
+        return best
+
+    # Returns the seconds until the next timer may fire, None if no timer
+    # is scheduled.
+    def timeout(self):
+        tick = self.nextTick()
+        if tick is None:
+            return None
+        return max(0, tick * self.resolution - self.clock())
+
+    # Fires the timers that expired, skipping the ticks without work.
+    def advance(self):
+        self.now = self.clock()
+        target = int(self.now / self.resolution)
+        while True:
+            tick = self.nextTick()
+            if tick is None or tick > target:
+                self.tick = max(self.tick, target)
+                return
+            self.tick = tick
+            self.process(tick)
+
+    # Moves the timers of the higher level slots the tick reaches down and
+    # fires the timers of its lowest level slot.
+    def process(self, tick):
+        for level in range(1, LEVELS):
+            shift = level * SLOT_BITS
+            if tick & ((1 << shift) - 1):
+                break
+            index = (tick >> shift) & MASK
+            slot = self.slots[level][index]
+            if slot:
+                self.slots[level][index] = {}
+                self.occupied[level] &= ~(1 << index)
+                for timer in slot:
+                    self.insert(timer)
+
+        index = tick & MASK
+        slot = self.slots[0][index]
+        # Timers are taken out one at a time, a callback may cancel a timer
+        # of the same slot.
+        while slot:
+            timer = next(iter(slot))
+            del slot[timer]
+            if timer.expires > tick:
+                self.insert(timer)
+                continue
+            timer.wheel = None
+            self.count -= 1
+            timer.callback(*timer.args)
+        self.occupied[0] &= ~(1 << index)
@@ -0,0 +1,87 @@
+import selectors
+import ssl
+
+# Errors of a non-blocking TLS socket that only mean it has to wait for the
+# socket to become readable or writable again.
+WANT_IO = (ssl.SSLWantReadError, ssl.SSLWantWriteError)
+
+
+# Returns the TLS context of the server for the certificate and key files.
+# Sessions can be resumed with session tickets, tickets is the number of
+# them a client gets per full handshake (TLS 1.3), and with the session
+# cache of the context (TLS 1.2). Raises OSError or ssl.SSLError if the
+# files cannot be loaded.
+def serverContext(cert, key, tickets=2):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert, key)
+    context.options &= ~ssl.OP_NO_TICKET
+    context.num_tickets = tickets
+    return context
+
+
+# Returns a TLS context for clients. Without cafile the certificate of the
+# server is checked against the default CA certificates of the system.
+def clientContext(cafile=None):
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
+
+
+class Handshake:
+    """
+    Drives the server side TLS handshake of an accepted socket from the
+    event loop of the select engine. The socket is registered for whatever
+    the handshake waits for, so a slow client never blocks the others. done
+    is called with the socket once the handshake completed, failed with the
+    socket and the error if it did not. timer is cancelled when the
+    handshake ends, e.g. the timer that aborts it.
+    """
+
+    __slots__ = ('sock', 'selector', 'done', 'failed', 'events', 'timer')
+
+    # Constructor.
+    def __init__(self, sock, selector, done, failed):
+        self.sock = sock
+        self.selector = selector
+        self.done = done
+        self.failed = failed
+        self.events = selectors.EVENT_READ
+        self.timer = None
+
+    # Starts the handshake right away, the first message of the client
+    # usually arrived together with the connection.
+    def start(self):
+        self.selector.register(self.sock, self.events, self.onEvent)
+        self.onEvent(self.events)
+
+    # Ends a handshake that took too long.
+    def abort(self):
+        self.timer = None
+        self.finish()
+        self.failed(self.sock, TimeoutError("TLS handshake timed out"))
+
+    def onEvent(self, mask):
+        try:
+            self.sock.do_handshake()
+        except ssl.SSLWantReadError:
+            self.wait(selectors.EVENT_READ)
+        except ssl.SSLWantWriteError:
+            self.wait(selectors.EVENT_WRITE)
+        except OSError as e:
+            self.finish()
+            self.failed(self.sock, e)
+        else:
+            self.finish()
+            self.done(self.sock)
+
+    def finish(self):
+        self.selector.unregister(self.sock)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def wait(self, events):
+        if events != self.events:
+            self.events = events
+            self.selector.modify(self.sock, events, self.onEvent)